@@ -12,19 +12,25 @@ import tempfile
 import os
 
 from agentpress.thread_manager import ThreadManager
+from agentpress.utils.json_helpers import dumps, loads
 from services.supabase import DBConnection
 from services import redis
 from utils.auth_utils import get_current_user_id_from_jwt, get_user_id_from_stream_auth, verify_thread_access
 from utils.logger import logger, structlog
 from services.billing import check_billing_status, can_use_model
 from utils.config import config
+from utils.tracing import critical_path, get_finished_trace, profile_key
+from utils.pagination import keyset_pages
 from sandbox.sandbox import create_sandbox, delete_sandbox, get_or_start_sandbox
 from services.llm import make_llm_api_call
-from run_agent_background import run_agent_background, _cleanup_redis_response_list, update_agent_run_status
+from run_agent_background import run_agent_background, archive_agent_run, _cleanup_redis_response_list, update_agent_run_status
 from utils.constants import MODEL_NAME_ALIASES
 from flags.flags import is_enabled
 
 from .config_helper import extract_agent_config, build_unified_config, extract_tools_for_agent_run, get_mcp_configs
+from .bootstrap_cache import invalidate_agent_bootstrap
+from . import response_stream, run_archiver, run_registry
+from .stream_hub import get_stream_hub
 
 router = APIRouter()
 db = None
@@ -147,26 +153,24 @@ async def cleanup():
     """Clean up resources and stop running agents on shutdown."""
     logger.info("Starting cleanup of agent API resources")
 
-    # Use the instance_id to find and clean up this instance's keys
+    # Use the instance_id to find and clean up this instance's runs
     try:
         if instance_id: # Ensure instance_id is set
-            running_keys = await redis.keys(f"active_run:{instance_id}:*")
-            logger.info(f"Found {len(running_keys)} running agent runs for instance {instance_id} to clean up")
-
-            for key in running_keys:
-                # Key format: active_run:{instance_id}:{agent_run_id}
-                parts = key.split(":")
-                if len(parts) == 3:
-                    agent_run_id = parts[2]
-                    await stop_agent_run(agent_run_id, error_message=f"Instance {instance_id} shutting down")
-                else:
-                    logger.warning(f"Unexpected key format found: {key}")
+            running_run_ids = await run_registry.get_instance_runs(instance_id)
+            logger.info(f"Found {len(running_run_ids)} running agent runs for instance {instance_id} to clean up")
+
+            for agent_run_id in running_run_ids:
+                await stop_agent_run(agent_run_id, error_message=f"Instance {instance_id} shutting down")
+                await run_registry.unregister_run(instance_id, agent_run_id)
         else:
             logger.warning("Instance ID not set, cannot clean up instance-specific agent runs.")
 
     except Exception as e:
         logger.error(f"Failed to clean up running agent runs: {str(e)}")
 
+    # Stop the shared stream subscription before closing Redis
+    await get_stream_hub().close()
+
     # Close Redis connection
     await redis.close()
     logger.info("Completed cleanup of agent API resources")
@@ -177,25 +181,28 @@ async def stop_agent_run(agent_run_id: str, error_message: Optional[str] = None)
     client = await db.client
     final_status = "failed" if error_message else "stopped"
 
-    # Attempt to fetch final responses from Redis
-    response_list_key = f"agent_run:{agent_run_id}:responses"
-    all_responses = []
-    try:
-        all_responses_json = await redis.lrange(response_list_key, 0, -1)
-        all_responses = [json.loads(r) for r in all_responses_json]
-        logger.info(f"Fetched {len(all_responses)} responses from Redis for DB update on stop/fail: {agent_run_id}")
-    except Exception as e:
-        logger.error(f"Failed to fetch responses from Redis for {agent_run_id} during stop/fail: {e}")
-        # Try fetching from DB as a fallback? Or proceed without responses? Proceeding without for now.
-
     # Update the agent run status in the database
     update_success = await update_agent_run_status(
-        client, agent_run_id, final_status, error=error_message, responses=all_responses
+        client, agent_run_id, final_status, error=error_message
     )
 
     if not update_success:
         logger.error(f"Failed to update database status for stopped/failed run {agent_run_id}")
 
+    # Archive the responses in the background, in case no worker is left to do it
+    try:
+        archive_agent_run.send(agent_run_id=agent_run_id)
+    except Exception as e:
+        logger.error(f"Failed to enqueue archiving of agent run {agent_run_id}: {str(e)}")
+
+    # End the stream for clients reading the run through the Redis Streams transport,
+    # before the STOP signal below wakes them up
+    try:
+        if await redis.exists(response_stream.response_stream_key(agent_run_id)):
+            await response_stream.append_control(agent_run_id, "STOP")
+    except Exception as e:
+        logger.error(f"Failed to append STOP signal to response stream of {agent_run_id}: {str(e)}")
+
     # Send STOP signal to the global control channel
     global_control_channel = f"agent_run:{agent_run_id}:control"
     try:
@@ -206,22 +213,16 @@ async def stop_agent_run(agent_run_id: str, error_message: Optional[str] = None)
 
     # Find all instances handling this agent run and send STOP to instance-specific channels
     try:
-        instance_keys = await redis.keys(f"active_run:*:{agent_run_id}")
-        logger.debug(f"Found {len(instance_keys)} active instance keys for agent run {agent_run_id}")
-
-        for key in instance_keys:
-            # Key format: active_run:{instance_id}:{agent_run_id}
-            parts = key.split(":")
-            if len(parts) == 3:
-                instance_id_from_key = parts[1]
-                instance_control_channel = f"agent_run:{agent_run_id}:control:{instance_id_from_key}"
-                try:
-                    await redis.publish(instance_control_channel, "STOP")
-                    logger.debug(f"Published STOP signal to instance channel {instance_control_channel}")
-                except Exception as e:
-                    logger.warning(f"Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
-            else:
-                 logger.warning(f"Unexpected key format found: {key}")
+        run_instance_ids = await run_registry.get_run_instances(agent_run_id)
+        logger.debug(f"Found {len(run_instance_ids)} active instances for agent run {agent_run_id}")
+
+        for run_instance_id in run_instance_ids:
+            instance_control_channel = f"agent_run:{agent_run_id}:control:{run_instance_id}"
+            try:
+                await redis.publish(instance_control_channel, "STOP")
+                logger.debug(f"Published STOP signal to instance channel {instance_control_channel}")
+            except Exception as e:
+                logger.warning(f"Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
 
         # Clean up the response list immediately on stop/fail
         await _cleanup_redis_response_list(agent_run_id)
@@ -385,11 +386,10 @@ async def start_agent(
     logger.info(f"Created new agent run: {agent_run_id}")
 
     # Register this run in Redis with TTL using instance ID
-    instance_key = f"active_run:{instance_id}:{agent_run_id}"
     try:
-        await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+        await run_registry.register_run(instance_id, agent_run_id)
     except Exception as e:
-        logger.warning(f"Failed to register agent run in Redis ({instance_key}): {str(e)}")
+        logger.warning(f"Failed to register agent run {agent_run_id} for instance {instance_id} in Redis: {str(e)}")
 
     request_id = structlog.contextvars.get_contextvars().get('request_id')
 
@@ -404,6 +404,7 @@ async def start_agent(
         is_agent_builder=is_agent_builder,
         target_agent_id=target_agent_id,
         request_id=request_id,
+        account_id=account_id,
     )
 
     return {"agent_run_id": agent_run_id, "status": "running"}
@@ -452,6 +453,24 @@ async def get_agent_run(agent_run_id: str, user_id: str = Depends(get_current_us
         "error": agent_run_data['error']
     }
 
+@router.get("/debug/runs/{agent_run_id}/profile")
+async def get_agent_run_profile(agent_run_id: str, user_id: str = Depends(get_current_user_id_from_jwt)):
+    """Get the critical path of a sampled agent run, built from its span trace."""
+    structlog.contextvars.bind_contextvars(
+        agent_run_id=agent_run_id,
+    )
+    client = await db.client
+    await get_agent_run_with_access_check(client, agent_run_id, user_id)
+
+    # Runs executed by this process are still in its ring buffer; others were stored by their worker
+    trace = get_finished_trace(agent_run_id)
+    if trace is None:
+        trace_json = await redis.get(profile_key(agent_run_id))
+        trace = loads(trace_json) if trace_json else None
+    if trace is None:
+        raise HTTPException(status_code=404, detail="No profile recorded for this agent run (it was not sampled, is still running or has expired)")
+    return critical_path(trace)
+
 @router.get("/thread/{thread_id}/agent", response_model=ThreadAgentResponse)
 async def get_thread_agent(thread_id: str, user_id: str = Depends(get_current_user_id_from_jwt)):
     """Get the agent details for a specific thread. Since threads are now agent-agnostic, 
@@ -594,9 +613,14 @@ async def get_thread_agent(thread_id: str, user_id: str = Depends(get_current_us
 async def stream_agent_run(
     agent_run_id: str,
     token: Optional[str] = None,
+    last_event_id: Optional[str] = None,
     request: Request = None
 ):
-    """Stream the responses of an agent run using Redis Lists and Pub/Sub."""
+    """Stream the responses of an agent run using Redis Streams, or Redis Lists and Pub/Sub for runs on the legacy transport.
+
+    Clients resuming a Redis Streams run send the ID of the last event they received,
+    either as the Last-Event-ID header or the last_event_id query parameter.
+    """
     logger.info(f"Starting stream for agent run: {agent_run_id}")
     client = await db.client
 
@@ -608,135 +632,177 @@ async def stream_agent_run(
         user_id=user_id,
     )
 
-    response_list_key = f"agent_run:{agent_run_id}:responses"
-    response_channel = f"agent_run:{agent_run_id}:new_response"
-    control_channel = f"agent_run:{agent_run_id}:control" # Global control channel
+    response_list_key = response_stream.response_list_key(agent_run_id)
+    response_channel = response_stream.response_channel(agent_run_id)
+
+    async def get_run_status():
+        run_status = await client.table('agent_runs').select('status', 'thread_id').eq("id", agent_run_id).maybe_single().execute()
+        return run_status.data or {}
+
+    async def replay_archive():
+        # Responses expire from Redis a day after the run ends; older runs are replayed from their archive
+        archived_responses = await run_archiver.load_archived_responses(client, agent_run_id)
+        if archived_responses:
+            logger.debug(f"Replaying {len(archived_responses)} archived responses for {agent_run_id}")
+        return "".join(f"data: {dumps(response)}\n\n" for response in archived_responses)
+
+    async def stream_entries_generator(resume_id: Optional[str]):
+        last_id = resume_id or "0-0"
+        logger.debug(f"Streaming responses for {agent_run_id} from Redis stream after entry {last_id}")
+        # Subscribe before the first read so no notification is missed in between
+        subscription = get_stream_hub().subscribe(agent_run_id)
+        initial_yield_complete = False
+
+        try:
+            # 1. Catch up on the entries already in the stream, many per round trip
+            while True:
+                entries = await response_stream.read_entries(agent_run_id, last_id)
+                if not entries:
+                    break
+                events, last_id, ended = response_stream.format_sse(entries)
+                yield events
+                if ended:
+                    return
+            initial_yield_complete = True
+
+            # 2. Check run status *after* yielding initial data
+            run_data = await get_run_status()
+            if run_data.get('status') != 'running':
+                logger.info(f"Agent run {agent_run_id} is not running (status: {run_data.get('status')}). Ending stream.")
+                if last_id == "0-0":
+                    archived_events = await replay_archive()
+                    if archived_events:
+                        yield archived_events
+                yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
+                return
+
+            structlog.contextvars.bind_contextvars(
+                thread_id=run_data.get('thread_id'),
+            )
+
+            # 3. On each hub notification, read everything appended since the last entry
+            while True:
+                event = await subscription.get(timeout=config.RESPONSE_STREAM_BLOCK_MS / 1000)
+                if event is not None and event[0] == "evicted":
+                    yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': 'Stream consumer too slow'})}\n\n"
+                    return
+
+                while True:
+                    entries = await response_stream.read_entries(agent_run_id, last_id)
+                    if not entries:
+                        break
+                    events, last_id, ended = response_stream.format_sse(entries)
+                    yield events
+                    if ended:
+                        return
+
+                if event is not None and event[0] == "control":
+                    # Control entries are appended before being published, so this only
+                    # happens if the entry could not be written
+                    yield f"data: {json.dumps({'type': 'status', 'status': event[1]})}\n\n"
+                    return
+
+                if event is None:
+                    # Nothing new: make sure the run did not end without a final entry (e.g. a crashed worker)
+                    run_data = await get_run_status()
+                    if run_data.get('status') != 'running':
+                        logger.info(f"Agent run {agent_run_id} ended without a final stream entry (status: {run_data.get('status')}). Ending stream.")
+                        yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
+                        return
+
+        except asyncio.CancelledError:
+            logger.info(f"Stream generator cancelled for {agent_run_id}")
+            raise
+        except Exception as e:
+            logger.error(f"Error streaming agent run {agent_run_id}: {e}", exc_info=True)
+            if not initial_yield_complete:
+                yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Failed to start stream: {e}'})}\n\n"
+            else:
+                yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Stream failed: {e}'})}\n\n"
+        finally:
+            subscription.close()
+            logger.debug(f"Streaming cleanup complete for agent run: {agent_run_id}")
 
     async def stream_generator():
         logger.debug(f"Streaming responses for {agent_run_id} using Redis list {response_list_key} and channel {response_channel}")
         last_processed_index = -1
-        pubsub_response = None
-        pubsub_control = None
-        listener_task = None
+        # Subscribe before the first read so no notification is missed in between
+        subscription = get_stream_hub().subscribe(agent_run_id)
         terminate_stream = False
         initial_yield_complete = False
 
         try:
             # 1. Fetch and yield initial responses from Redis list
             initial_responses_json = await redis.lrange(response_list_key, 0, -1)
-            initial_responses = []
             if initial_responses_json:
-                initial_responses = [json.loads(r) for r in initial_responses_json]
-                logger.debug(f"Sending {len(initial_responses)} initial responses for {agent_run_id}")
-                for response in initial_responses:
-                    yield f"data: {json.dumps(response)}\n\n"
-                last_processed_index = len(initial_responses) - 1
+                logger.debug(f"Sending {len(initial_responses_json)} initial responses for {agent_run_id}")
+                # Responses are forwarded exactly as the worker serialized them
+                yield "".join(f"data: {response_json}\n\n" for response_json in initial_responses_json)
+                last_processed_index = len(initial_responses_json) - 1
             initial_yield_complete = True
 
             # 2. Check run status *after* yielding initial data
-            run_status = await client.table('agent_runs').select('status', 'thread_id').eq("id", agent_run_id).maybe_single().execute()
-            current_status = run_status.data.get('status') if run_status.data else None
+            run_data = await get_run_status()
+            current_status = run_data.get('status')
 
             if current_status != 'running':
                 logger.info(f"Agent run {agent_run_id} is not running (status: {current_status}). Ending stream.")
+                if not initial_responses_json:
+                    archived_events = await replay_archive()
+                    if archived_events:
+                        yield archived_events
                 yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
                 return
           
             structlog.contextvars.bind_contextvars(
-                thread_id=run_status.data.get('thread_id'),
+                thread_id=run_data.get('thread_id'),
             )
 
-            # 3. Set up Pub/Sub listeners for new responses and control signals
-            pubsub_response = await redis.create_pubsub()
-            await pubsub_response.subscribe(response_channel)
-            logger.debug(f"Subscribed to response channel: {response_channel}")
-
-            pubsub_control = await redis.create_pubsub()
-            await pubsub_control.subscribe(control_channel)
-            logger.debug(f"Subscribed to control channel: {control_channel}")
-
-            # Queue to communicate between listeners and the main generator loop
-            message_queue = asyncio.Queue()
-
-            async def listen_messages():
-                response_reader = pubsub_response.listen()
-                control_reader = pubsub_control.listen()
-                tasks = [asyncio.create_task(response_reader.__anext__()), asyncio.create_task(control_reader.__anext__())]
-
-                while not terminate_stream:
-                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-                    for task in done:
-                        try:
-                            message = task.result()
-                            if message and isinstance(message, dict) and message.get("type") == "message":
-                                channel = message.get("channel")
-                                data = message.get("data")
-                                if isinstance(data, bytes): data = data.decode('utf-8')
-
-                                if channel == response_channel and data == "new":
-                                    await message_queue.put({"type": "new_response"})
-                                elif channel == control_channel and data in ["STOP", "END_STREAM", "ERROR"]:
-                                    logger.info(f"Received control signal '{data}' for {agent_run_id}")
-                                    await message_queue.put({"type": "control", "data": data})
-                                    return # Stop listening on control signal
-
-                        except StopAsyncIteration:
-                            logger.warning(f"Listener {task} stopped.")
-                            # Decide how to handle listener stopping, maybe terminate?
-                            await message_queue.put({"type": "error", "data": "Listener stopped unexpectedly"})
-                            return
-                        except Exception as e:
-                            logger.error(f"Error in listener for {agent_run_id}: {e}")
-                            await message_queue.put({"type": "error", "data": "Listener failed"})
-                            return
-                        finally:
-                            # Reschedule the completed listener task
-                            if task in tasks:
-                                tasks.remove(task)
-                                if message and isinstance(message, dict) and message.get("channel") == response_channel:
-                                     tasks.append(asyncio.create_task(response_reader.__anext__()))
-                                elif message and isinstance(message, dict) and message.get("channel") == control_channel:
-                                     tasks.append(asyncio.create_task(control_reader.__anext__()))
-
-                # Cancel pending listener tasks on exit
-                for p_task in pending: p_task.cancel()
-                for task in tasks: task.cancel()
-
-
-            listener_task = asyncio.create_task(listen_messages())
-
-            # 4. Main loop to process messages from the queue
+            # 3. Main loop to process the notifications dispatched by the stream hub
             while not terminate_stream:
                 try:
-                    queue_item = await message_queue.get()
+                    event = await subscription.get(timeout=config.RESPONSE_STREAM_BLOCK_MS / 1000)
+                    if event is None:
+                        # Nothing new: make sure the run did not end without a control signal (e.g. a crashed worker)
+                        run_data = await get_run_status()
+                        if run_data.get('status') != 'running':
+                            logger.info(f"Agent run {agent_run_id} ended without a control signal (status: {run_data.get('status')}). Ending stream.")
+                            remaining_responses_json = await redis.lrange(response_list_key, last_processed_index + 1, -1)
+                            if remaining_responses_json:
+                                yield "".join(f"data: {response_json}\n\n" for response_json in remaining_responses_json)
+                            yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
+                            terminate_stream = True
+                            break
+                        continue
+                    event_type, event_data = event
 
-                    if queue_item["type"] == "new_response":
+                    if event_type == "new_response":
                         # Fetch new responses from Redis list starting after the last processed index
                         new_start_index = last_processed_index + 1
                         new_responses_json = await redis.lrange(response_list_key, new_start_index, -1)
 
                         if new_responses_json:
-                            new_responses = [json.loads(r) for r in new_responses_json]
-                            num_new = len(new_responses)
-                            # logger.debug(f"Received {num_new} new responses for {agent_run_id} (index {new_start_index} onwards)")
-                            for response in new_responses:
-                                yield f"data: {json.dumps(response)}\n\n"
+                            events = []
+                            for response_json in new_responses_json:
+                                events.append(f"data: {response_json}\n\n")
                                 # Check if this response signals completion
-                                if response.get('type') == 'status' and response.get('status') in ['completed', 'failed', 'stopped']:
-                                    logger.info(f"Detected run completion via status message in stream: {response.get('status')}")
+                                terminal_status = response_stream.terminal_status(response_json)
+                                if terminal_status:
+                                    logger.info(f"Detected run completion via status message in stream: {terminal_status}")
                                     terminate_stream = True
                                     break # Stop processing further new responses
-                            last_processed_index += num_new
+                            last_processed_index += len(new_responses_json)
+                            yield "".join(events)
                         if terminate_stream: break
 
-                    elif queue_item["type"] == "control":
-                        control_signal = queue_item["data"]
+                    elif event_type == "control":
+                        logger.info(f"Received control signal '{event_data}' for {agent_run_id}")
                         terminate_stream = True # Stop the stream on any control signal
-                        yield f"data: {json.dumps({'type': 'status', 'status': control_signal})}\n\n"
+                        yield f"data: {json.dumps({'type': 'status', 'status': event_data})}\n\n"
                         break
 
-                    elif queue_item["type"] == "error":
-                        logger.error(f"Listener error for {agent_run_id}: {queue_item['data']}")
+                    elif event_type == "evicted":
+                        logger.error(f"Stream subscriber of {agent_run_id} was evicted")
                         terminate_stream = True
                         yield f"data: {json.dumps({'type': 'status', 'status': 'error'})}\n\n"
                         break
@@ -758,29 +824,21 @@ async def stream_agent_run(
                  yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Failed to start stream: {e}'})}\n\n"
         finally:
             terminate_stream = True
-            # Graceful shutdown order: unsubscribe → close → cancel
-            if pubsub_response: await pubsub_response.unsubscribe(response_channel)
-            if pubsub_control: await pubsub_control.unsubscribe(control_channel)
-            if pubsub_response: await pubsub_response.close()
-            if pubsub_control: await pubsub_control.close()
-
-            if listener_task:
-                listener_task.cancel()
-                try:
-                    await listener_task  # Reap inner tasks & swallow their errors
-                except asyncio.CancelledError:
-                    pass
-                except Exception as e:
-                    logger.debug(f"listener_task ended with: {e}")
-            # Wait briefly for tasks to cancel
-            await asyncio.sleep(0.1)
+            subscription.close()
             logger.debug(f"Streaming cleanup complete for agent run: {agent_run_id}")
 
-    return StreamingResponse(stream_generator(), media_type="text/event-stream", headers={
+    sse_headers = {
         "Cache-Control": "no-cache, no-transform", "Connection": "keep-alive",
         "X-Accel-Buffering": "no", "Content-Type": "text/event-stream",
         "Access-Control-Allow-Origin": "*"
-    })
+    }
+
+    if await response_stream.uses_streams(agent_run_id):
+        resume_id = response_stream.parse_last_event_id(request.headers.get("last-event-id") if request else None)
+        resume_id = resume_id or response_stream.parse_last_event_id(last_event_id)
+        return StreamingResponse(stream_entries_generator(resume_id), media_type="text/event-stream", headers=sse_headers)
+
+    return StreamingResponse(stream_generator(), media_type="text/event-stream", headers=sse_headers)
 
 async def generate_and_update_project_name(project_id: str, prompt: str):
     """Generates a project name using an LLM and updates the database."""
@@ -1157,11 +1215,10 @@ async def initiate_agent_with_files(
         )
 
         # Register run in Redis
-        instance_key = f"active_run:{instance_id}:{agent_run_id}"
         try:
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_registry.register_run(instance_id, agent_run_id)
         except Exception as e:
-            logger.warning(f"Failed to register agent run in Redis ({instance_key}): {str(e)}")
+            logger.warning(f"Failed to register agent run {agent_run_id} for instance {instance_id} in Redis: {str(e)}")
 
         request_id = structlog.contextvars.get_contextvars().get('request_id')
 
@@ -1176,6 +1233,7 @@ async def initiate_agent_with_files(
             is_agent_builder=is_agent_builder,
             target_agent_id=target_agent_id,
             request_id=request_id,
+            account_id=account_id,
         )
 
         return {"thread_id": thread_id, "agent_run_id": agent_run_id}
@@ -1873,6 +1931,7 @@ async def update_agent(
                 created_by=version_data.get('created_by')
             )
         
+        await invalidate_agent_bootstrap(agent_id)
         logger.info(f"Updated agent {agent_id} for user: {user_id}")
         
         return AgentResponse(
@@ -1931,6 +1990,7 @@ async def delete_agent(agent_id: str, user_id: str = Depends(get_current_user_id
         
         # Delete the agent
         await client.table('agents').delete().eq('agent_id', agent_id).execute()
+        await invalidate_agent_bootstrap(agent_id)
         
         logger.info(f"Successfully deleted agent: {agent_id}")
         return {"message": "Agent deleted successfully"}
@@ -1985,11 +2045,15 @@ async def get_agent_builder_chat_history(
         logger.info(f"Found {len(agent_builder_threads)} agent builder threads, using latest: {latest_thread_id}")
         
         # Get messages from the latest thread, excluding status and summary messages
-        messages_result = await client.table('messages').select('*').eq('thread_id', latest_thread_id).neq('type', 'status').neq('type', 'summary').order('created_at', desc=False).execute()
+        messages = []
+        async for page in keyset_pages(
+            lambda: client.table('messages').select('*').eq('thread_id', latest_thread_id).neq('type', 'status').neq('type', 'summary')
+        ):
+            messages.extend(page)
         
-        logger.info(f"Found {len(messages_result.data)} messages for agent builder chat history")
+        logger.info(f"Found {len(messages)} messages for agent builder chat history")
         return {
-            "messages": messages_result.data,
+            "messages": messages,
             "thread_id": latest_thread_id
         }
         
@@ -2081,6 +2145,7 @@ async def create_agent_version(
         "current_version_id": version['version_id'],
         "version_count": next_version_number
     }).eq("agent_id", agent_id).execute()
+    await invalidate_agent_bootstrap(agent_id)
     
     logger.info(f"Created version v{next_version_number} for agent {agent_id}")
     
@@ -2109,6 +2174,7 @@ async def activate_agent_version(
     await client.table('agents').update({
         "current_version_id": version_id
     }).eq("agent_id", agent_id).execute()
+    await invalidate_agent_bootstrap(agent_id)
     
     return {"message": "Version activated successfully"}
 
@@ -2301,6 +2367,7 @@ async def update_pipedream_tools_for_agent(
         
         if not update_result.data:
             raise HTTPException(status_code=500, detail="Failed to update agent")
+        await invalidate_agent_bootstrap(agent_id)
         
         logger.info(f"Successfully updated {len(enabled_tools)} tools for agent {agent_id}")
         
@@ -2448,6 +2515,7 @@ async def update_custom_mcp_tools_for_agent(
         
         if not update_result.data:
             raise HTTPException(status_code=500, detail="Failed to update agent")
+        await invalidate_agent_bootstrap(agent_id)
         
         logger.info(f"Successfully updated {len(enabled_tools)} custom MCP tools for agent {agent_id}")
         
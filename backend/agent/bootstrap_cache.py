@@ -0,0 +1,169 @@
+"""
+Warm bootstrap cache for agent runs.
+
+Every call to run_agent repeats the same setup before its first LLM call:
+resolving Pipedream credential profiles, deciding which tools to register,
+connecting to every MCP server to list its tools and rendering the MCP
+section of the system prompt. None of this changes between runs of the same
+agent version on the same project, so the results are kept in an in-process
+cache keyed by (agent_id, version_id, project_id).
+
+The project row is not cached: it holds the sandbox and its credentials,
+which change whenever the sandbox is recreated, so every run reads it.
+
+Entries expire after AGENT_BOOTSTRAP_CACHE_TTL seconds and are dropped when:
+- The agent config they were built from changes (checked with a fingerprint)
+- invalidate_agent_bootstrap() bumps the agent's generation counter in Redis,
+  which the API does whenever an agent, its versions or its MCP credentials
+  are updated, so every worker process sees the invalidation
+"""
+
+import copy
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+
+GENERATION_KEY_PREFIX = "agent_bootstrap_generation"
+
+BootstrapKey = Tuple[Optional[str], Optional[str], str]
+
+
+@dataclass
+class AgentBootstrap:
+    """Setup results shared by the runs of one agent version on one project.
+
+    Attributes:
+        fingerprint: Hash of the agent config the entry was built from
+        generation: Invalidation generation of the agent when the entry was built
+        expires_at: time.monotonic() deadline of the entry
+        tool_blueprint: Names of the agentpress tools to register
+        mcp_configs: MCP server configs with Pipedream profiles resolved
+        mcp_listings: Tool listings of the MCP servers, see MCPToolWrapper.export_tool_listings
+        mcp_prompt: The MCP tools section of the system prompt
+    """
+    fingerprint: str
+    generation: int
+    expires_at: float
+    tool_blueprint: Optional[List[str]] = None
+    mcp_configs: Optional[List[Dict[str, Any]]] = None
+    mcp_listings: Optional[Dict[str, Any]] = None
+    mcp_prompt: Optional[str] = None
+
+
+def bootstrap_fingerprint(agent_config: Optional[Dict[str, Any]], is_agent_builder: bool = False) -> str:
+    """Hash the parts of an agent config that the bootstrap depends on."""
+    agent_config = agent_config or {}
+    payload = json.dumps({
+        'agentpress_tools': agent_config.get('agentpress_tools'),
+        'configured_mcps': agent_config.get('configured_mcps'),
+        'custom_mcps': agent_config.get('custom_mcps'),
+        'is_agent_builder': is_agent_builder,
+    }, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class AgentBootstrapCache:
+    """In-process LRU of AgentBootstrap entries with TTLs."""
+
+    def __init__(self, ttl: Optional[int] = None, max_entries: Optional[int] = None):
+        """Initialize the cache.
+
+        Args:
+            ttl: Lifetime of an entry in seconds, 0 disables the cache
+            max_entries: Maximum number of cached entries
+        """
+        self.ttl = ttl if ttl is not None else config.AGENT_BOOTSTRAP_CACHE_TTL
+        self.max_entries = max_entries if max_entries is not None else config.AGENT_BOOTSTRAP_CACHE_MAX_ENTRIES
+        self._entries: "OrderedDict[BootstrapKey, AgentBootstrap]" = OrderedDict()
+
+    @staticmethod
+    def key(agent_id: Optional[str], version_id: Optional[str], project_id: str) -> BootstrapKey:
+        return (agent_id, version_id, project_id)
+
+    async def _get_generation(self, agent_id: Optional[str]) -> int:
+        if not agent_id:
+            return 0
+        try:
+            return int(await redis.get(f"{GENERATION_KEY_PREFIX}:{agent_id}", 0))
+        except Exception as e:
+            logger.warning(f"Failed to read bootstrap generation for agent {agent_id}: {str(e)}")
+            return -1
+
+    async def get(self, key: BootstrapKey, fingerprint: str) -> AgentBootstrap:
+        """Get the entry for a key, or a new empty entry to be filled by the caller.
+
+        The returned entry is a copy; pass it to put() to store what was filled in.
+        """
+        generation = await self._get_generation(key[0])
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            if entry.fingerprint == fingerprint and entry.generation == generation and generation >= 0 and entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                logger.debug(f"Agent bootstrap cache hit for {key}")
+                return copy.deepcopy(entry)
+            del self._entries[key]
+
+        return AgentBootstrap(fingerprint=fingerprint, generation=generation, expires_at=time.monotonic() + self.ttl)
+
+    def put(self, key: BootstrapKey, entry: AgentBootstrap):
+        """Store an entry until its original deadline."""
+        if not self.ttl or entry.generation < 0:
+            return
+        self._entries[key] = copy.deepcopy(entry)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_local(self, agent_id: Optional[str] = None):
+        """Drop the entries of an agent, or all entries, from this process."""
+        if agent_id is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == agent_id]:
+            del self._entries[key]
+
+
+async def invalidate_agent_bootstrap(agent_id: str):
+    """Invalidate the bootstrap entries of an agent in every worker process."""
+    try:
+        await redis.incr(f"{GENERATION_KEY_PREFIX}:{agent_id}")
+    except Exception as e:
+        logger.error(f"Failed to invalidate bootstrap cache for agent {agent_id}: {str(e)}")
+    get_bootstrap_cache().invalidate_local(agent_id)
+
+
+class SetupTimer:
+    """Records the durations of the consecutive setup phases of an agent run."""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.started_at = time.perf_counter()
+        self._last_mark = self.started_at
+
+    def mark(self, phase: str):
+        """Record the time since the previous mark as the duration of a phase, in ms."""
+        now = time.perf_counter()
+        self.timings[phase] = round((now - self._last_mark) * 1000, 1)
+        self._last_mark = now
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started_at) * 1000, 1)
+
+
+_bootstrap_cache: Optional[AgentBootstrapCache] = None
+
+
+def get_bootstrap_cache() -> AgentBootstrapCache:
+    """Get the process-wide AgentBootstrapCache instance."""
+    global _bootstrap_cache
+    if _bootstrap_cache is None:
+        _bootstrap_cache = AgentBootstrapCache()
+    return _bootstrap_cache
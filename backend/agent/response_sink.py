@@ -0,0 +1,199 @@
+"""
+Coalescing Redis sink for the responses of an agent run.
+
+Publishing every streamed chunk with its own RPUSH and PUBLISH tasks costs two
+Redis commands per token and keeps a task object alive per command for the
+whole run. The ResponseSink buffers serialized responses for at most
+flush_interval_ms (or until batch_size are pending) and writes each batch as
+one MULTI/EXEC pipeline:
+
+- List transport: a single RPUSH of every value plus one PUBLISH "new"
+- Stream transport: one XADD per response plus one PUBLISH "new", sent in
+  the same round trip
+
+Batches are written one at a time in the order responses were put, so the
+stored order matches the order in which the agent produced them. put() blocks
+while max_pending responses are waiting, which bounds memory when Redis falls
+behind the model.
+
+The queue depth, pipeline durations and batch sizes are exported as
+Prometheus metrics while the run is live; SinkMetrics summarizes them per run.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+from utils.metrics import (
+    REDIS_OP_SECONDS,
+    RESPONSE_SINK_BATCH_SIZE,
+    RESPONSE_SINK_FLUSH_SECONDS,
+    RESPONSE_SINK_QUEUE_DEPTH,
+)
+
+from . import response_stream
+
+
+@dataclass
+class SinkMetrics:
+    """Counters of a ResponseSink.
+
+    Attributes:
+        responses: Responses put into the sink
+        flushes: Pipelines sent to Redis
+        failed_responses: Responses dropped after their pipeline failed twice
+        queue_depth: Responses currently waiting to be flushed
+        max_queue_depth: Highest queue depth seen
+        backpressure_waits: Times put() waited for a flush because the queue was full
+        last_flush_ms: Duration of the latest pipeline
+        max_flush_ms: Duration of the slowest pipeline
+        total_flush_ms: Summed duration of all pipelines
+    """
+    responses: int = 0
+    flushes: int = 0
+    failed_responses: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    backpressure_waits: int = 0
+    last_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_flush_ms: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data['avg_flush_ms'] = round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0
+        data['responses_per_flush'] = round(self.responses / self.flushes, 2) if self.flushes else 0.0
+        return data
+
+
+class ResponseSink:
+    """Batches the Redis writes of the responses of one agent run."""
+
+    def __init__(
+        self,
+        agent_run_id: str,
+        use_streams: bool,
+        batch_size: Optional[int] = None,
+        flush_interval_ms: Optional[int] = None,
+        max_pending: Optional[int] = None,
+    ):
+        """Initialize the sink.
+
+        Args:
+            agent_run_id: The run whose responses are written
+            use_streams: Whether the run uses the Redis Streams transport
+            batch_size: Number of pending responses that triggers an immediate flush
+            flush_interval_ms: Maximum time a response waits before being flushed
+            max_pending: Number of pending responses at which put() waits for a flush
+        """
+        self.agent_run_id = agent_run_id
+        self.use_streams = use_streams
+        self.batch_size = batch_size or config.RESPONSE_SINK_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else config.RESPONSE_SINK_FLUSH_INTERVAL_MS) / 1000
+        self.max_pending = max(max_pending or config.RESPONSE_SINK_MAX_PENDING, self.batch_size)
+        self.metrics = SinkMetrics()
+        self._pending: List[Tuple[str, Optional[str]]] = []
+        self._write_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def put(self, response_json: str, status: Optional[str] = None):
+        """Queue a serialized response for writing.
+
+        Args:
+            response_json: The JSON-encoded response
+            status: The status of the response if it is a status message
+        """
+        if len(self._pending) >= self.max_pending:
+            self.metrics.backpressure_waits += 1
+            await self._write_pending()
+
+        self._pending.append((response_json, status))
+        RESPONSE_SINK_QUEUE_DEPTH.inc()
+        self.metrics.responses += 1
+        self.metrics.queue_depth = len(self._pending)
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.metrics.queue_depth)
+
+        if len(self._pending) >= self.batch_size and (self._flusher is None or self._flusher.done()):
+            self._flusher = self._spawn(self._write_pending())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._write_after(self.flush_interval))
+
+    async def _write_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # Responses put from here on open a new window instead of trickling into this write
+        self._timer = None
+        await self._write_pending()
+
+    async def _write_pending(self):
+        # The lock is FIFO, so batches are written in the order responses were put
+        async with self._write_lock:
+            pending, self._pending = self._pending, []
+            RESPONSE_SINK_QUEUE_DEPTH.dec(len(pending))
+            self.metrics.queue_depth = 0
+            for start in range(0, len(pending), self.batch_size):
+                await self._write(pending[start:start + self.batch_size])
+
+    async def _send(self, batch: List[Tuple[str, Optional[str]]]):
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if self.use_streams:
+                stream_key = response_stream.response_stream_key(self.agent_run_id)
+                for response_json, status in batch:
+                    pipe.xadd(stream_key, response_stream.entry_fields(response_json, status), maxlen=config.RESPONSE_STREAM_MAXLEN, approximate=True)
+            else:
+                pipe.rpush(response_stream.response_list_key(self.agent_run_id), *[response_json for response_json, _ in batch])
+            # One notification per batch wakes up the stream hub subscribers of the run
+            pipe.publish(response_stream.response_channel(self.agent_run_id), "new")
+            await pipe.execute()
+
+    async def _write(self, batch: List[Tuple[str, Optional[str]]]):
+        started = time.perf_counter()
+        try:
+            try:
+                await self._send(batch)
+            except Exception as e:
+                logger.warning(f"Failed to write {len(batch)} responses for agent run {self.agent_run_id}, retrying: {str(e)}")
+                await self._send(batch)
+        except Exception as e:
+            logger.error(f"Dropped {len(batch)} responses for agent run {self.agent_run_id}: {str(e)}")
+            self.metrics.failed_responses += len(batch)
+        finally:
+            elapsed = time.perf_counter() - started
+            transport = "stream" if self.use_streams else "list"
+            REDIS_OP_SECONDS.labels(op="response_sink_pipeline").observe(elapsed)
+            RESPONSE_SINK_FLUSH_SECONDS.labels(transport=transport).observe(elapsed)
+            RESPONSE_SINK_BATCH_SIZE.labels(transport=transport).observe(len(batch))
+            elapsed_ms = round(elapsed * 1000, 2)
+            self.metrics.flushes += 1
+            self.metrics.last_flush_ms = elapsed_ms
+            self.metrics.max_flush_ms = max(self.metrics.max_flush_ms, elapsed_ms)
+            self.metrics.total_flush_ms += elapsed_ms
+
+    async def flush(self):
+        """Wait until every response put so far is written."""
+        await self._write_pending()
+
+    async def close(self, timeout: float = 30.0):
+        """Flush the remaining responses and stop the flush timer."""
+        try:
+            await asyncio.wait_for(self._write_pending(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timeout flushing responses for agent run {self.agent_run_id}")
+        for task in list(self._tasks):
+            task.cancel()
+        if self._pending:
+            # Never written; keep them out of the queue depth of the live runs
+            RESPONSE_SINK_QUEUE_DEPTH.dec(len(self._pending))
+            self._pending = []
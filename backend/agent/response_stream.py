@@ -0,0 +1,165 @@
+"""
+Response transport for agent runs.
+
+Runs have historically published each response with an RPUSH onto
+agent_run:{id}:responses followed by a PUBLISH of "new" on
+agent_run:{id}:new_response, which every streaming client answered with an
+LRANGE from its last index. Behind the `redis_streams_transport` flag, runs
+instead append each response to the Redis Stream agent_run:{id}:stream:
+
+- XADD carries the response itself, and a single notification per written
+  batch wakes up readers (see agent/stream_hub.py)
+- Clients XREAD from their last entry ID and receive every pending entry in
+  one round trip, without re-parsing the responses
+- Entry IDs are sent as SSE event IDs, so reconnecting clients resume from
+  their Last-Event-ID instead of replaying the whole run
+
+Stream entries have a `data` field holding the JSON response, plus `end` when
+the response is a terminal status, or only a `control` field for the
+STOP / END_STREAM / ERROR signals that end a stream. Control entries are
+appended before the signal is published on the run's control channel.
+
+The transport of a run is fixed by whichever key exists, so flipping the flag
+does not affect runs that are already streaming.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from agentpress.utils.json_helpers import dumps, loads
+from flags.flags import is_enabled
+from services import redis
+from utils.config import config
+
+STREAM_TRANSPORT_FLAG = "redis_streams_transport"
+
+TERMINAL_STATUSES = ('completed', 'failed', 'stopped')
+
+_ENTRY_ID_PATTERN = re.compile(r"^\d+-\d+$")
+
+StreamEntry = Tuple[str, Dict[str, str]]
+
+
+def response_list_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:responses"
+
+
+def response_stream_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:stream"
+
+
+def response_channel(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:new_response"
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[str]:
+    """Validate a Last-Event-ID sent by a client, returning None if it is not a stream entry ID."""
+    if value and _ENTRY_ID_PATTERN.match(value.strip()):
+        return value.strip()
+    return None
+
+
+async def uses_streams(agent_run_id: str) -> bool:
+    """Whether the responses of a run go through a Redis Stream rather than a list."""
+    if await redis.exists(response_stream_key(agent_run_id)):
+        return True
+    if await redis.exists(response_list_key(agent_run_id)):
+        return False
+    return await is_enabled(STREAM_TRANSPORT_FLAG)
+
+
+def entry_fields(response_json: str, status: Optional[str] = None) -> Dict[str, str]:
+    """Build the fields of the stream entry of a serialized response."""
+    fields = {'data': response_json}
+    if status in TERMINAL_STATUSES:
+        fields['end'] = status
+    return fields
+
+
+async def append_response(agent_run_id: str, response_json: str, status: Optional[str] = None) -> str:
+    """Append a serialized response to the stream of a run, returning its entry ID.
+
+    Args:
+        agent_run_id: The run the response belongs to
+        response_json: The JSON-encoded response
+        status: The status of the response if it is a terminal status message
+    """
+    return await redis.xadd(response_stream_key(agent_run_id), entry_fields(response_json, status), maxlen=config.RESPONSE_STREAM_MAXLEN)
+
+
+async def append_control(agent_run_id: str, signal: str) -> str:
+    """Append a control signal that ends the stream for every reader."""
+    return await redis.xadd(response_stream_key(agent_run_id), {'control': signal}, maxlen=config.RESPONSE_STREAM_MAXLEN)
+
+
+async def read_entries(agent_run_id: str, last_id: str, block_ms: Optional[int] = None) -> List[StreamEntry]:
+    """Read the entries after last_id, waiting up to block_ms for new ones if there are none."""
+    result = await redis.xread(
+        {response_stream_key(agent_run_id): last_id},
+        count=config.RESPONSE_STREAM_READ_COUNT,
+        block=block_ms,
+    )
+    if not result:
+        return []
+    return result[0][1]
+
+
+def terminal_status(response_json: str) -> Optional[str]:
+    """Get the status of a serialized response if it ends the run.
+
+    Only responses that can be status messages are decoded; inside the JSON
+    strings of chunk payloads every quote is escaped, so a bare "status" key
+    appears only in actual status fields.
+    """
+    if '"status"' not in response_json:
+        return None
+    response = loads(response_json)
+    if response.get('type') == 'status' and response.get('status') in TERMINAL_STATUSES:
+        return response['status']
+    return None
+
+
+def format_sse(entries: List[StreamEntry]) -> Tuple[str, str, bool]:
+    """Render stream entries as SSE events without decoding their payloads.
+
+    Returns:
+        The SSE text, the ID of the last rendered entry and whether an entry
+        ended the stream. Entries after the one that ends the stream are
+        not rendered.
+    """
+    events = []
+    last_id = None
+    ended = False
+    for entry_id, fields in entries:
+        last_id = entry_id
+        if 'control' in fields:
+            data = dumps({'type': 'status', 'status': fields['control']})
+            ended = True
+        else:
+            data = fields.get('data', '{}')
+            ended = 'end' in fields
+        events.append(f"id: {entry_id}\ndata: {data}\n\n")
+        if ended:
+            break
+    return "".join(events), last_id, ended
+
+
+async def get_all_responses(agent_run_id: str) -> List[Dict[str, Any]]:
+    """Get every response of a run from whichever transport it uses."""
+    entries = await redis.xrange(response_stream_key(agent_run_id))
+    if entries:
+        return [loads(fields['data']) for _, fields in entries if 'data' in fields]
+    responses_json = await redis.lrange(response_list_key(agent_run_id), 0, -1)
+    return [loads(r) for r in responses_json]
+
+
+async def expire_responses(agent_run_id: str, ttl: int):
+    """Set a TTL on the stored responses of a run."""
+    await redis.expire(response_list_key(agent_run_id), ttl)
+    await redis.expire(response_stream_key(agent_run_id), ttl)
+
+
+async def delete_responses(agent_run_id: str):
+    """Delete the stored responses of a run."""
+    await redis.delete(response_list_key(agent_run_id))
+    await redis.delete(response_stream_key(agent_run_id))
@@ -1,7 +1,7 @@
 import os
 import json
 import asyncio
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 # from agent.tools.message_tool import MessageTool
 from agent.tools.message_tool import MessageTool
@@ -13,6 +13,7 @@ from utils.config import config
 from flags.flags import is_enabled
 from agent.agent_builder_prompt import get_agent_builder_prompt
 from agentpress.thread_manager import ThreadManager
+from agentpress.thread_state import ThreadStateTracker, record_message
 from agentpress.response_processor import ProcessorConfig
 from agent.tools.sb_shell_tool import SandboxShellTool
 from agent.tools.sb_files_tool import SandboxFilesTool
@@ -21,7 +22,6 @@ from agent.tools.data_providers_tool import DataProvidersTool
 from agent.tools.expand_msg_tool import ExpandMessageTool
 from agent.prompt import get_system_prompt
 from utils.logger import logger
-from utils.auth_utils import get_account_id_from_thread
 from services.billing import check_billing_status
 from agent.tools.sb_vision_tool import SandboxVisionTool
 from agent.tools.sb_image_edit_tool import SandboxImageEditTool
@@ -32,11 +32,114 @@ from agent.gemini_prompt import get_gemini_system_prompt
 from agent.tools.mcp_tool_wrapper import MCPToolWrapper
 from agentpress.tool import SchemaType
 from services.llm import LLMError, LLMRetryError, LLMContextOverflowError
+from agent.bootstrap_cache import get_bootstrap_cache, bootstrap_fingerprint, SetupTimer
+from utils.metrics import AGENT_SETUP_PHASE_SECONDS
 from datetime import datetime, timezone
+from functools import lru_cache
 import uuid
 
 load_dotenv()
 
+# Agentpress tools available to agent runs: name -> (tool class, run-scoped constructor arguments)
+AGENT_TOOLS = {
+    'sb_shell_tool': (SandboxShellTool, ('project_id', 'thread_manager')),
+    'sb_files_tool': (SandboxFilesTool, ('project_id', 'thread_manager')),
+    'sb_browser_tool': (SandboxBrowserTool, ('project_id', 'thread_id', 'thread_manager')),
+    'sb_deploy_tool': (SandboxDeployTool, ('project_id', 'thread_manager')),
+    'sb_expose_tool': (SandboxExposeTool, ('project_id', 'thread_manager')),
+    'expand_msg_tool': (ExpandMessageTool, ('thread_id', 'thread_manager')),
+    'message_tool': (MessageTool, ()),
+    'web_search_tool': (SandboxWebSearchTool, ('project_id', 'thread_manager')),
+    'sb_vision_tool': (SandboxVisionTool, ('project_id', 'thread_id', 'thread_manager')),
+    'sb_image_edit_tool': (SandboxImageEditTool, ('project_id', 'thread_id', 'thread_manager')),
+    'data_providers_tool': (DataProvidersTool, ()),
+}
+
+
+def build_tool_blueprint(enabled_tools: Optional[Dict[str, Any]]) -> List[str]:
+    """Get the names of the agentpress tools to register, in registration order."""
+    if enabled_tools is None:
+        # No agent specified - all tools for full Suna capabilities
+        tool_names = [
+            'sb_shell_tool', 'sb_files_tool', 'sb_browser_tool', 'sb_deploy_tool', 'sb_expose_tool',
+            'expand_msg_tool', 'message_tool', 'web_search_tool', 'sb_vision_tool', 'sb_image_edit_tool'
+        ]
+        if config.RAPID_API_KEY:
+            tool_names.append('data_providers_tool')
+        return tool_names
+
+    tool_names = ['expand_msg_tool', 'message_tool']
+    for tool_name in ['sb_shell_tool', 'sb_files_tool', 'sb_browser_tool', 'sb_deploy_tool', 'sb_expose_tool', 'web_search_tool', 'sb_vision_tool']:
+        if enabled_tools.get(tool_name, {}).get('enabled', False):
+            tool_names.append(tool_name)
+    if config.RAPID_API_KEY and enabled_tools.get('data_providers_tool', {}).get('enabled', False):
+        tool_names.append('data_providers_tool')
+    return tool_names
+
+
+@lru_cache(maxsize=1)
+def get_sample_response() -> str:
+    sample_response_path = os.path.join(os.path.dirname(__file__), 'sample_responses/1.txt')
+    with open(sample_response_path, 'r') as file:
+        return file.read()
+
+
+async def resolve_mcp_configs(agent_config: Dict[str, Any], account_id: str) -> List[Dict[str, Any]]:
+    """Merge the configured and custom MCPs of an agent, resolving Pipedream profiles."""
+    all_mcps = []
+    
+    # Add standard configured MCPs
+    if agent_config.get('configured_mcps'):
+        all_mcps.extend(agent_config['configured_mcps'])
+    
+    # Add custom MCPs
+    if agent_config.get('custom_mcps'):
+        for custom_mcp in agent_config['custom_mcps']:
+            # Transform custom MCP to standard format
+            custom_type = custom_mcp.get('customType', custom_mcp.get('type', 'sse'))
+            
+            # For Pipedream MCPs, ensure we have the user ID and proper config
+            if custom_type == 'pipedream':
+                # Get user ID from thread
+                if 'config' not in custom_mcp:
+                    custom_mcp['config'] = {}
+                
+                # Get external_user_id from profile if not present
+                if not custom_mcp['config'].get('external_user_id'):
+                    profile_id = custom_mcp['config'].get('profile_id')
+                    if profile_id:
+                        try:
+                            from pipedream.profiles import get_profile_manager
+                            from services.supabase import DBConnection
+                            profile_db = DBConnection()
+                            profile_manager = get_profile_manager(profile_db)
+                            
+                            # Get the profile to retrieve external_user_id
+                            profile = await profile_manager.get_profile(account_id, profile_id)
+                            if profile:
+                                custom_mcp['config']['external_user_id'] = profile.external_user_id
+                                logger.info(f"Retrieved external_user_id from profile {profile_id} for Pipedream MCP")
+                            else:
+                                logger.error(f"Could not find profile {profile_id} for Pipedream MCP")
+                        except Exception as e:
+                            logger.error(f"Error retrieving external_user_id from profile {profile_id}: {e}")
+                
+                if 'headers' in custom_mcp['config'] and 'x-pd-app-slug' in custom_mcp['config']['headers']:
+                    custom_mcp['config']['app_slug'] = custom_mcp['config']['headers']['x-pd-app-slug']
+            
+            mcp_config = {
+                'name': custom_mcp['name'],
+                'qualifiedName': f"custom_{custom_type}_{custom_mcp['name'].replace(' ', '_').lower()}",
+                'config': custom_mcp['config'],
+                'enabledTools': custom_mcp.get('enabledTools', []),
+                'instructions': custom_mcp.get('instructions', ''),
+                'isCustom': True,
+                'customType': custom_type
+            }
+            all_mcps.append(mcp_config)
+    
+    return all_mcps
+
 async def run_agent(
     thread_id: str,
     project_id: str,
@@ -64,12 +167,27 @@ async def run_agent(
 
     client = await thread_manager.db.client
 
-    # Get account ID from thread for billing checks
-    account_id = await get_account_id_from_thread(client, thread_id)
+    # Setup results that don't change between runs of the same agent version are cached per worker
+    timer = SetupTimer()
+    bootstrap_cache = get_bootstrap_cache()
+    bootstrap_key = bootstrap_cache.key(
+        agent_config.get('agent_id') if agent_config else None,
+        agent_config.get('current_version_id') if agent_config else None,
+        project_id
+    )
+    bootstrap = await bootstrap_cache.get(bootstrap_key, bootstrap_fingerprint(agent_config, is_agent_builder or False))
+    bootstrap_hit = bootstrap.tool_blueprint is not None
+    timer.mark("bootstrap_cache")
+
+    # Get account ID from thread for billing checks, and hand the thread to the usage ledger
+    thread_result = await client.table('threads').select('thread_id, account_id, project_id, created_at').eq('thread_id', thread_id).limit(1).execute()
+    thread = thread_result.data[0] if thread_result.data else None
+    account_id = thread.get('account_id') if thread else None
     if not account_id:
         raise ValueError("Could not determine account ID for thread")
+    thread_manager.set_thread_billing_info(thread)
 
-    # Get sandbox info from project
+    # Get sandbox info from project. Not cached, the sandbox can be recreated at any time
     project = await client.table('projects').select('*').eq('project_id', project_id).execute()
     if not project.data or len(project.data) == 0:
         raise ValueError(f"Project {project_id} not found")
@@ -78,6 +196,7 @@ async def run_agent(
     sandbox_info = project_data.get('sandbox', {})
     if not sandbox_info.get('id'):
         raise ValueError(f"No sandbox found for project {project_id}")
+    timer.mark("project")
 
     # Initialize tools with project_id instead of sandbox object
     # This ensures each tool independently verifies it's operating on the correct project
@@ -105,94 +224,24 @@ async def run_agent(
 
     if enabled_tools is None:
         logger.info("No agent specified - registering all tools for full Suna capabilities")
-        thread_manager.add_tool(SandboxShellTool, project_id=project_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxFilesTool, project_id=project_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxBrowserTool, project_id=project_id, thread_id=thread_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxDeployTool, project_id=project_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxExposeTool, project_id=project_id, thread_manager=thread_manager)
-        thread_manager.add_tool(ExpandMessageTool, thread_id=thread_id, thread_manager=thread_manager)
-        thread_manager.add_tool(MessageTool)
-        thread_manager.add_tool(SandboxWebSearchTool, project_id=project_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxVisionTool, project_id=project_id, thread_id=thread_id, thread_manager=thread_manager)
-        thread_manager.add_tool(SandboxImageEditTool, project_id=project_id, thread_id=thread_id, thread_manager=thread_manager)
-        if config.RAPID_API_KEY:
-            thread_manager.add_tool(DataProvidersTool)
     else:
         logger.info("Custom agent specified - registering only enabled tools")
-        thread_manager.add_tool(ExpandMessageTool, thread_id=thread_id, thread_manager=thread_manager)
-        thread_manager.add_tool(MessageTool)
-        if enabled_tools.get('sb_shell_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxShellTool, project_id=project_id, thread_manager=thread_manager)
-        if enabled_tools.get('sb_files_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxFilesTool, project_id=project_id, thread_manager=thread_manager)
-        if enabled_tools.get('sb_browser_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxBrowserTool, project_id=project_id, thread_id=thread_id, thread_manager=thread_manager)
-        if enabled_tools.get('sb_deploy_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxDeployTool, project_id=project_id, thread_manager=thread_manager)
-        if enabled_tools.get('sb_expose_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxExposeTool, project_id=project_id, thread_manager=thread_manager)
-        if enabled_tools.get('web_search_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxWebSearchTool, project_id=project_id, thread_manager=thread_manager)
-        if enabled_tools.get('sb_vision_tool', {}).get('enabled', False):
-            thread_manager.add_tool(SandboxVisionTool, project_id=project_id, thread_id=thread_id, thread_manager=thread_manager)
-        if config.RAPID_API_KEY and enabled_tools.get('data_providers_tool', {}).get('enabled', False):
-            thread_manager.add_tool(DataProvidersTool)
+    if bootstrap.tool_blueprint is None:
+        bootstrap.tool_blueprint = build_tool_blueprint(enabled_tools)
+
+    run_arguments = {'project_id': project_id, 'thread_id': thread_id, 'thread_manager': thread_manager}
+    for tool_name in bootstrap.tool_blueprint:
+        tool_class, argument_names = AGENT_TOOLS[tool_name]
+        thread_manager.add_tool(tool_class, **{name: run_arguments[name] for name in argument_names})
+    timer.mark("tools")
 
     # Register MCP tool wrapper if agent has configured MCPs or custom MCPs
     mcp_wrapper_instance = None
     if agent_config:
         # Merge configured_mcps and custom_mcps
-        all_mcps = []
-        
-        # Add standard configured MCPs
-        if agent_config.get('configured_mcps'):
-            all_mcps.extend(agent_config['configured_mcps'])
-        
-        # Add custom MCPs
-        if agent_config.get('custom_mcps'):
-            for custom_mcp in agent_config['custom_mcps']:
-                # Transform custom MCP to standard format
-                custom_type = custom_mcp.get('customType', custom_mcp.get('type', 'sse'))
-                
-                # For Pipedream MCPs, ensure we have the user ID and proper config
-                if custom_type == 'pipedream':
-                    # Get user ID from thread
-                    if 'config' not in custom_mcp:
-                        custom_mcp['config'] = {}
-                    
-                    # Get external_user_id from profile if not present
-                    if not custom_mcp['config'].get('external_user_id'):
-                        profile_id = custom_mcp['config'].get('profile_id')
-                        if profile_id:
-                            try:
-                                from pipedream.profiles import get_profile_manager
-                                from services.supabase import DBConnection
-                                profile_db = DBConnection()
-                                profile_manager = get_profile_manager(profile_db)
-                                
-                                # Get the profile to retrieve external_user_id
-                                profile = await profile_manager.get_profile(account_id, profile_id)
-                                if profile:
-                                    custom_mcp['config']['external_user_id'] = profile.external_user_id
-                                    logger.info(f"Retrieved external_user_id from profile {profile_id} for Pipedream MCP")
-                                else:
-                                    logger.error(f"Could not find profile {profile_id} for Pipedream MCP")
-                            except Exception as e:
-                                logger.error(f"Error retrieving external_user_id from profile {profile_id}: {e}")
-                    
-                    if 'headers' in custom_mcp['config'] and 'x-pd-app-slug' in custom_mcp['config']['headers']:
-                        custom_mcp['config']['app_slug'] = custom_mcp['config']['headers']['x-pd-app-slug']
-                
-                mcp_config = {
-                    'name': custom_mcp['name'],
-                    'qualifiedName': f"custom_{custom_type}_{custom_mcp['name'].replace(' ', '_').lower()}",
-                    'config': custom_mcp['config'],
-                    'enabledTools': custom_mcp.get('enabledTools', []),
-                    'instructions': custom_mcp.get('instructions', ''),
-                    'isCustom': True,
-                    'customType': custom_type
-                }
-                all_mcps.append(mcp_config)
+        if bootstrap.mcp_configs is None:
+            bootstrap.mcp_configs = await resolve_mcp_configs(agent_config, account_id)
+        all_mcps = bootstrap.mcp_configs
         
         if all_mcps:
             logger.info(f"Registering MCP tool wrapper for {len(all_mcps)} MCP servers (including {len(agent_config.get('custom_mcps', []))} custom)")
@@ -205,18 +254,21 @@ async def run_agent(
             
             if mcp_wrapper_instance:
                 try:
-                    await mcp_wrapper_instance.initialize_and_register_tools()
-                    logger.info("MCP tools initialized successfully")
+                    if bootstrap.mcp_listings:
+                        await mcp_wrapper_instance.initialize_from_listings(bootstrap.mcp_listings)
+                        logger.info("MCP tools initialized from cached tool listings")
+                    else:
+                        await mcp_wrapper_instance.initialize_and_register_tools()
+                        logger.info("MCP tools initialized successfully")
+                        # Only complete listings are reused by later runs
+                        bootstrap.mcp_listings = mcp_wrapper_instance.export_tool_listings()
                     updated_schemas = mcp_wrapper_instance.get_schemas()
                     logger.info(f"MCP wrapper has {len(updated_schemas)} schemas available")
                     for method_name, schema_list in updated_schemas.items():
                         if method_name != 'call_mcp_tool':
                             for schema in schema_list:
                                 if schema.schema_type == SchemaType.OPENAPI:
-                                    thread_manager.tool_registry.tools[method_name] = {
-                                        "instance": mcp_wrapper_instance,
-                                        "schema": schema
-                                    }
+                                    thread_manager.tool_registry.register_function(method_name, mcp_wrapper_instance, schema)
                                     logger.info(f"Registered dynamic MCP tool: {method_name}")
                     
                     # Log all registered tools for debugging
@@ -228,6 +280,7 @@ async def run_agent(
                 except Exception as e:
                     logger.error(f"Failed to initialize MCP tools: {e}")
                     # Continue without MCP tools if initialization fails
+    timer.mark("mcp")
 
     # Prepare system prompt
     # First, get the default system prompt
@@ -239,9 +292,7 @@ async def run_agent(
         
     # Add sample response for non-anthropic models
     if "anthropic" not in model_name.lower():
-        sample_response_path = os.path.join(os.path.dirname(__file__), 'sample_responses/1.txt')
-        with open(sample_response_path, 'r') as file:
-            sample_response = file.read()
+        sample_response = get_sample_response()
         default_system_content = default_system_content + "\n\n <sample_assistant_response>" + sample_response + "</sample_assistant_response>"
     
     # Handle custom agent system prompt
@@ -259,6 +310,7 @@ async def run_agent(
         # Use just the default system prompt
         system_content = default_system_content
         logger.info("Using default system prompt only")
+    timer.mark("system_prompt")
     
     if await is_enabled("knowledge_base"):
         try:
@@ -282,9 +334,13 @@ async def run_agent(
                 
         except Exception as e:
             logger.error(f"Error retrieving knowledge base context for thread {thread_id}: {e}")
+    timer.mark("knowledge_base")
 
 
-    if agent_config and (agent_config.get('configured_mcps') or agent_config.get('custom_mcps')) and mcp_wrapper_instance and mcp_wrapper_instance._initialized:
+    has_mcp_tools = agent_config and (agent_config.get('configured_mcps') or agent_config.get('custom_mcps')) and mcp_wrapper_instance and mcp_wrapper_instance._initialized
+    if has_mcp_tools and bootstrap.mcp_prompt:
+        system_content += bootstrap.mcp_prompt
+    elif has_mcp_tools:
         mcp_info = "\n\n--- MCP Tools Available ---\n"
         mcp_info += "You have access to external MCP (Model Context Protocol) server tools.\n"
         mcp_info += "MCP tools can be called directly using their native function names in the standard function calling format:\n"
@@ -344,11 +400,22 @@ async def run_agent(
         mcp_info += "NEVER supplement MCP results with your training data or make assumptions beyond what the tools provide.\n"
         
         system_content += mcp_info
+        if bootstrap.mcp_listings:
+            bootstrap.mcp_prompt = mcp_info
     
     system_message = { "role": "system", "content": system_content }
+    timer.mark("mcp_prompt")
+
+    bootstrap_cache.put(bootstrap_key, bootstrap)
+    logger.info(f"Agent setup for thread {thread_id} took {timer.total_ms()}ms (bootstrap cache {'hit' if bootstrap_hit else 'miss'}): {timer.timings}")
+    for phase, duration_ms in timer.timings.items():
+        AGENT_SETUP_PHASE_SECONDS.labels(phase=phase, bootstrap_cache='hit' if bootstrap_hit else 'miss').observe(duration_ms / 1000)
+    if trace:
+        trace.event(name="agent_setup", level="DEFAULT", status_message=(f"Agent setup took {timer.total_ms()}ms"), metadata={"bootstrap_cache_hit": bootstrap_hit, "timings_ms": timer.timings})
 
     iteration_count = 0
     continue_execution = True
+    thread_state = ThreadStateTracker(client, thread_id)
 
     latest_user_message = await client.table('messages').select('*').eq('thread_id', thread_id).eq('type', 'user').order('created_at', desc=True).limit(1).execute()
     if latest_user_message.data and len(latest_user_message.data) > 0:
@@ -375,10 +442,10 @@ async def run_agent(
                 "message": error_msg
             }
             break
-        # Check if last message is from assistant using direct Supabase query
-        latest_message = await client.table('messages').select('*').eq('thread_id', thread_id).in_('type', ['assistant', 'tool', 'user']).order('created_at', desc=True).limit(1).execute()
-        if latest_message.data and len(latest_message.data) > 0:
-            message_type = latest_message.data[0].get('type')
+        # Check if last message is from assistant using the thread head (one round trip per iteration)
+        head = await thread_state.head()
+        if head.turn_type:
+            message_type = head.turn_type
             if message_type == 'assistant':
                 logger.info(f"Last message was from assistant, stopping execution")
                 if trace:
@@ -390,13 +457,10 @@ async def run_agent(
         temporary_message = None
         temp_message_content_list = [] # List to hold text/image blocks
 
-        # Get the latest browser_state message
-        latest_browser_state_msg = await client.table('messages').select('*').eq('thread_id', thread_id).eq('type', 'browser_state').order('created_at', desc=True).limit(1).execute()
-        if latest_browser_state_msg.data and len(latest_browser_state_msg.data) > 0:
+        # Get the latest browser_state message, fetched only when it changed since the last iteration
+        if head.browser_state_id:
             try:
-                browser_content = latest_browser_state_msg.data[0]["content"]
-                if isinstance(browser_content, str):
-                    browser_content = json.loads(browser_content)
+                browser_content = await thread_state.browser_state(head) or {}
                 screenshot_base64 = browser_content.get("screenshot_base64")
                 screenshot_url = browser_content.get("image_url")
                 
@@ -448,11 +512,10 @@ async def run_agent(
                 if trace:
                     trace.event(name="error_parsing_browser_state", level="ERROR", status_message=(f"{e}"))
 
-        # Get the latest image_context message (NEW)
-        latest_image_context_msg = await client.table('messages').select('*').eq('thread_id', thread_id).eq('type', 'image_context').order('created_at', desc=True).limit(1).execute()
-        if latest_image_context_msg.data and len(latest_image_context_msg.data) > 0:
+        # Get the latest image_context message, deleting it as it is read
+        if head.image_context_id:
             try:
-                image_context_content = latest_image_context_msg.data[0]["content"] if isinstance(latest_image_context_msg.data[0]["content"], dict) else json.loads(latest_image_context_msg.data[0]["content"])
+                image_context_content = await thread_state.take_image_context(head) or {}
                 base64_image = image_context_content.get("base64")
                 mime_type = image_context_content.get("mime_type")
                 file_path = image_context_content.get("file_path", "unknown file")
@@ -470,8 +533,6 @@ async def run_agent(
                     })
                 else:
                     logger.warning(f"Image context found for '{file_path}' but missing base64 or mime_type.")
-
-                await client.table('messages').delete().eq('message_id', latest_image_context_msg.data[0]["message_id"]).execute()
             except Exception as e:
                 logger.error(f"Error parsing image context: {e}")
                 if trace:
@@ -653,8 +714,9 @@ async def run_agent(
                     }
                     
                     # Store recovery message in thread
+                    recovery_message_id = str(uuid.uuid4())
                     await client.table('messages').insert({
-                        "message_id": str(uuid.uuid4()),
+                        "message_id": recovery_message_id,
                         "thread_id": thread_id,
                         "type": "user",
                         "is_llm_message": False,
@@ -663,6 +725,10 @@ async def run_agent(
                         "created_at": datetime.now(timezone.utc).isoformat(),
                         "updated_at": datetime.now(timezone.utc).isoformat()
                     }).execute()
+                    try:
+                        await record_message(thread_id, "user", recovery_message_id)
+                    except Exception as head_error:
+                        logger.warning(f"Failed to update thread head of {thread_id}: {str(head_error)}")
                     
                     logger.info(f"✅ Added context recovery message - continuing execution")
                     
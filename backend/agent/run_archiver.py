@@ -0,0 +1,139 @@
+"""
+Compacted archive of the responses of finished agent runs.
+
+A run streams one response per token chunk, so storing its responses
+verbatim in agent_runs means thousands of tiny JSON objects per run. The
+archiver merges consecutive content chunks of the same thread run into one
+chunk carrying the whole text, compresses the JSON array (zstd when the
+zstandard package is installed, zlib otherwise) and stores it base64 encoded
+in agent_runs.responses_archive with a single update.
+
+Archiving runs in the low-priority archive_agent_run actor once the run has
+finished, so it never delays the completion of the run itself. The stream
+endpoint replays archived runs whose Redis responses have expired.
+"""
+
+import base64
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from agentpress.utils.json_helpers import dumps, loads, safe_json_parse
+from utils.logger import logger
+
+from . import response_stream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def _chunk_run_id(response: Dict[str, Any]) -> Optional[str]:
+    """Get the thread_run_id of a streamed content chunk, or None if the response is not one."""
+    if response.get('type') != 'assistant' or response.get('message_id') is not None:
+        return None
+    metadata = safe_json_parse(response.get('metadata'), {})
+    if not isinstance(metadata, dict) or metadata.get('stream_status') != 'chunk':
+        return None
+    return metadata.get('thread_run_id') or ''
+
+
+def compact_responses(responses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge consecutive content chunks of the same thread run into single chunks.
+
+    The merged chunk keeps the fields of the first chunk, the updated_at of the
+    last one and the concatenated content, so replaying it renders the same text.
+    """
+    compacted: List[Dict[str, Any]] = []
+    merging_run_id: Optional[str] = None
+    merged_parts: List[str] = []
+
+    def close_merge():
+        if merged_parts:
+            compacted[-1]['content'] = dumps({"role": "assistant", "content": "".join(merged_parts)})
+            merged_parts.clear()
+
+    for response in responses:
+        run_id = _chunk_run_id(response)
+        content = safe_json_parse(response.get('content'), {}) if run_id is not None else None
+        if run_id is None or not isinstance(content, dict) or set(content) - {'role', 'content'}:
+            close_merge()
+            merging_run_id = None
+            compacted.append(response)
+            continue
+
+        if merging_run_id is not None and run_id == merging_run_id:
+            merged_parts.append(content.get('content') or '')
+            compacted[-1]['updated_at'] = response.get('updated_at', compacted[-1].get('updated_at'))
+            continue
+
+        close_merge()
+        merging_run_id = run_id
+        compacted.append(dict(response))
+        merged_parts.append(content.get('content') or '')
+
+    close_merge()
+    return compacted
+
+
+def encode_archive(responses: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """Compress a list of responses, returning the encoding and the base64 archive."""
+    raw = dumps(responses).encode('utf-8')
+    if zstandard is not None:
+        encoding, compressed = "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    else:
+        encoding, compressed = "zlib", zlib.compress(raw, ZLIB_LEVEL)
+    return encoding, base64.b64encode(compressed).decode('ascii')
+
+
+def decode_archive(encoding: str, archive: str) -> List[Dict[str, Any]]:
+    """Decompress an archive written by encode_archive."""
+    compressed = base64.b64decode(archive)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd response archives")
+        raw = zstandard.ZstdDecompressor().decompress(compressed)
+    elif encoding == "zlib":
+        raw = zlib.decompress(compressed)
+    else:
+        raise ValueError(f"Unknown response archive encoding: {encoding}")
+    return loads(raw)
+
+
+async def archive_run(client, agent_run_id: str) -> bool:
+    """Archive the responses of a finished run from Redis into agent_runs.
+
+    Returns:
+        True if an archive was written. Runs whose responses are no longer
+        in Redis are left untouched rather than overwritten with an empty archive.
+    """
+    responses = await response_stream.get_all_responses(agent_run_id)
+    if not responses:
+        logger.info(f"No responses in Redis to archive for agent run {agent_run_id}")
+        return False
+
+    compacted = compact_responses(responses)
+    encoding, archive = encode_archive(compacted)
+    await client.table('agent_runs').update({
+        'responses_archive': archive,
+        'responses_archive_encoding': encoding,
+    }).eq('id', agent_run_id).execute()
+
+    logger.info(f"Archived agent run {agent_run_id}: {len(responses)} responses compacted to {len(compacted)}, {len(archive)} bytes ({encoding})")
+    return True
+
+
+async def load_archived_responses(client, agent_run_id: str) -> List[Dict[str, Any]]:
+    """Load the archived responses of a run, or an empty list if it has no archive."""
+    result = await client.table('agent_runs').select('responses_archive, responses_archive_encoding').eq('id', agent_run_id).maybe_single().execute()
+    data = result.data if result else None
+    if not data or not data.get('responses_archive'):
+        return []
+    try:
+        return decode_archive(data.get('responses_archive_encoding') or "zlib", data['responses_archive'])
+    except Exception as e:
+        logger.error(f"Failed to decode response archive of agent run {agent_run_id}: {str(e)}")
+        return []
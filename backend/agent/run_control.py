@@ -0,0 +1,137 @@
+"""
+Stop signalling and liveness of a running agent run.
+
+The worker used to poll its control channels with get_message(timeout=0.5)
+plus a 0.1s sleep for the whole lifetime of every run, only noticing a STOP
+between two responses, and refreshed the registration of the run from the
+same loop. RunControl splits this into two idle tasks:
+
+- A listener blocked on the control channel subscription, which sets
+  `stop_requested` as soon as a STOP arrives
+- A heartbeat that extends the registration of the run in the active run
+  registry every ACTIVE_RUN_HEARTBEAT_INTERVAL seconds
+
+run_until_stopped() runs the agent loop as a task and cancels it when a STOP
+arrives, so the cancellation reaches whatever the run is awaiting (the LLM
+stream, a tool execution or a Redis write) instead of the next response.
+"""
+
+import asyncio
+from typing import Awaitable, Optional
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+from utils.retry import retry
+
+from . import run_registry
+
+
+class RunControl:
+    """Control channel listener and heartbeat of one agent run on one instance."""
+
+    def __init__(self, agent_run_id: str, instance_id: str):
+        self.agent_run_id = agent_run_id
+        self.instance_id = instance_id
+        self.stop_requested = asyncio.Event()
+        self.stop_reason: Optional[str] = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    @property
+    def control_channels(self):
+        return (
+            f"agent_run:{self.agent_run_id}:control:{self.instance_id}",
+            f"agent_run:{self.agent_run_id}:control",
+        )
+
+    async def start(self):
+        """Subscribe to the control channels and register the run as active."""
+        self._pubsub = await redis.create_pubsub()
+        try:
+            await retry(lambda: self._pubsub.subscribe(*self.control_channels))
+        except Exception as e:
+            logger.error(f"Redis failed to subscribe to control channels: {e}", exc_info=True)
+            raise e
+        logger.debug(f"Subscribed to control channels: {', '.join(self.control_channels)}")
+        self._listener = asyncio.create_task(self._listen())
+
+        # Register the run as active on this instance until the heartbeat stops
+        await run_registry.register_run(self.instance_id, self.agent_run_id, ttl=config.ACTIVE_RUN_HEARTBEAT_TTL)
+        self._heartbeat = asyncio.create_task(self._beat())
+
+    def request_stop(self, reason: str):
+        if not self.stop_requested.is_set():
+            self.stop_reason = reason
+            self.stop_requested.set()
+
+    async def _listen(self):
+        try:
+            async for message in self._pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = message.get("data")
+                if isinstance(data, bytes): data = data.decode('utf-8')
+                if data == "STOP":
+                    logger.info(f"Received STOP signal for agent run {self.agent_run_id} (Instance: {self.instance_id})")
+                    self.request_stop("stop_signal")
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in stop signal listener for {self.agent_run_id}: {e}", exc_info=True)
+            self.request_stop("listener_failed") # Stop the run if the listener fails
+
+    async def _beat(self):
+        # Keeps the registration alive while the run is running, however long it waits on the LLM or tools
+        while True:
+            await asyncio.sleep(config.ACTIVE_RUN_HEARTBEAT_INTERVAL)
+            try:
+                await run_registry.heartbeat(self.instance_id, self.agent_run_id, ttl=config.ACTIVE_RUN_HEARTBEAT_TTL)
+            except Exception as e:
+                logger.warning(f"Failed to heartbeat active run {self.agent_run_id}: {e}")
+
+    async def run_until_stopped(self, coro: Awaitable) -> bool:
+        """Run coro, cancelling it if a stop is requested first.
+
+        Returns:
+            True if the run was stopped. Exceptions raised by coro propagate.
+        """
+        task = asyncio.ensure_future(coro)
+        stop_waiter = asyncio.create_task(self.stop_requested.wait())
+        try:
+            await asyncio.wait({task, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Also reached when the caller itself is cancelled
+            stop_waiter.cancel()
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:
+                    logger.warning(f"Agent run {self.agent_run_id} raised while being cancelled: {e}")
+
+        if task.cancelled():
+            return True
+        task.result()
+        return False
+
+    async def close(self):
+        """Stop the listener and heartbeat and close the subscription."""
+        for task in (self._listener, self._heartbeat):
+            if task and not task.done():
+                task.cancel()
+                try: await task
+                except asyncio.CancelledError: pass
+                except Exception as e: logger.warning(f"Error during run control task cancellation: {e}")
+
+        if self._pubsub:
+            try:
+                await self._pubsub.unsubscribe()
+                await self._pubsub.close()
+                logger.debug(f"Closed pubsub connection for {self.agent_run_id}")
+            except Exception as e:
+                logger.warning(f"Error closing pubsub for {self.agent_run_id}: {str(e)}")
@@ -0,0 +1,86 @@
+"""
+Indexed registry of active agent runs.
+
+Runs used to be registered as active_run:{instance_id}:{agent_run_id} keys,
+so finding the runs of an instance or the instances of a run needed a KEYS
+scan over the whole keyspace. The registry instead keeps two sorted sets per
+entry, each scored by the entry's expiry timestamp:
+
+- active_runs:instance:{instance_id} holds the run ids of an instance
+- active_runs:run:{agent_run_id} holds the instance ids handling a run
+
+Entries are registered with a TTL and kept alive by heartbeats; lookups
+prune entries whose deadline has passed, so runs of dead instances expire on
+their own without a scan. Both lookups are O(log n + runs affected).
+"""
+
+import time
+from typing import List
+
+from services import redis
+from utils.logger import logger
+
+INSTANCE_KEY_PREFIX = "active_runs:instance"
+RUN_KEY_PREFIX = "active_runs:run"
+
+
+def _instance_key(instance_id: str) -> str:
+    return f"{INSTANCE_KEY_PREFIX}:{instance_id}"
+
+
+def _run_key(agent_run_id: str) -> str:
+    return f"{RUN_KEY_PREFIX}:{agent_run_id}"
+
+
+async def register_run(instance_id: str, agent_run_id: str, ttl: int = redis.REDIS_KEY_TTL):
+    """Register a run as active on an instance for ttl seconds.
+
+    Calling it again for the same pair acts as a heartbeat and extends the deadline.
+    """
+    deadline = time.time() + ttl
+    instance_key = _instance_key(instance_id)
+    run_key = _run_key(agent_run_id)
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zadd(instance_key, {agent_run_id: deadline})
+        pipe.zadd(run_key, {instance_id: deadline})
+        # Safety net for sets nobody reads anymore; entries expire by score
+        pipe.expire(instance_key, max(ttl, redis.REDIS_KEY_TTL))
+        pipe.expire(run_key, max(ttl, redis.REDIS_KEY_TTL))
+        await pipe.execute()
+
+
+async def heartbeat(instance_id: str, agent_run_id: str, ttl: int):
+    """Extend the deadline of a registered run."""
+    await register_run(instance_id, agent_run_id, ttl=ttl)
+
+
+async def unregister_run(instance_id: str, agent_run_id: str):
+    """Remove a run from an instance."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zrem(_instance_key(instance_id), agent_run_id)
+        pipe.zrem(_run_key(agent_run_id), instance_id)
+        await pipe.execute()
+
+
+async def _live_members(key: str) -> List[str]:
+    now = time.time()
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zrangebyscore(key, now, "+inf")
+        pruned, members = await pipe.execute()
+    if pruned:
+        logger.debug(f"Pruned {pruned} expired entries from {key}")
+    return members
+
+
+async def get_instance_runs(instance_id: str) -> List[str]:
+    """Get the ids of the runs active on an instance."""
+    return await _live_members(_instance_key(instance_id))
+
+
+async def get_run_instances(agent_run_id: str) -> List[str]:
+    """Get the ids of the instances handling a run."""
+    return await _live_members(_run_key(agent_run_id))
@@ -0,0 +1,187 @@
+"""
+Process-wide pub/sub fan-out for agent run streams.
+
+Every SSE client of /agent-run/{id}/stream used to open its own Redis pubsub
+connections for the run's new_response and control channels, so the number
+of Redis connections grew with the number of open browser tabs. The
+StreamHub instead holds a single pattern subscription on `agent_run:*` per
+API process and dispatches each message to the in-memory queues of the local
+subscribers of that run.
+
+- Subscriptions are reference counted per run, and runs without subscribers
+  are dropped from the dispatch table
+- Consecutive new_response notifications are coalesced, since a subscriber
+  re-reads everything after its last position anyway
+- A subscriber whose queue is full is evicted: its queue is replaced by a
+  single `evicted` event so the client reconnects and resumes instead of
+  holding messages in memory indefinitely
+- If the pattern subscription drops, it is re-established and every
+  subscriber gets a new_response event to re-read anything it missed
+"""
+
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+
+CHANNEL_PATTERN = "agent_run:*"
+
+CONTROL_SIGNALS = ("STOP", "END_STREAM", "ERROR")
+
+HubEvent = Tuple[str, Optional[str]]
+
+
+class Subscription:
+    """Queue of the hub events of one agent run for one stream client.
+
+    Events are ("new_response", None), ("control", signal) or ("evicted", None).
+    """
+
+    def __init__(self, hub: "StreamHub", agent_run_id: str, max_queue: int):
+        self.hub = hub
+        self.agent_run_id = agent_run_id
+        self.queue: "asyncio.Queue[HubEvent]" = asyncio.Queue(maxsize=max_queue)
+        self.evicted = False
+        self._new_response_pending = False
+
+    def _deliver(self, event: HubEvent):
+        if self.evicted:
+            return
+        if event[0] == "new_response":
+            if self._new_response_pending:
+                return
+            self._new_response_pending = True
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.hub._evict(self)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[HubEvent]:
+        """Wait for the next event, returning None if none arrives within timeout."""
+        try:
+            event = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event[0] == "new_response":
+            self._new_response_pending = False
+        return event
+
+    def close(self):
+        """Release the subscription."""
+        self.hub._unsubscribe(self)
+
+
+class StreamHub:
+    """Single pattern subscription shared by every stream client of the process."""
+
+    def __init__(self, max_queue: Optional[int] = None):
+        """Initialize the hub.
+
+        Args:
+            max_queue: Maximum number of events buffered per subscriber before it is evicted
+        """
+        self.max_queue = max_queue or config.STREAM_HUB_MAX_QUEUE
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self.evictions = 0
+
+    def subscribe(self, agent_run_id: str) -> Subscription:
+        """Subscribe to the events of a run, starting the shared listener if needed."""
+        subscription = Subscription(self, agent_run_id, self.max_queue)
+        self._subscribers.setdefault(agent_run_id, set()).add(subscription)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.agent_run_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[subscription.agent_run_id]
+
+    def _evict(self, subscription: Subscription):
+        logger.warning(f"Evicting slow stream subscriber of agent run {subscription.agent_run_id}")
+        self.evictions += 1
+        subscription.evicted = True
+        self._unsubscribe(subscription)
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(("evicted", None))
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def _dispatch(self, channel: str, data: str):
+        # Channels are agent_run:{id}:new_response and agent_run:{id}:control;
+        # instance-specific control channels (agent_run:{id}:control:{instance}) are for workers
+        parts = channel.split(":")
+        if len(parts) != 3:
+            return
+        subscriptions = self._subscribers.get(parts[1])
+        if not subscriptions:
+            return
+
+        if parts[2] == "new_response":
+            event = ("new_response", None)
+        elif parts[2] == "control" and data in CONTROL_SIGNALS:
+            event = ("control", data)
+        else:
+            return
+
+        for subscription in list(subscriptions):
+            subscription._deliver(event)
+
+    def _wake_all(self):
+        for subscriptions in list(self._subscribers.values()):
+            for subscription in list(subscriptions):
+                subscription._deliver(("new_response", None))
+
+    async def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = await redis.create_pubsub()
+                await pubsub.psubscribe(CHANNEL_PATTERN)
+                logger.info(f"Stream hub subscribed to {CHANNEL_PATTERN}")
+                # Anything published while (re)subscribing may have been missed
+                self._wake_all()
+                async for message in pubsub.listen():
+                    if message.get("type") == "pmessage":
+                        self._dispatch(message.get("channel"), message.get("data"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stream hub subscription failed, reconnecting: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                if pubsub:
+                    try:
+                        await pubsub.punsubscribe()
+                        await pubsub.close()
+                    except Exception as e:
+                        logger.debug(f"Error closing stream hub pubsub: {str(e)}")
+
+    async def close(self):
+        """Stop the shared listener."""
+        if self._listener and not self._listener.done():
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        self._listener = None
+
+
+_stream_hub: Optional[StreamHub] = None
+
+
+def get_stream_hub() -> StreamHub:
+    """Get the process-wide StreamHub instance."""
+    global _stream_hub
+    if _stream_hub is None:
+        _stream_hub = StreamHub()
+    return _stream_hub
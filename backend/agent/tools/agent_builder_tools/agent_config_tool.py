@@ -3,6 +3,7 @@ from typing import Optional, Dict, Any
 from agentpress.tool import ToolResult, openapi_schema, xml_schema
 from agentpress.thread_manager import ThreadManager
 from .base_tool import AgentBuilderBaseTool
+from agent.bootstrap_cache import invalidate_agent_bootstrap
 from utils.logger import logger
 
 
@@ -139,6 +140,7 @@ class AgentConfigTool(AgentBuilderBaseTool):
             
             if not result.data:
                 return self.fail_response("Failed to update agent")
+            await invalidate_agent_bootstrap(self.agent_id)
 
             return self.success_response({
                 "message": "Agent updated successfully",
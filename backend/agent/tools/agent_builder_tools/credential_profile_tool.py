@@ -3,6 +3,7 @@ from typing import Optional, List
 from agentpress.tool import ToolResult, openapi_schema, xml_schema
 from agentpress.thread_manager import ThreadManager
 from .base_tool import AgentBuilderBaseTool
+from agent.bootstrap_cache import invalidate_agent_bootstrap
 from pipedream.search_utils import PipedreamSearchAPI
 from pipedream.profiles import get_profile_manager
 from utils.logger import logger
@@ -396,6 +397,7 @@ class CredentialProfileTool(AgentBuilderBaseTool):
             
             if not update_result.data:
                 return self.fail_response("Failed to save agent configuration")
+            await invalidate_agent_bootstrap(self.agent_id)
             
             return self.success_response({
                 "message": f"Successfully {action} {profile.app_name} profile '{profile.profile_name}' with {len(enabled_tools)} tools",
@@ -458,6 +460,7 @@ class CredentialProfileTool(AgentBuilderBaseTool):
                     await client.table('agents').update({
                         'custom_mcps': updated_mcps
                     }).eq('agent_id', self.agent_id).execute()
+                    await invalidate_agent_bootstrap(self.agent_id)
             
             await profile_manager.delete_profile(account_id, profile_id)
             
@@ -1,8 +1,8 @@
 from typing import Any, Dict, List, Optional
+from agentpress.resource_scheduler import MCP_RESOURCE
 from agentpress.tool import Tool, ToolResult, openapi_schema, xml_schema, ToolSchema, SchemaType
 from mcp_service.client import MCPManager
 from utils.logger import logger
-import inspect
 from agent.tools.utils.mcp_connection_manager import MCPConnectionManager
 from agent.tools.utils.custom_mcp_handler import CustomMCPHandler
 from agent.tools.utils.dynamic_tool_builder import DynamicToolBuilder
@@ -10,6 +10,8 @@ from agent.tools.utils.mcp_tool_executor import MCPToolExecutor
 
 
 class MCPToolWrapper(Tool):
+    resource_class = MCP_RESOURCE
+
     def __init__(self, mcp_configs: Optional[List[Dict[str, Any]]] = None):
         self.mcp_manager = MCPManager()
         self.mcp_configs = mcp_configs or []
@@ -31,6 +33,28 @@ class MCPToolWrapper(Tool):
             await self._create_dynamic_tools()
             self._initialized = True
     
+    async def initialize_from_listings(self, listings: Dict[str, Any]):
+        """Initialize from tool listings exported by another wrapper instead of connecting to the servers."""
+        self.mcp_manager.connections = dict(listings['connections'])
+        self.custom_handler.custom_tools = dict(listings['custom_tools'])
+        await self._create_dynamic_tools()
+        self._initialized = True
+    
+    def export_tool_listings(self) -> Optional[Dict[str, Any]]:
+        """Export the MCP tool listings for reuse, or None if any server failed to initialize."""
+        if not self._initialized:
+            return None
+        standard_configs = [cfg for cfg in self.mcp_configs if not cfg.get('isCustom', False)]
+        custom_names = {cfg.get('name', 'Unknown') for cfg in self.mcp_configs if cfg.get('isCustom', False)}
+        connected_names = {conn.qualified_name for conn in self.mcp_manager.connections.values()}
+        listed_custom_names = {tool['server'] for tool in self.custom_handler.custom_tools.values()}
+        if any(cfg['qualifiedName'] not in connected_names for cfg in standard_configs) or not custom_names <= listed_custom_names:
+            return None
+        return {
+            'connections': dict(self.mcp_manager.connections),
+            'custom_tools': self.custom_handler.get_custom_tools()
+        }
+    
     async def _initialize_servers(self):
         standard_configs = [cfg for cfg in self.mcp_configs if not cfg.get('isCustom', False)]
         custom_configs = [cfg for cfg in self.mcp_configs if cfg.get('isCustom', False)]
@@ -81,10 +105,7 @@ class MCPToolWrapper(Tool):
             logger.error(f"Error creating dynamic MCP tools: {e}")
     
     def _register_schemas(self):
-        for name, method in inspect.getmembers(self, predicate=inspect.ismethod):
-            if hasattr(method, 'tool_schemas'):
-                self._schemas[name] = method.tool_schemas
-                logger.debug(f"Registered schemas for method '{name}' in {self.__class__.__name__}")
+        super()._register_schemas()
         
         logger.debug(f"Initial registration complete for MCPToolWrapper")
     
@@ -4,6 +4,7 @@ import base64
 import io
 from PIL import Image
 
+from agentpress.resource_scheduler import BROWSER_RESOURCE
 from agentpress.tool import ToolResult, openapi_schema, xml_schema
 from agentpress.thread_manager import ThreadManager
 from sandbox.tool_base import SandboxToolsBase
@@ -13,6 +14,8 @@ from utils.s3_upload_utils import upload_base64_image
 
 class SandboxBrowserTool(SandboxToolsBase):
     """Tool for executing tasks in a Daytona sandbox with browser-use capabilities."""
+
+    resource_class = BROWSER_RESOURCE
     
     def __init__(self, project_id: str, thread_id: str, thread_manager: ThreadManager):
         super().__init__(project_id, thread_manager)
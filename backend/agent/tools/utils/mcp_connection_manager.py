@@ -5,12 +5,14 @@ from mcp.client.sse import sse_client
 from mcp.client.stdio import stdio_client
 from mcp.client.streamable_http import streamablehttp_client
 from utils.logger import logger
+from utils.metrics import MCP_CONNECT_SECONDS, timed
 
 
 class MCPConnectionManager:
     def __init__(self):
         self.connected_servers: Dict[str, Dict[str, Any]] = {}
     
+    @timed(MCP_CONNECT_SECONDS, transport="sse")
     async def connect_sse_server(self, server_name: str, server_config: Dict[str, Any], timeout: int = 15) -> Dict[str, Any]:
         url = server_config["url"]
         headers = server_config.get("headers", {})
@@ -71,6 +73,7 @@ class MCPConnectionManager:
                 else:
                     raise
     
+    @timed(MCP_CONNECT_SECONDS, transport="http")
     async def connect_http_server(self, server_name: str, server_config: Dict[str, Any], timeout: int = 15) -> Dict[str, Any]:
         url = server_config["url"]
         
@@ -100,6 +103,7 @@ class MCPConnectionManager:
                     logger.info(f"Connected to {server_name} via HTTP ({len(tools_info)} tools)")
                     return server_info
     
+    @timed(MCP_CONNECT_SECONDS, transport="stdio")
     async def connect_stdio_server(self, server_name: str, server_config: Dict[str, Any], timeout: int = 15) -> Dict[str, Any]:
         server_params = StdioServerParameters(
             command=server_config["command"],
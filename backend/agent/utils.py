@@ -1,13 +1,12 @@
-import json
 from typing import Optional
 from utils.logger import logger
 from services import redis
+from agent import response_stream, run_archiver, run_registry
 
 
 async def _cleanup_redis_response_list(agent_run_id: str):
     try:
-        response_list_key = f"agent_run:{agent_run_id}:responses"
-        await redis.delete(response_list_key)
+        await response_stream.delete_responses(agent_run_id)
         logger.debug(f"Cleaned up Redis response list for agent run {agent_run_id}")
     except Exception as e:
         logger.warning(f"Failed to clean up Redis response list for {agent_run_id}: {str(e)}")
@@ -29,22 +28,25 @@ async def stop_agent_run(db, agent_run_id: str, error_message: Optional[str] = N
     client = await db.client
     final_status = "failed" if error_message else "stopped"
 
-    response_list_key = f"agent_run:{agent_run_id}:responses"
-    all_responses = []
+    # Archived inline since the responses are deleted from Redis below
     try:
-        all_responses_json = await redis.lrange(response_list_key, 0, -1)
-        all_responses = [json.loads(r) for r in all_responses_json]
-        logger.info(f"Fetched {len(all_responses)} responses from Redis for DB update on stop/fail: {agent_run_id}")
+        await run_archiver.archive_run(client, agent_run_id)
     except Exception as e:
-        logger.error(f"Failed to fetch responses from Redis for {agent_run_id} during stop/fail: {e}")
+        logger.error(f"Failed to archive responses of {agent_run_id} during stop/fail: {e}")
 
     update_success = await update_agent_run_status(
-        client, agent_run_id, final_status, error=error_message, responses=all_responses
+        client, agent_run_id, final_status, error=error_message
     )
 
     if not update_success:
         logger.error(f"Failed to update database status for stopped/failed run {agent_run_id}")
 
+    try:
+        if await redis.exists(response_stream.response_stream_key(agent_run_id)):
+            await response_stream.append_control(agent_run_id, "STOP")
+    except Exception as e:
+        logger.error(f"Failed to append STOP signal to response stream of {agent_run_id}: {str(e)}")
+
     global_control_channel = f"agent_run:{agent_run_id}:control"
     try:
         await redis.publish(global_control_channel, "STOP")
@@ -53,21 +55,16 @@ async def stop_agent_run(db, agent_run_id: str, error_message: Optional[str] = N
         logger.error(f"Failed to publish STOP signal to global channel {global_control_channel}: {str(e)}")
 
     try:
-        instance_keys = await redis.keys(f"active_run:*:{agent_run_id}")
-        logger.debug(f"Found {len(instance_keys)} active instance keys for agent run {agent_run_id}")
-
-        for key in instance_keys:
-            parts = key.split(":")
-            if len(parts) == 3:
-                instance_id_from_key = parts[1]
-                instance_control_channel = f"agent_run:{agent_run_id}:control:{instance_id_from_key}"
-                try:
-                    await redis.publish(instance_control_channel, "STOP")
-                    logger.debug(f"Published STOP signal to instance channel {instance_control_channel}")
-                except Exception as e:
-                    logger.warning(f"Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
-            else:
-                 logger.warning(f"Unexpected key format found: {key}")
+        run_instance_ids = await run_registry.get_run_instances(agent_run_id)
+        logger.debug(f"Found {len(run_instance_ids)} active instances for agent run {agent_run_id}")
+
+        for run_instance_id in run_instance_ids:
+            instance_control_channel = f"agent_run:{agent_run_id}:control:{run_instance_id}"
+            try:
+                await redis.publish(instance_control_channel, "STOP")
+                logger.debug(f"Published STOP signal to instance channel {instance_control_channel}")
+            except Exception as e:
+                logger.warning(f"Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
 
         await _cleanup_redis_response_list(agent_run_id)
 
@@ -13,7 +13,6 @@ import os
 
 from agentpress.thread_manager import ThreadManager
 from services.supabase import DBConnection
-from services import redis
 from utils.auth_utils import get_current_user_id_from_jwt, get_user_id_from_stream_auth, verify_thread_access
 from utils.logger import logger, structlog
 from services.billing import check_billing_status, can_use_model
@@ -24,6 +23,7 @@ from run_agent_background import run_agent_background
 from utils.constants import MODEL_NAME_ALIASES
 from flags.flags import is_enabled
 from .config_helper import extract_agent_config
+from . import run_registry
 
 router = APIRouter()
 db = None
@@ -678,11 +678,10 @@ async def execute_agent_workflow(
     )
     logger.info(f"Created new agent run: {agent_run_id}")
 
-    instance_key = f"active_run:{instance_id}:{agent_run_id}"
     try:
-        await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+        await run_registry.register_run(instance_id, agent_run_id)
     except Exception as e:
-        logger.warning(f"Failed to register workflow agent run in Redis ({instance_key}): {str(e)}")
+        logger.warning(f"Failed to register workflow agent run {agent_run_id} for instance {instance_id} in Redis: {str(e)}")
 
     request_id = structlog.contextvars.get_contextvars().get('request_id')
 
@@ -701,9 +700,10 @@ async def execute_agent_workflow(
         is_agent_builder=False,
         target_agent_id=None,
         request_id=request_id,
+        account_id=account_id,
     )
 
-    logger.info(f"Started workflow agent execution ({instance_key})")
+    logger.info(f"Started workflow agent execution {agent_run_id} (Instance: {instance_id})")
 
     return {
         "execution_id": execution_id,
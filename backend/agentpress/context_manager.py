@@ -5,14 +5,21 @@ This module handles token counting and thread summarization to prevent
 reaching the context window limitations of LLM models.
 """
 
+import heapq
 import json
+import math
 from typing import List, Dict, Any, Optional, Union
 
-from litellm.utils import token_counter
+from agentpress.message_cache import get_message_cache
+from agentpress.token_cache import get_token_cache
+from services.llm import make_llm_api_call
 from services.supabase import DBConnection
 from utils.logger import logger
+from utils.metrics import COMPRESS_MESSAGES_TOKENS_REMOVED
 
 DEFAULT_TOKEN_THRESHOLD = 120000
+SUMMARY_TARGET_TOKENS = 10000
+SUMMARY_KEEP_RECENT_MESSAGES = 10
 
 class ContextManager:
     """Manages thread context including token counting and summarization."""
@@ -25,6 +32,7 @@ class ContextManager:
         """
         self.db = DBConnection()
         self.token_threshold = token_threshold
+        self.token_cache = get_token_cache()
 
     def is_tool_result_message(self, msg: Dict[str, Any]) -> bool:
         """Check if a message is a tool result message."""
@@ -92,73 +100,6 @@ class ContextManager:
             else:
                 return msg_content
   
-    def compress_tool_result_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the tool result messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of ToolResult messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if self.is_tool_result_message(msg):  # Only compress ToolResult messages
-                    _i += 1  # Count the number of ToolResult messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent ToolResult message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-        return messages
-
-    def compress_user_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the user messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of User messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if msg.get('role') == 'user':  # Only compress User messages
-                    _i += 1  # Count the number of User messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent User message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-        return messages
-
-    def compress_assistant_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int], token_threshold: int = 1000) -> List[Dict[str, Any]]:
-        """Compress the assistant messages except the most recent one."""
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=messages)
-        max_tokens_value = max_tokens or (100 * 1000)
-        
-        if uncompressed_total_token_count > max_tokens_value:
-            _i = 0  # Count the number of Assistant messages
-            for msg in reversed(messages):  # Start from the end and work backwards
-                if msg.get('role') == 'assistant':  # Only compress Assistant messages
-                    _i += 1  # Count the number of Assistant messages
-                    msg_token_count = token_counter(messages=[msg])  # Count the number of tokens in the message
-                    if msg_token_count > token_threshold:  # If the message is too long
-                        if _i > 1:  # If this is not the most recent Assistant message
-                            message_id = msg.get('message_id')  # Get the message_id
-                            if message_id:
-                                msg["content"] = self.compress_message(msg["content"], message_id, token_threshold * 3)
-                            else:
-                                logger.warning(f"UNEXPECTED: Message has no message_id {str(msg)[:100]}")
-                        else:
-                            msg["content"] = self.safe_truncate(msg["content"], int(max_tokens_value * 2))
-                            
-        return messages
-
     def remove_meta_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Remove meta messages from the messages."""
         result: List[Dict[str, Any]] = []
@@ -186,49 +127,122 @@ class ContextManager:
                 result.append(msg)
         return result
 
+    def get_model_max_tokens(self, llm_model: str) -> int:
+        """Get the prompt token budget for a model."""
+        if 'sonnet' in llm_model.lower():
+            return 200 * 1000 - 64000 - 28000
+        elif 'gpt' in llm_model.lower():
+            return 128 * 1000 - 28000
+        elif 'gemini' in llm_model.lower():
+            return 1000 * 1000 - 300000
+        elif 'deepseek' in llm_model.lower():
+            return 128 * 1000 - 28000
+        else:
+            return 41 * 1000 - 10000
+
     def compress_messages(self, messages: List[Dict[str, Any]], llm_model: str, max_tokens: Optional[int] = 41000, token_threshold: int = 4096, max_iterations: int = 5) -> List[Dict[str, Any]]:
-        """Compress the messages.
+        """Compress the messages to fit the model's token budget.
+
+        Picks a truncation level per message in a single pass over cached
+        per-message token counts. Truncation levels start at token_threshold and
+        halve max_iterations times. A priority queue ordered by (level, position)
+        compresses messages oldest to newest at each level and stops as soon as
+        the estimated total fits the budget, so no message list is re-tokenized.
+
+        The most recent tool result, user and assistant messages are never
+        compressed (only safely truncated if huge), and compressed messages
+        keep their message_id pointer for the expand-message tool. If the
+        budget still can't be met, messages are omitted from the middle.
         
         Args:
             messages: List of messages to compress
             llm_model: Model name for token counting
-            max_tokens: Maximum allowed tokens
+            max_tokens: Maximum allowed tokens (overridden by the model-specific budget)
             token_threshold: Token threshold for individual message compression (must be a power of 2)
-            max_iterations: Maximum number of compression iterations
+            max_iterations: Number of times the truncation level is halved
         """
-        # Set model-specific token limits
-        if 'sonnet' in llm_model.lower():
-            max_tokens = 200 * 1000 - 64000 - 28000
-        elif 'gpt' in llm_model.lower():
-            max_tokens = 128 * 1000 - 28000
-        elif 'gemini' in llm_model.lower():
-            max_tokens = 1000 * 1000 - 300000
-        elif 'deepseek' in llm_model.lower():
-            max_tokens = 128 * 1000 - 28000
-        else:
-            max_tokens = 41 * 1000 - 10000
+        max_tokens = self.get_model_max_tokens(llm_model)
 
-        result = messages
-        result = self.remove_meta_messages(result)
+        result = self.remove_meta_messages(messages)
+        costs = self.token_cache.counts(result, llm_model)
+        uncompressed_total_token_count = self.token_cache.overhead(llm_model) + sum(costs)
 
-        uncompressed_total_token_count = token_counter(model=llm_model, messages=result)
+        if uncompressed_total_token_count <= max_tokens:
+            return self.middle_out_messages(result)
 
-        result = self.compress_tool_result_messages(result, llm_model, max_tokens, token_threshold)
-        result = self.compress_user_messages(result, llm_model, max_tokens, token_threshold)
-        result = self.compress_assistant_messages(result, llm_model, max_tokens, token_threshold)
+        # The most recent message of each kind stays intact
+        protected = set()
+        for kind_matches in (
+            self.is_tool_result_message,
+            lambda msg: msg.get('role') == 'user',
+            lambda msg: msg.get('role') == 'assistant',
+        ):
+            for i in range(len(result) - 1, -1, -1):
+                if result[i].get('role') != 'system' and kind_matches(result[i]):
+                    protected.add(i)
+                    break
 
-        compressed_token_count = token_counter(model=llm_model, messages=result)
+        total = uncompressed_total_token_count
+        for i in protected:
+            if costs[i] > token_threshold:
+                result[i] = {**result[i], "content": self.safe_truncate(result[i]["content"], int(max_tokens * 2))}
+                new_cost = self.token_cache.count(result[i], llm_model)
+                total -= costs[i] - new_cost
+                costs[i] = new_cost
 
-        logger.info(f"compress_messages: {uncompressed_total_token_count} -> {compressed_token_count}")  # Log the token compression for debugging later
+        levels = [token_threshold >> step for step in range(max_iterations + 1) if token_threshold >> step > 0]
 
-        if max_iterations <= 0:
-            logger.warning(f"compress_messages: Max iterations reached, omitting messages")
-            result = self.compress_messages_by_omitting_messages(messages, llm_model, max_tokens)
-            return result
+        def push_next_level(queue: List, start_level: int, i: int, cost: int):
+            for level_index in range(start_level, len(levels)):
+                if cost > levels[level_index]:
+                    heapq.heappush(queue, (level_index, i))
+                    return
+
+        queue: List = []
+        content_lengths: Dict[int, int] = {}
+        for i, msg in enumerate(result):
+            if i in protected or msg.get('role') == 'system':
+                continue
+            content = msg.get('content')
+            if isinstance(content, str):
+                content_lengths[i] = len(content)
+            elif isinstance(content, dict):
+                content_lengths[i] = len(json.dumps(content))
+            else:
+                continue
+            push_next_level(queue, 0, i, costs[i])
+
+        # Greedily lower the truncation level of the oldest messages first until the budget is met
+        estimated_costs = list(costs)
+        chosen_levels: Dict[int, int] = {}
+        while queue and total > max_tokens:
+            level_index, i = heapq.heappop(queue)
+            max_length = levels[level_index] * 3
+            if content_lengths[i] <= max_length:
+                push_next_level(queue, level_index + 1, i, estimated_costs[i])
+                continue
+            # compress_message keeps max_length characters plus the expand-message pointer
+            new_cost = min(estimated_costs[i], math.ceil(costs[i] * (max_length + 100) / content_lengths[i]))
+            total -= estimated_costs[i] - new_cost
+            estimated_costs[i] = new_cost
+            chosen_levels[i] = max_length
+            push_next_level(queue, level_index + 1, i, new_cost)
+
+        for i, max_length in chosen_levels.items():
+            message_id = result[i].get('message_id')
+            if message_id:
+                result[i] = {**result[i], "content": self.compress_message(result[i]["content"], message_id, max_length)}
+            else:
+                logger.warning(f"UNEXPECTED: Message has no message_id {str(result[i])[:100]}")
+
+        compressed_token_count = self.token_cache.total(result, llm_model)
+
+        logger.info(f"compress_messages: {uncompressed_total_token_count} -> {compressed_token_count}")  # Log the token compression for debugging later
+        COMPRESS_MESSAGES_TOKENS_REMOVED.labels(model=llm_model).observe(max(0, uncompressed_total_token_count - compressed_token_count))
 
         if compressed_token_count > max_tokens:
-            logger.warning(f"Further token compression is needed: {compressed_token_count} > {max_tokens}")
-            result = self.compress_messages(messages, llm_model, max_tokens, token_threshold // 2, max_iterations - 1)
+            logger.warning(f"compress_messages: Token budget still exceeded ({compressed_token_count} > {max_tokens}), omitting messages")
+            result = self.compress_messages_by_omitting_messages(result, llm_model, max_tokens)
 
         return self.middle_out_messages(result)
     
@@ -256,7 +270,8 @@ class ContextManager:
         result = self.remove_meta_messages(result)
 
         # Early exit if no compression needed
-        initial_token_count = token_counter(model=llm_model, messages=result)
+        prefix = self.token_cache.prefix_sums(result, llm_model)
+        initial_token_count = prefix[-1]
         max_allowed_tokens = max_tokens or (100 * 1000)
         
         if initial_token_count <= max_allowed_tokens:
@@ -264,40 +279,60 @@ class ContextManager:
 
         # Separate system message (assumed to be first) from conversation messages
         system_message = messages[0] if messages and messages[0].get('role') == 'system' else None
-        conversation_messages = result[1:] if system_message else result
+        offset = 1 if system_message else 0
+        conversation_length = len(result) - offset
+
+        def conversation_tokens(start: int, end: int) -> int:
+            return prefix[offset + end] - prefix[offset + start]
+
+        # The remaining conversation is conversation[start:head_end] + conversation[tail_start:].
+        # Removals only move these bounds, so each batch updates the token count in O(1)
+        # from the prefix sums instead of rebuilding and re-tokenizing the list.
+        start = 0
+        head_end = tail_start = conversation_length // 2
         
         safety_limit = 500
         current_token_count = initial_token_count
         
         while current_token_count > max_allowed_tokens and safety_limit > 0:
             safety_limit -= 1
+
+            head_length = head_end - start
+            remaining = head_length + (conversation_length - tail_start)
             
-            if len(conversation_messages) <= min_messages_to_keep:
-                logger.warning(f"Cannot compress further: only {len(conversation_messages)} messages remain (min: {min_messages_to_keep})")
+            if remaining <= min_messages_to_keep:
+                logger.warning(f"Cannot compress further: only {remaining} messages remain (min: {min_messages_to_keep})")
                 break
 
             # Calculate removal strategy based on current message count
-            if len(conversation_messages) > (removal_batch_size * 2):
-                # Remove from middle, keeping recent and early context
-                middle_start = len(conversation_messages) // 2 - (removal_batch_size // 2)
-                middle_end = middle_start + removal_batch_size
-                conversation_messages = conversation_messages[:middle_start] + conversation_messages[middle_end:]
+            if remaining > (removal_batch_size * 2):
+                # Remove from middle, keeping recent and early context.
+                # The middle window always straddles the gap left by earlier removals.
+                middle_start = remaining // 2 - (removal_batch_size // 2)
+                remove_from_head = min(max(head_length - middle_start, 0), removal_batch_size, head_length)
+                remove_from_tail = min(removal_batch_size - remove_from_head, conversation_length - tail_start)
+                current_token_count -= conversation_tokens(head_end - remove_from_head, head_end)
+                current_token_count -= conversation_tokens(tail_start, tail_start + remove_from_tail)
+                head_end -= remove_from_head
+                tail_start += remove_from_tail
             else:
                 # Remove from earlier messages, preserving recent context
-                messages_to_remove = min(removal_batch_size, len(conversation_messages) // 2)
+                messages_to_remove = min(removal_batch_size, remaining // 2)
                 if messages_to_remove > 0:
-                    conversation_messages = conversation_messages[messages_to_remove:]
+                    remove_from_head = min(messages_to_remove, head_length)
+                    remove_from_tail = messages_to_remove - remove_from_head
+                    current_token_count -= conversation_tokens(start, start + remove_from_head)
+                    current_token_count -= conversation_tokens(tail_start, tail_start + remove_from_tail)
+                    start += remove_from_head
+                    tail_start += remove_from_tail
                 else:
                     # Can't remove any more messages
                     break
 
-            # Recalculate token count
-            messages_to_count = ([system_message] + conversation_messages) if system_message else conversation_messages
-            current_token_count = token_counter(model=llm_model, messages=messages_to_count)
-
         # Prepare final result
+        conversation_messages = result[offset + start:offset + head_end] + result[offset + tail_start:]
         final_messages = ([system_message] + conversation_messages) if system_message else conversation_messages
-        final_token_count = token_counter(model=llm_model, messages=final_messages)
+        final_token_count = current_token_count
         
         logger.info(f"compress_messages_by_omitting_messages: {initial_token_count} -> {final_token_count} tokens ({len(messages)} -> {len(final_messages)} messages)")
             
@@ -312,4 +347,123 @@ class ContextManager:
         keep_start = max_messages // 2
         keep_end = max_messages - keep_start
         
-        return messages[:keep_start] + messages[-keep_end:] 
\ No newline at end of file
+        return messages[:keep_start] + messages[-keep_end:] 
+
+    async def create_summary(self, messages: List[Dict[str, Any]], llm_model: str) -> Optional[Dict[str, Any]]:
+        """Generate a summary of the given messages.
+
+        Args:
+            messages: Messages to summarize, oldest first
+            llm_model: Model to use for summarization
+
+        Returns:
+            The summary as an LLM message, or None if summarization failed
+        """
+        system_message = {
+            "role": "system",
+            "content": f"""You are a specialized summarization assistant. Your task is to create a concise but comprehensive summary of the conversation history.
+
+The summary should:
+1. Preserve all key information including decisions, conclusions, and important context
+2. Include any tools that were used and their results
+3. Maintain chronological order of events
+4. Be presented as a narrated list of key points with section headers
+5. Include only factual information from the conversation (no new information)
+6. Be concise but detailed enough that the conversation can continue with this summary as context
+
+VERY IMPORTANT: This summary will replace older parts of the conversation in the LLM's context window, so ensure it contains ALL key information and LATEST STATE OF THE CONVERSATION - SO WE WILL KNOW HOW TO PICK UP WHERE WE LEFT OFF.
+
+THE CONVERSATION HISTORY TO SUMMARIZE IS AS FOLLOWS:
+===============================================================
+==================== CONVERSATION HISTORY ====================
+"""
+        }
+        prompt_messages = [system_message] + messages + [{
+            "role": "user",
+            "content": "==================== END OF CONVERSATION HISTORY ====================\n\nPLEASE PROVIDE THE SUMMARY NOW."
+        }]
+        prompt_messages = self.compress_messages(prompt_messages, llm_model)
+
+        try:
+            response = await make_llm_api_call(
+                model_name=llm_model,
+                messages=prompt_messages,
+                temperature=0,
+                max_tokens=SUMMARY_TARGET_TOKENS,
+                stream=False
+            )
+        except Exception as e:
+            logger.error(f"Error creating summary: {str(e)}", exc_info=True)
+            return None
+
+        if not (response and hasattr(response, 'choices') and response.choices):
+            logger.warning("Summarization returned no choices")
+            return None
+
+        summary_content = response.choices[0].message.content
+        return {
+            "role": "user",
+            "content": f"""
+======== CONVERSATION HISTORY SUMMARY ========
+
+{summary_content}
+
+======== END OF SUMMARY ========
+
+The above is a summary of the conversation history. The conversation continues below.
+"""
+        }
+
+    async def check_and_summarize_if_needed(self, thread_id: str, llm_model: str, keep_recent_messages: int = SUMMARY_KEEP_RECENT_MESSAGES) -> bool:
+        """Write a summary message for a thread if its context exceeds the token threshold.
+
+        The summary replaces everything but the most recent messages. It is
+        stored as a `summary` message whose metadata records the created_at and
+        message_id of the last summarized message, so later get_llm_messages
+        calls load only the summary plus the messages after that point.
+
+        Args:
+            thread_id: The ID of the thread to summarize
+            llm_model: Model used for token counting and summarization
+            keep_recent_messages: Number of most recent messages left unsummarized
+
+        Returns:
+            True if a summary was written
+        """
+        client = await self.db.client
+        entry = await get_message_cache().get_entry(client, thread_id)
+        messages = entry.messages
+
+        token_count = self.token_cache.total(messages, llm_model)
+        if token_count < self.token_threshold:
+            logger.debug(f"Thread {thread_id} doesn't need summarization: {token_count} < {self.token_threshold} threshold")
+            return False
+
+        # Never leave a tool result without the message that called it
+        boundary = len(messages) - keep_recent_messages
+        while boundary > 0 and messages[boundary].get('role') == 'tool':
+            boundary -= 1
+        if boundary <= (1 if entry.summary_id else 0):
+            logger.info(f"Thread {thread_id} has no messages old enough to summarize")
+            return False
+
+        logger.info(f"Summarizing {boundary} of {len(messages)} messages for thread {thread_id} ({token_count} tokens)")
+        summary = await self.create_summary(messages[:boundary], llm_model)
+        if not summary:
+            return False
+
+        last_summarized = messages[boundary - 1]
+        await client.table('messages').insert({
+            'thread_id': thread_id,
+            'type': 'summary',
+            'content': summary,
+            'is_llm_message': True,
+            'metadata': {
+                'token_count': token_count,
+                'summarized_until': entry.created_ats[boundary - 1],
+                'summarized_message_id': last_summarized.get('message_id'),
+            },
+        }).execute()
+
+        logger.info(f"Added summary message for thread {thread_id}")
+        return True
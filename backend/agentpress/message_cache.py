@@ -0,0 +1,286 @@
+"""
+Incremental per-thread cache of LLM messages for AgentPress.
+
+This module keeps the parsed LLM messages of recently used threads so that
+repeated calls to ThreadManager.get_llm_messages only fetch rows that were
+inserted after the cached watermark instead of re-reading the whole thread.
+
+The cache has two tiers:
+- An in-process LRU holding the parsed messages of the most recent threads
+- A Redis tier shared across workers, used to warm the local tier on a miss
+
+Each entry tracks a (created_at, message_id) watermark. A refresh queries
+rows with created_at >= watermark and skips the ids already seen at the
+watermark timestamp, so rows written by other writers (frontend, triggers,
+other workers) are still picked up.
+
+Threads with rolling summaries are loaded from their latest `summary` message
+onwards: the summary replaces every message up to its `summarized_until`
+timestamp. A newer summary arriving through a refresh rebases the entry the
+same way.
+"""
+
+import asyncio
+import copy
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+from utils.pagination import keyset_pages
+
+REDIS_KEY_PREFIX = "thread_llm_messages"
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a timestamp returned by PostgREST."""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+@dataclass
+class ThreadMessagesEntry:
+    """Cached LLM messages of a single thread.
+
+    Attributes:
+        messages: Parsed message dicts in created_at order, each with its message_id
+        created_ats: created_at of each message in messages
+        watermark: created_at of the newest row seen
+        watermark_ids: ids of the rows seen whose created_at equals the watermark
+        summary_id: message_id of the summary the messages start from, if any
+        summary_created_at: created_at of that summary
+    """
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    created_ats: List[str] = field(default_factory=list)
+    watermark: Optional[str] = None
+    watermark_ids: List[str] = field(default_factory=list)
+    summary_id: Optional[str] = None
+    summary_created_at: Optional[str] = None
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "messages": self.messages,
+            "created_ats": self.created_ats,
+            "watermark": self.watermark,
+            "watermark_ids": self.watermark_ids,
+            "summary_id": self.summary_id,
+            "summary_created_at": self.summary_created_at,
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> "ThreadMessagesEntry":
+        data = json.loads(raw)
+        return cls(
+            messages=data.get("messages", []),
+            created_ats=data.get("created_ats", []),
+            watermark=data.get("watermark"),
+            watermark_ids=data.get("watermark_ids", []),
+            summary_id=data.get("summary_id"),
+            summary_created_at=data.get("summary_created_at"),
+        )
+
+
+class ThreadMessageCache:
+    """Two-tier incremental cache of LLM messages keyed by thread_id."""
+
+    def __init__(self, max_threads: Optional[int] = None, redis_ttl: Optional[int] = None):
+        """Initialize the cache.
+
+        Args:
+            max_threads: Maximum number of threads kept in the in-process LRU
+            redis_ttl: TTL in seconds of the shared Redis tier, 0 disables it
+        """
+        self.max_threads = max_threads if max_threads is not None else config.MESSAGE_CACHE_MAX_THREADS
+        self.redis_ttl = redis_ttl if redis_ttl is not None else config.MESSAGE_CACHE_REDIS_TTL
+        self._entries: "OrderedDict[str, ThreadMessagesEntry]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _redis_key(self, thread_id: str) -> str:
+        return f"{REDIS_KEY_PREFIX}:{thread_id}"
+
+    def _get_lock(self, thread_id: str) -> asyncio.Lock:
+        lock = self._locks.get(thread_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[thread_id] = lock
+        return lock
+
+    def _store_local(self, thread_id: str, entry: ThreadMessagesEntry):
+        self._entries[thread_id] = entry
+        self._entries.move_to_end(thread_id)
+        while len(self._entries) > self.max_threads:
+            evicted_id, _ = self._entries.popitem(last=False)
+            lock = self._locks.get(evicted_id)
+            if lock is not None and not lock.locked():
+                del self._locks[evicted_id]
+
+    async def _load_remote(self, thread_id: str) -> Optional[ThreadMessagesEntry]:
+        if not self.redis_ttl:
+            return None
+        try:
+            raw = await redis.get(self._redis_key(thread_id))
+            if raw:
+                entry = ThreadMessagesEntry.from_json(raw)
+                if len(entry.created_ats) == len(entry.messages):
+                    return entry
+        except Exception as e:
+            logger.warning(f"Failed to load cached messages for thread {thread_id} from Redis: {str(e)}")
+        return None
+
+    async def _store_remote(self, thread_id: str, entry: ThreadMessagesEntry):
+        if not self.redis_ttl:
+            return
+        try:
+            await redis.set(self._redis_key(thread_id), entry.to_json(), ex=self.redis_ttl)
+        except Exception as e:
+            logger.warning(f"Failed to store cached messages for thread {thread_id} in Redis: {str(e)}")
+
+    async def _fetch_since(self, client, thread_id: str, watermark: Optional[str]) -> List[Dict[str, Any]]:
+        """Fetch LLM message rows at or after the watermark, paging by (created_at, message_id)."""
+        def build_query():
+            query = client.table('messages').select('message_id, type, content, metadata, created_at').eq('thread_id', thread_id).eq('is_llm_message', True)
+            if watermark:
+                query = query.gte('created_at', watermark)
+            return query
+
+        rows = []
+        async for page in keyset_pages(build_query):
+            rows.extend(page)
+        return rows
+
+    @staticmethod
+    def _parse_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        content = row['content']
+        if isinstance(content, str):
+            try:
+                content = json.loads(content)
+            except json.JSONDecodeError:
+                logger.error(f"Failed to parse message: {content}")
+                return None
+        content['message_id'] = row['message_id']
+        return content
+
+    async def _load_latest_summary(self, client, thread_id: str) -> Optional[Dict[str, Any]]:
+        result = await client.table('messages').select('message_id, type, content, metadata, created_at').eq('thread_id', thread_id).eq('type', 'summary').eq('is_llm_message', True).order('created_at', desc=True).limit(1).execute()
+        return result.data[0] if result.data else None
+
+    def _apply_summary(self, entry: ThreadMessagesEntry, row: Dict[str, Any]):
+        """Rebase the entry on a summary row, dropping the messages it replaces."""
+        if entry.summary_created_at and parse_timestamp(row['created_at']) <= parse_timestamp(entry.summary_created_at):
+            return
+        summary = self._parse_row(row)
+        if summary is None:
+            return
+
+        summarized_until = parse_timestamp((row.get('metadata') or {}).get('summarized_until') or row['created_at'])
+        kept = [
+            (message, created_at)
+            for message, created_at in zip(entry.messages, entry.created_ats)
+            if message.get('message_id') != entry.summary_id and parse_timestamp(created_at) > summarized_until
+        ]
+        entry.messages = [summary] + [message for message, _ in kept]
+        entry.created_ats = [row['created_at']] + [created_at for _, created_at in kept]
+        entry.summary_id = row['message_id']
+        entry.summary_created_at = row['created_at']
+
+    async def _load_initial(self, client, thread_id: str) -> ThreadMessagesEntry:
+        """Start a new entry from the latest summary of the thread, if any."""
+        entry = ThreadMessagesEntry()
+        summary_row = await self._load_latest_summary(client, thread_id)
+        if summary_row:
+            metadata = summary_row.get('metadata') or {}
+            self._apply_summary(entry, summary_row)
+            # Resume right after the last summarized message
+            entry.watermark = metadata.get('summarized_until') or summary_row['created_at']
+            entry.watermark_ids = [metadata['summarized_message_id']] if metadata.get('summarized_message_id') else []
+        return entry
+
+    def _merge_rows(self, entry: ThreadMessagesEntry, rows: List[Dict[str, Any]]) -> int:
+        """Merge rows fetched past the watermark into the entry, returning how many were new."""
+        seen_ids = set(entry.watermark_ids)
+        new_rows = [row for row in rows if row['message_id'] not in seen_ids]
+
+        for row in new_rows:
+            if row.get('type') == 'summary':
+                # Ignored unless newer than the summary the entry starts from
+                self._apply_summary(entry, row)
+            else:
+                message = self._parse_row(row)
+                if message is not None:
+                    entry.messages.append(message)
+                    entry.created_ats.append(row['created_at'])
+            if row['created_at'] != entry.watermark:
+                entry.watermark = row['created_at']
+                entry.watermark_ids = []
+            entry.watermark_ids.append(row['message_id'])
+
+        return len(new_rows)
+
+    async def get_entry(self, client, thread_id: str, refresh: bool = True) -> ThreadMessagesEntry:
+        """Get the cached entry of a thread, fetching only rows newer than the watermark.
+
+        Args:
+            client: Supabase async client
+            thread_id: The ID of the thread to get messages for
+            refresh: Whether to query the database for rows newer than the watermark.
+                     Callers that know no message was written since their last
+                     refresh may skip the round trip.
+
+        Returns:
+            A deep copy of the entry, safe for callers to mutate.
+        """
+        async with self._get_lock(thread_id):
+            entry = self._entries.get(thread_id)
+            if entry is None:
+                entry = await self._load_remote(thread_id)
+                refresh = True
+            if entry is None:
+                entry = await self._load_initial(client, thread_id)
+
+            if refresh:
+                rows = await self._fetch_since(client, thread_id, entry.watermark)
+                new_count = self._merge_rows(entry, rows)
+                if new_count:
+                    logger.debug(f"Fetched {new_count} new messages for thread {thread_id} ({len(entry.messages)} cached)")
+                    await self._store_remote(thread_id, entry)
+
+            self._store_local(thread_id, entry)
+            return copy.deepcopy(entry)
+
+    async def get_messages(self, client, thread_id: str, refresh: bool = True) -> List[Dict[str, Any]]:
+        """Get the LLM messages of a thread, starting from its latest summary.
+
+        See get_entry for the arguments.
+
+        Returns:
+            Deep copies of the cached message dicts, safe for callers to mutate.
+        """
+        entry = await self.get_entry(client, thread_id, refresh=refresh)
+        return entry.messages
+
+    async def invalidate(self, thread_id: str):
+        """Drop a thread from both cache tiers.
+
+        Needed when existing LLM messages are updated or deleted, since the
+        watermark only detects newly inserted rows.
+        """
+        self._entries.pop(thread_id, None)
+        if self.redis_ttl:
+            try:
+                await redis.delete(self._redis_key(thread_id))
+            except Exception as e:
+                logger.warning(f"Failed to invalidate cached messages for thread {thread_id} in Redis: {str(e)}")
+
+
+_message_cache: Optional[ThreadMessageCache] = None
+
+
+def get_message_cache() -> ThreadMessageCache:
+    """Get the process-wide ThreadMessageCache instance."""
+    global _message_cache
+    if _message_cache is None:
+        _message_cache = ThreadMessageCache()
+    return _message_cache
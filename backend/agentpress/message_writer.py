@@ -0,0 +1,175 @@
+"""
+Write-behind message persistence for AgentPress.
+
+Saving a status event or message with a separate INSERT before it can be
+yielded puts a database round trip on the streaming path. The MessageWriter
+instead assigns message IDs (UUIDv7) client-side, returns the full message
+object immediately and inserts queued rows in batches, either once
+batch_size rows are pending or after flush_interval_ms.
+
+created_at is left to the database like for every other writer of messages,
+so the order of a thread and the watermarks of the message cache never
+depend on the clock of the worker. The returned message carries the local
+time as a provisional created_at for display only. Batches are written one
+at a time in enqueue order, the database stamps each row of a batch with its
+own clock_timestamp() and message IDs are strictly increasing per writer, so
+ordering by (created_at, message_id) matches the order in which messages
+were produced. flush() is a barrier that returns once every message
+enqueued before the call is persisted.
+
+Work that must only happen for stored messages, such as recording the usage
+of a response, is passed as on_persisted and runs once the batch of the
+message is inserted.
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from services.supabase import DBConnection
+from utils.config import config
+from utils.logger import logger
+
+
+def uuid7() -> str:
+    """Generate a time-ordered UUIDv7 string (RFC 9562)."""
+    timestamp_ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), 'big')
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    value |= ((rand >> 62) & 0xFFF) << 64
+    value |= 0b10 << 62
+    value |= rand & ((1 << 62) - 1)
+    return str(uuid.UUID(int=value))
+
+
+class MessageWriter:
+    """Batches message inserts off the streaming path."""
+
+    def __init__(self, db: DBConnection, batch_size: Optional[int] = None, flush_interval_ms: Optional[int] = None):
+        """Initialize the MessageWriter.
+
+        Args:
+            db: Database connection used for inserts
+            batch_size: Number of pending rows that triggers an immediate flush
+            flush_interval_ms: Maximum time a row waits before being flushed
+        """
+        self.db = db
+        self.batch_size = batch_size or config.MESSAGE_WRITER_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None else config.MESSAGE_WRITER_FLUSH_INTERVAL_MS) / 1000
+        self._pending: List[Dict[str, Any]] = []
+        self._write_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._errors: List[str] = []
+        self._last_message_id: Optional[int] = None
+        self._callbacks: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {}
+        self._callback_tasks: Set[asyncio.Task] = set()
+
+    def _next_message_id(self) -> str:
+        value = uuid.UUID(uuid7()).int
+        # UUIDv7 is only ordered across milliseconds, ties within a batch are broken by the id
+        if self._last_message_id is not None and value <= self._last_message_id:
+            value = self._last_message_id + 1
+        self._last_message_id = value
+        return str(uuid.UUID(int=value))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def enqueue(
+        self,
+        row: Dict[str, Any],
+        on_persisted: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    ) -> Dict[str, Any]:
+        """Queue a message row for insertion.
+
+        Args:
+            row: Column values of the message, without message_id or timestamps
+            on_persisted: Called in the background with the stored row once the
+                          message is inserted; not called if the insert fails
+
+        Returns:
+            The full message object, with a provisional created_at.
+        """
+        message = {'message_id': self._next_message_id(), **row}
+        self._pending.append(message)
+        if on_persisted:
+            self._callbacks[message['message_id']] = on_persisted
+
+        if len(self._pending) >= self.batch_size:
+            self._spawn(self._write_pending())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._write_after(self.flush_interval))
+
+        now = datetime.now(timezone.utc).isoformat()
+        return {**message, 'created_at': now, 'updated_at': now}
+
+    async def _write_after(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        # The lock is FIFO, so batches are inserted in the order rows were enqueued
+        async with self._write_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:len(batch)]
+                await self._insert(batch)
+
+    async def _insert(self, batch: List[Dict[str, Any]]):
+        client = await self.db.client
+        try:
+            result = await client.table('messages').insert(batch).execute()
+        except Exception as e:
+            logger.warning(f"Batch insert of {len(batch)} messages failed, retrying one by one: {str(e)}")
+        else:
+            logger.debug(f"Flushed {len(batch)} messages")
+            self._persisted(batch, result.data)
+            return
+
+        for message in batch:
+            try:
+                result = await client.table('messages').insert(message).execute()
+            except Exception as e:
+                logger.error(f"Failed to add message {message['message_id']} to thread {message.get('thread_id')}: {str(e)}", exc_info=True)
+                self._errors.append(f"{message['message_id']}: {str(e)}")
+                self._callbacks.pop(message['message_id'], None)
+            else:
+                self._persisted([message], result.data)
+
+    def _persisted(self, messages: List[Dict[str, Any]], stored: Optional[List[Dict[str, Any]]]):
+        """Run the on_persisted callbacks of inserted messages with their stored rows."""
+        stored_rows = {row.get('message_id'): row for row in stored or [] if isinstance(row, dict)}
+        for message in messages:
+            callback = self._callbacks.pop(message['message_id'], None)
+            if callback:
+                task = asyncio.create_task(callback(stored_rows.get(message['message_id'], message)))
+                self._callback_tasks.add(task)
+                task.add_done_callback(self._callback_done)
+
+    def _callback_done(self, task: asyncio.Task):
+        self._callback_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Message persistence callback failed: {str(task.exception())}")
+
+    async def flush(self):
+        """Wait until every message enqueued so far is persisted.
+
+        The on_persisted callbacks of those messages have also finished.
+
+        Raises:
+            RuntimeError: If any message since the last flush could not be inserted.
+        """
+        await self._write_pending()
+        if self._callback_tasks:
+            await asyncio.gather(*list(self._callback_tasks), return_exceptions=True)
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise RuntimeError(f"Failed to persist {len(errors)} messages: {'; '.join(errors)}")
@@ -0,0 +1,249 @@
+"""
+Per-worker concurrency scheduler for agent runs.
+
+A worker process runs every agent run it picks up on one event loop, with no
+limit on how many LLM streams, sandbox operations or browser actions those
+runs have in flight at once. The scheduler gives each resource class a fixed
+number of slots:
+
+- llm:{provider}: streaming LLM calls per provider (anthropic, openai, ...)
+- sandbox: operations of sandbox tools
+- browser: browser automation actions
+- mcp: calls to MCP servers
+
+A call that finds its pool full waits in a queue of its account, and freed
+slots are granted to the queued accounts round robin, so one account running
+many agents cannot starve the others on the same worker.
+
+The worker also asks the scheduler whether it is overloaded before starting
+a run, and defers the run back to RabbitMQ instead of adding it to a
+saturated process. Slot usage is exported as Prometheus gauges.
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, AsyncIterator, Deque, Dict, Optional
+
+from prometheus_client import Counter, Gauge
+
+from utils.config import config
+from utils.logger import logger
+
+LLM_RESOURCE_PREFIX = "llm"
+SANDBOX_RESOURCE = "sandbox"
+BROWSER_RESOURCE = "browser"
+MCP_RESOURCE = "mcp"
+
+# Waiters with no bound account share a single queue
+ANONYMOUS_ACCOUNT = "-"
+
+SLOTS_IN_USE = Gauge("agent_worker_slots_in_use", "Concurrency slots held per resource class", ["resource"])
+SLOTS_CAPACITY = Gauge("agent_worker_slots_capacity", "Concurrency slots available per resource class", ["resource"])
+SLOT_WAITERS = Gauge("agent_worker_slot_waiters", "Calls waiting for a concurrency slot per resource class", ["resource"])
+ACTIVE_RUNS = Gauge("agent_worker_active_runs", "Agent runs executing on this worker process")
+DEFERRED_RUNS = Counter("agent_worker_deferred_runs_total", "Agent runs pushed back to the queue because the worker was overloaded")
+
+_current_account: ContextVar[Optional[str]] = ContextVar("scheduler_account", default=None)
+
+
+def bind_account(account_id: Optional[str]):
+    """Set the account that the slots requested by the current run are queued under."""
+    _current_account.set(account_id)
+
+
+def llm_resource(model_name: str) -> str:
+    """Get the resource class of the LLM calls of a model, e.g. llm:anthropic."""
+    provider = model_name.split("/", 1)[0] if "/" in model_name else "openai"
+    return f"{LLM_RESOURCE_PREFIX}:{provider}"
+
+
+def _parse_provider_slots(value: Optional[str]) -> Dict[str, int]:
+    """Parse SCHEDULER_LLM_PROVIDER_SLOTS, e.g. "anthropic=8,openrouter=32"."""
+    slots = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        provider, _, count = item.partition("=")
+        try:
+            slots[provider.strip()] = int(count)
+        except ValueError:
+            logger.warning(f"Invalid LLM slot count for provider {provider.strip()}: {count}")
+    return slots
+
+
+class Slot:
+    """A slot held in a pool, released once."""
+
+    def __init__(self, pool: "SlotPool"):
+        self._pool = pool
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._pool._release()
+
+
+class SlotPool:
+    """Fixed number of slots of one resource class, granted fairly across accounts."""
+
+    def __init__(self, resource: str, capacity: int):
+        self.resource = resource
+        self.capacity = capacity
+        self.in_use = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = {}
+        self._turns: Deque[str] = deque()
+        self.waiting = 0
+        SLOTS_CAPACITY.labels(resource=resource).set(capacity)
+        self._export()
+
+    def _export(self):
+        SLOTS_IN_USE.labels(resource=self.resource).set(self.in_use)
+        SLOT_WAITERS.labels(resource=self.resource).set(self.waiting)
+
+    async def acquire(self, account_id: Optional[str] = None) -> Slot:
+        """Wait for a slot, queued behind the other waiters of the same account."""
+        if self.in_use < self.capacity and not self.waiting:
+            self.in_use += 1
+            self._export()
+            return Slot(self)
+
+        account = account_id or ANONYMOUS_ACCOUNT
+        waiter = asyncio.get_running_loop().create_future()
+        if account not in self._queues:
+            self._queues[account] = deque()
+            self._turns.append(account)
+        self._queues[account].append(waiter)
+        self.waiting += 1
+        self._export()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted as the waiter was cancelled; pass it on
+                self._release()
+            else:
+                self._discard(account, waiter)
+            raise
+        return Slot(self)
+
+    def _discard(self, account: str, waiter: asyncio.Future):
+        queue = self._queues.get(account)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.waiting -= 1
+        if not queue:
+            del self._queues[account]
+            self._turns.remove(account)
+        self._export()
+
+    def _release(self):
+        # Hand the slot to the next account in turn instead of freeing it, so it cannot be taken out of order
+        while self._turns:
+            account = self._turns.popleft()
+            queue = self._queues[account]
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self._turns.append(account)
+            else:
+                del self._queues[account]
+            if not waiter.done():
+                waiter.set_result(None)
+                self._export()
+                return
+        self.in_use -= 1
+        self._export()
+
+
+class ResourceScheduler:
+    """Slot pools of the resource classes of one worker process."""
+
+    def __init__(self):
+        self._pools: Dict[str, SlotPool] = {}
+        self._provider_slots = _parse_provider_slots(config.SCHEDULER_LLM_PROVIDER_SLOTS)
+        self.active_runs = 0
+
+    def _capacity(self, resource: str) -> int:
+        if resource.startswith(f"{LLM_RESOURCE_PREFIX}:"):
+            provider = resource.split(":", 1)[1]
+            return self._provider_slots.get(provider, config.SCHEDULER_LLM_SLOTS_PER_PROVIDER)
+        if resource == SANDBOX_RESOURCE:
+            return config.SCHEDULER_SANDBOX_SLOTS
+        if resource == BROWSER_RESOURCE:
+            return config.SCHEDULER_BROWSER_SLOTS
+        if resource == MCP_RESOURCE:
+            return config.SCHEDULER_MCP_SLOTS
+        return config.SCHEDULER_DEFAULT_SLOTS
+
+    def pool(self, resource: str) -> SlotPool:
+        if resource not in self._pools:
+            self._pools[resource] = SlotPool(resource, max(1, self._capacity(resource)))
+        return self._pools[resource]
+
+    async def acquire(self, resource: str) -> Slot:
+        """Wait for a slot of a resource class for the account bound to the current run."""
+        return await self.pool(resource).acquire(_current_account.get())
+
+    @asynccontextmanager
+    async def slot(self, resource: Optional[str]) -> AsyncIterator[None]:
+        """Hold a slot of a resource class for the duration of the block; None holds nothing."""
+        if resource is None:
+            yield
+            return
+        held = await self.acquire(resource)
+        try:
+            yield
+        finally:
+            held.release()
+
+    async def hold_while_streaming(self, slot: Slot, stream: AsyncGenerator) -> AsyncGenerator:
+        """Yield from an LLM stream, releasing its slot once the stream is exhausted or closed.
+
+        A stream that is dropped without being closed only runs this cleanup
+        when it is garbage collected, so callers also release the slot once
+        they stop reading.
+        """
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            slot.release()
+
+    def run_started(self):
+        self.active_runs += 1
+        ACTIVE_RUNS.set(self.active_runs)
+
+    def run_finished(self):
+        self.active_runs = max(0, self.active_runs - 1)
+        ACTIVE_RUNS.set(self.active_runs)
+
+    def overload_reason(self, model_name: str) -> Optional[str]:
+        """Why a new run of the model should not start on this worker, or None if it can."""
+        if self.active_runs >= config.SCHEDULER_MAX_ACTIVE_RUNS:
+            return f"{self.active_runs} active runs"
+        llm_pool = self._pools.get(llm_resource(model_name))
+        if llm_pool and llm_pool.waiting >= llm_pool.capacity:
+            return f"{llm_pool.waiting} calls waiting for {llm_pool.resource}"
+        return None
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Usage of every pool, for logs and debugging."""
+        return {
+            resource: {"in_use": pool.in_use, "capacity": pool.capacity, "waiting": pool.waiting}
+            for resource, pool in self._pools.items()
+        }
+
+
+_scheduler: Optional[ResourceScheduler] = None
+
+
+def get_scheduler() -> ResourceScheduler:
+    """Get the process-wide ResourceScheduler instance."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ResourceScheduler()
+    return _scheduler
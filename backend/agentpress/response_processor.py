@@ -12,18 +12,22 @@ import json
 import re
 import uuid
 import asyncio
+import time
 from datetime import datetime, timezone
 from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple, Union, Callable, Literal
 from dataclasses import dataclass
 from utils.logger import logger
+from utils.metrics import LLM_TIME_TO_FIRST_TOKEN_SECONDS, TOOL_EXECUTION_SECONDS, TOOL_SLOT_WAIT_SECONDS
+from utils.tracing import end_span, span as tracing_span, start_span
 from agentpress.tool import ToolResult
 from agentpress.tool_registry import ToolRegistry
-from agentpress.xml_tool_parser import XMLToolParser
+from agentpress.resource_scheduler import MCP_RESOURCE, get_scheduler
+from agentpress.xml_tool_parser import XMLToolParser, XMLToolCallStream, XMLToolCall
 from langfuse.client import StatefulTraceClient
 from services.langfuse import langfuse
 from agentpress.utils.json_helpers import (
     ensure_dict, ensure_list, safe_json_parse, 
-    to_json_string, format_for_yield
+    to_json_string, format_for_yield, dumps
 )
 from litellm.utils import token_counter
 
@@ -86,7 +90,7 @@ class ProcessorConfig:
 class ResponseProcessor:
     """Processes LLM responses, extracting and executing tool calls."""
     
-    def __init__(self, tool_registry: ToolRegistry, add_message_callback: Callable, trace: Optional[StatefulTraceClient] = None, is_agent_builder: bool = False, target_agent_id: Optional[str] = None, agent_config: Optional[dict] = None):
+    def __init__(self, tool_registry: ToolRegistry, add_message_callback: Callable, trace: Optional[StatefulTraceClient] = None, is_agent_builder: bool = False, target_agent_id: Optional[str] = None, agent_config: Optional[dict] = None, flush_messages_callback: Optional[Callable] = None):
         """Initialize the ResponseProcessor.
         
         Args:
@@ -94,9 +98,13 @@ class ResponseProcessor:
             add_message_callback: Callback function to add messages to the thread.
                 MUST return the full saved message object (dict) or None.
             agent_config: Optional agent configuration with version information
+            flush_messages_callback: Optional async callback that waits until messages
+                added through add_message_callback are persisted. Called once at the
+                end of each response when add_message_callback writes behind.
         """
         self.tool_registry = tool_registry
         self.add_message = add_message_callback
+        self.flush_messages = flush_messages_callback
         self.trace = trace or langfuse.trace(name="anonymous:response_processor")
         # Initialize the XML parser with backwards compatibility
         self.xml_parser = XMLToolParser(strict_mode=False)
@@ -104,6 +112,16 @@ class ResponseProcessor:
         self.target_agent_id = target_agent_id
         self.agent_config = agent_config
 
+    async def _flush_messages(self):
+        """Wait for write-behind messages to be persisted, if a flush callback is set."""
+        if not self.flush_messages:
+            return
+        try:
+            await self.flush_messages()
+        except Exception as e:
+            logger.error(f"Error flushing messages: {str(e)}", exc_info=True)
+            self.trace.event(name="error_flushing_messages", level="ERROR", status_message=(f"Error flushing messages: {str(e)}"))
+
     async def _yield_message(self, message_obj: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
         """Helper to yield a message with proper formatting.
         
@@ -161,7 +179,7 @@ class ResponseProcessor:
         """
         accumulated_content = ""
         tool_calls_buffer = {}
-        current_xml_content = ""
+        xml_stream = XMLToolCallStream(self.xml_parser, tag_matcher=self.tool_registry.get_xml_tag_matcher())
         xml_chunks_buffer = []
         pending_tool_executions = []
         yielded_tool_indices = set() # Stores indices of tools whose *status* has been yielded
@@ -173,6 +191,8 @@ class ResponseProcessor:
         has_printed_thinking_prefix = False # Flag for printing thinking prefix only once
         agent_should_terminate = False # Flag to track if a terminating tool has been executed
         complete_native_tool_calls = [] # Initialize early for use in assistant_response_end
+        stream_span = None # Span of the LLM stream in the run trace, if the run is sampled
+        cancelled = False # Set when the run is stopped while this response is being processed
 
         # Collect metadata for reconstructing LiteLLM response object
         streaming_metadata = {
@@ -192,6 +212,9 @@ class ResponseProcessor:
                    f"Execute on stream={config.execute_on_stream}, Strategy={config.tool_execution_strategy}")
 
         thread_run_id = str(uuid.uuid4())
+        # The metadata of streamed chunks is the same for the whole run, so it is serialized once
+        chunk_metadata = dumps({"stream_status": "chunk", "thread_run_id": thread_run_id})
+        tool_chunk_metadata = dumps({"thread_run_id": thread_run_id})
 
         try:
             # --- Save and Yield Start Events ---
@@ -212,11 +235,16 @@ class ResponseProcessor:
 
             __sequence = 0
 
+            stream_started = time.perf_counter()
+            stream_span = start_span("llm.stream", model=llm_model)
             async for chunk in llm_response:
                 # Extract streaming metadata from chunks
                 current_time = datetime.now(timezone.utc).timestamp()
                 if streaming_metadata["first_chunk_time"] is None:
                     streaming_metadata["first_chunk_time"] = current_time
+                    time_to_first_token = time.perf_counter() - stream_started
+                    LLM_TIME_TO_FIRST_TOKEN_SECONDS.labels(model=llm_model).observe(time_to_first_token)
+                    if stream_span: stream_span.attributes["time_to_first_token_ms"] = round(time_to_first_token * 1000, 1)
                 streaming_metadata["last_chunk_time"] = current_time
                 
                 # Extract metadata from chunk attributes
@@ -254,7 +282,6 @@ class ResponseProcessor:
                         chunk_content = delta.content
                         # print(chunk_content, end='', flush=True)
                         accumulated_content += chunk_content
-                        current_xml_content += chunk_content
 
                         if not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
                             # Yield ONLY content chunk (don't save)
@@ -263,8 +290,8 @@ class ResponseProcessor:
                                 "sequence": __sequence,
                                 "message_id": None, "thread_id": thread_id, "type": "assistant",
                                 "is_llm_message": True,
-                                "content": to_json_string({"role": "assistant", "content": chunk_content}),
-                                "metadata": to_json_string({"stream_status": "chunk", "thread_run_id": thread_run_id}),
+                                "content": dumps({"role": "assistant", "content": chunk_content}),
+                                "metadata": chunk_metadata,
                                 "created_at": now_chunk, "updated_at": now_chunk
                             }
                             __sequence += 1
@@ -274,11 +301,11 @@ class ResponseProcessor:
 
                         # --- Process XML Tool Calls (if enabled and limit not reached) ---
                         if config.xml_tool_calling and not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
-                            xml_chunks = self._extract_xml_chunks(current_xml_content)
-                            for xml_chunk in xml_chunks:
-                                current_xml_content = current_xml_content.replace(xml_chunk, "", 1)
+                            # Only the new delta is scanned; blocks are returned once their closing tag arrives
+                            for xml_block in xml_stream.feed(chunk_content):
+                                xml_chunk = xml_block.raw_xml
                                 xml_chunks_buffer.append(xml_chunk)
-                                result = self._parse_xml_tool_call(xml_chunk)
+                                result = self._parse_xml_tool_call(xml_chunk, xml_block.tool_calls)
                                 if result:
                                     tool_call, parsing_details = result
                                     xml_tool_call_count += 1
@@ -325,8 +352,8 @@ class ResponseProcessor:
                             now_tool_chunk = datetime.now(timezone.utc).isoformat()
                             yield {
                                 "message_id": None, "thread_id": thread_id, "type": "status", "is_llm_message": True,
-                                "content": to_json_string({"role": "assistant", "status_type": "tool_call_chunk", "tool_call_chunk": tool_call_data_chunk}),
-                                "metadata": to_json_string({"thread_run_id": thread_run_id}),
+                                "content": dumps({"role": "assistant", "status_type": "tool_call_chunk", "tool_call_chunk": tool_call_data_chunk}),
+                                "metadata": tool_chunk_metadata,
                                 "created_at": now_tool_chunk, "updated_at": now_tool_chunk
                             }
 
@@ -375,6 +402,8 @@ class ResponseProcessor:
                     self.trace.event(name="stopping_stream_processing_after_loop_due_to_xml_tool_call_limit", level="DEFAULT", status_message=(f"Stopping stream processing after loop due to XML tool call limit"))
                     break
 
+            end_span(stream_span)
+
             # print() # Add a final newline after the streaming loop finishes
 
             # --- After Streaming Loop ---
@@ -558,9 +587,7 @@ class ResponseProcessor:
                  # Gather XML tool calls from buffer (up to limit)
                 parsed_xml_data = []
                 if config.xml_tool_calling:
-                    # Reparse remaining content just in case (should be empty if processed correctly)
-                    xml_chunks = self._extract_xml_chunks(current_xml_content)
-                    xml_chunks_buffer.extend(xml_chunks)
+                    # Complete blocks were already collected by the stream tokenizer
                     # Process only chunks not already handled in the stream loop
                     remaining_limit = config.max_xml_tool_calls - xml_tool_call_count if config.max_xml_tool_calls > 0 else len(xml_chunks_buffer)
                     xml_chunks_to_process = xml_chunks_buffer[:remaining_limit] # Ensure limit is respected
@@ -794,6 +821,16 @@ class ResponseProcessor:
                     logger.error(f"Error saving assistant response end for stream: {str(e)}")
                     self.trace.event(name="error_saving_assistant_response_end_for_stream", level="ERROR", status_message=(f"Error saving assistant response end for stream: {str(e)}"))
 
+        except (asyncio.CancelledError, GeneratorExit):
+            # The run was stopped: abandon the tools still executing instead of waiting for them
+            cancelled = True
+            still_running = [execution["task"] for execution in pending_tool_executions if not execution["task"].done()]
+            for task in still_running:
+                task.cancel()
+            logger.info(f"Stream processing cancelled, {len(still_running)} tool executions cancelled")
+            self.trace.event(name="stream_processing_cancelled", level="WARNING", status_message=(f"Stream processing cancelled, {len(still_running)} tool executions cancelled"))
+            raise
+
         except Exception as e:
             logger.error(f"Error processing stream: {str(e)}", exc_info=True)
             self.trace.event(name="error_processing_stream", level="ERROR", status_message=(f"Error processing stream: {str(e)}"))
@@ -811,6 +848,8 @@ class ResponseProcessor:
             raise # Use bare 'raise' to preserve the original exception with its traceback
 
         finally:
+            if stream_span is not None and stream_span.end is None:
+                end_span(stream_span)
             # Save and Yield the final thread_run_end status
             try:
                 end_content = {"status_type": "thread_run_end"}
@@ -818,7 +857,10 @@ class ResponseProcessor:
                     thread_id=thread_id, type="status", content=end_content, 
                     is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
                 )
-                if end_msg_obj: yield format_for_yield(end_msg_obj)
+                # Barrier: everything saved during this response is persisted before the run ends
+                await self._flush_messages()
+                # A cancelled generator must not yield again, or the cancellation would be swallowed
+                if end_msg_obj and not cancelled: yield format_for_yield(end_msg_obj)
             except Exception as final_e:
                 logger.error(f"Error in finally block: {str(final_e)}", exc_info=True)
                 self.trace.event(name="error_in_finally_block", level="ERROR", status_message=(f"Error in finally block: {str(final_e)}"))
@@ -851,6 +893,7 @@ class ResponseProcessor:
         tool_result_message_objects = {}
         finish_reason = None
         native_tool_calls_for_message = []
+        cancelled = False # Set when the run is stopped while this response is being processed
 
         try:
             # Save and Yield thread_run_start status message
@@ -993,6 +1036,12 @@ class ResponseProcessor:
                     logger.error(f"Error saving assistant response end for non-stream: {str(e)}")
                     self.trace.event(name="error_saving_assistant_response_end_for_non_stream", level="ERROR", status_message=(f"Error saving assistant response end for non-stream: {str(e)}"))
 
+        except (asyncio.CancelledError, GeneratorExit):
+            # Parallel tool executions are cancelled by asyncio.gather along with this task
+            cancelled = True
+            logger.info("Non-streaming response processing cancelled")
+            raise
+
         except Exception as e:
              logger.error(f"Error processing non-streaming response: {str(e)}", exc_info=True)
              self.trace.event(name="error_processing_non_streaming_response", level="ERROR", status_message=(f"Error processing non-streaming response: {str(e)}"))
@@ -1016,7 +1065,10 @@ class ResponseProcessor:
                 thread_id=thread_id, type="status", content=end_content, 
                 is_llm_message=False, metadata={"thread_run_id": thread_run_id if 'thread_run_id' in locals() else None}
             )
-            if end_msg_obj: yield format_for_yield(end_msg_obj)
+            # Barrier: everything saved during this response is persisted before the run ends
+            await self._flush_messages()
+            # A cancelled generator must not yield again, or the cancellation would be swallowed
+            if end_msg_obj and not cancelled: yield format_for_yield(end_msg_obj)
 
     # XML parsing methods
     def _extract_tag_content(self, xml_chunk: str, tag_name: str) -> Tuple[Optional[str], Optional[str]]:
@@ -1094,100 +1146,30 @@ class ResponseProcessor:
             return None
 
     def _extract_xml_chunks(self, content: str) -> List[str]:
-        """Extract complete XML chunks using start and end pattern matching."""
-        chunks = []
-        pos = 0
-        
+        """Extract complete XML chunks using the incremental tool call tokenizer."""
         try:
-            # First, look for new format <function_calls> blocks
-            start_pattern = '<function_calls>'
-            end_pattern = '</function_calls>'
-            
-            while pos < len(content):
-                # Find the next function_calls block
-                start_pos = content.find(start_pattern, pos)
-                if start_pos == -1:
-                    break
-                
-                # Find the matching end tag
-                end_pos = content.find(end_pattern, start_pos)
-                if end_pos == -1:
-                    break
-                
-                # Extract the complete block including tags
-                chunk_end = end_pos + len(end_pattern)
-                chunk = content[start_pos:chunk_end]
-                chunks.append(chunk)
-                
-                # Move position past this chunk
-                pos = chunk_end
-            
-            # If no new format found, fall back to old format for backwards compatibility
-            if not chunks:
-                pos = 0
-                while pos < len(content):
-                    # Find the next tool tag
-                    next_tag_start = -1
-                    current_tag = None
-                    
-                    # Find the earliest occurrence of any registered tag
-                    for tag_name in self.tool_registry.xml_tools.keys():
-                        start_pattern = f'<{tag_name}'
-                        tag_pos = content.find(start_pattern, pos)
-                        
-                        if tag_pos != -1 and (next_tag_start == -1 or tag_pos < next_tag_start):
-                            next_tag_start = tag_pos
-                            current_tag = tag_name
-                    
-                    if next_tag_start == -1 or not current_tag:
-                        break
-                    
-                    # Find the matching end tag
-                    end_pattern = f'</{current_tag}>'
-                    tag_stack = []
-                    chunk_start = next_tag_start
-                    current_pos = next_tag_start
-                    
-                    while current_pos < len(content):
-                        # Look for next start or end tag of the same type
-                        next_start = content.find(f'<{current_tag}', current_pos + 1)
-                        next_end = content.find(end_pattern, current_pos)
-                        
-                        if next_end == -1:  # No closing tag found
-                            break
-                        
-                        if next_start != -1 and next_start < next_end:
-                            # Found nested start tag
-                            tag_stack.append(next_start)
-                            current_pos = next_start + 1
-                        else:
-                            # Found end tag
-                            if not tag_stack:  # This is our matching end tag
-                                chunk_end = next_end + len(end_pattern)
-                                chunk = content[chunk_start:chunk_end]
-                                chunks.append(chunk)
-                                pos = chunk_end
-                                break
-                            else:
-                                # Pop nested tag
-                                tag_stack.pop()
-                                current_pos = next_end + 1
-                    
-                    if current_pos >= len(content):  # Reached end without finding closing tag
-                        break
-                    
-                    pos = max(pos + 1, current_pos)
+            xml_stream = XMLToolCallStream(self.xml_parser, tag_matcher=self.tool_registry.get_xml_tag_matcher())
+            blocks = xml_stream.feed(content)
+
+            # Legacy tags are only used for backwards compatibility when no new format block is found
+            function_call_blocks = [block.raw_xml for block in blocks if block.legacy_tag is None]
+            if function_call_blocks:
+                return function_call_blocks
+            return [block.raw_xml for block in blocks]
         
         except Exception as e:
             logger.error(f"Error extracting XML chunks: {e}")
             logger.error(f"Content was: {content}")
             self.trace.event(name="error_extracting_xml_chunks", level="ERROR", status_message=(f"Error extracting XML chunks: {e}"), metadata={"content": content})
-        
-        return chunks
+            return []
 
-    def _parse_xml_tool_call(self, xml_chunk: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    def _parse_xml_tool_call(self, xml_chunk: str, parsed_calls: Optional[List[XMLToolCall]] = None) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
         """Parse XML chunk into tool call format and return parsing details.
         
+        Args:
+            xml_chunk: The raw XML chunk
+            parsed_calls: Tool calls already parsed from the chunk by XMLToolCallStream, if any
+
         Returns:
             Tuple of (tool_call, parsing_details) or None if parsing fails.
             - tool_call: Dict with 'function_name', 'xml_tag_name', 'arguments'
@@ -1196,8 +1178,9 @@ class ResponseProcessor:
         try:
             # Check if this is the new format (contains <function_calls>)
             if '<function_calls>' in xml_chunk and '<invoke' in xml_chunk:
-                # Use the new XML parser
-                parsed_calls = self.xml_parser.parse_content(xml_chunk)
+                # Use the new XML parser unless the stream tokenizer already parsed the chunk
+                if not parsed_calls:
+                    parsed_calls = self.xml_parser.parse_content(xml_chunk)
                 
                 if not parsed_calls:
                     logger.error(f"No tool calls found in XML chunk: {xml_chunk}")
@@ -1343,6 +1326,12 @@ class ResponseProcessor:
         return parsed_data
 
     # Tool execution methods
+    def _tool_resource(self, function_name: str, tool_fn: Callable) -> Optional[str]:
+        """Get the scheduler resource class of a tool function, if its tool has one."""
+        # Dynamic MCP methods are plain functions, so fall back to the instance they were registered with
+        tool_instance = getattr(tool_fn, '__self__', None) or self.tool_registry.tools.get(function_name, {}).get('instance')
+        return getattr(tool_instance, 'resource_class', None)
+
     async def _execute_tool(self, tool_call: Dict[str, Any]) -> ToolResult:
         """Execute a single tool call and return the result."""
         span = self.trace.span(name=f"execute_tool.{tool_call['function_name']}", input=tool_call["arguments"])            
@@ -1370,7 +1359,24 @@ class ResponseProcessor:
                 return ToolResult(success=False, output=f"Tool function '{function_name}' not found")
             
             logger.debug(f"Found tool function for '{function_name}', executing...")
-            result = await tool_fn(**arguments)
+            # Sandbox, browser and MCP calls wait for a slot of their resource class on this worker
+            resource = self._tool_resource(function_name, tool_fn)
+            tool_label = MCP_RESOURCE if resource == MCP_RESOURCE else function_name
+            waiting_since = time.perf_counter()
+            started = None
+            try:
+                with tracing_span(f"{resource or 'tool'}.{function_name}"):
+                    async with get_scheduler().slot(resource):
+                        started = time.perf_counter()
+                        if resource:
+                            TOOL_SLOT_WAIT_SECONDS.labels(resource=resource).observe(started - waiting_since)
+                        result = await tool_fn(**arguments)
+            except Exception:
+                if started is not None:
+                    TOOL_EXECUTION_SECONDS.labels(tool=tool_label, success="false").observe(time.perf_counter() - started)
+                raise
+            success = getattr(result, 'success', True)
+            TOOL_EXECUTION_SECONDS.labels(tool=tool_label, success=str(bool(success)).lower()).observe(time.perf_counter() - started)
             logger.info(f"Tool execution complete: {function_name} -> {result}")
             span.end(status_message="tool_executed", output=result)
             return result
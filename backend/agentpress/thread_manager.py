@@ -10,22 +10,30 @@ This module provides comprehensive conversation management, including:
 - Context summarization to manage token limits
 """
 
-import json
+from contextlib import aclosing
+from functools import partial
 from typing import List, Dict, Any, Optional, Type, Union, AsyncGenerator, Literal, cast
 from services.llm import make_llm_api_call
 from agentpress.tool import Tool
 from agentpress.tool_registry import ToolRegistry
 from agentpress.context_manager import ContextManager
+from agentpress.message_cache import get_message_cache
+from agentpress.message_writer import MessageWriter
+from agentpress.token_cache import get_token_cache
+from agentpress.thread_state import record_message
+from agentpress.resource_scheduler import Slot, get_scheduler, llm_resource
 from agentpress.response_processor import (
     ResponseProcessor,
     ProcessorConfig
 )
 from services.supabase import DBConnection
+from services.billing import record_usage
 from utils.logger import logger
+from utils.metrics import AUTO_CONTINUES, COMPRESS_MESSAGES_SECONDS, observe
+from utils.tracing import span
 from langfuse.client import StatefulGenerationClient, StatefulTraceClient
 from services.langfuse import langfuse
 import datetime
-from litellm.utils import token_counter
 
 # Type alias for tool choice
 ToolChoice = Literal["auto", "required", "none"]
@@ -48,6 +56,7 @@ class ThreadManager:
             agent_config: Optional agent configuration with version information
         """
         self.db = DBConnection()
+        self.message_writer = MessageWriter(self.db)
         self.tool_registry = ToolRegistry()
         self.trace = trace
         self.is_agent_builder = is_agent_builder
@@ -57,13 +66,20 @@ class ThreadManager:
             self.trace = langfuse.trace(name="anonymous:thread_manager")
         self.response_processor = ResponseProcessor(
             tool_registry=self.tool_registry,
-            add_message_callback=self.add_message,
+            add_message_callback=partial(self.add_message, defer=True),
+            flush_messages_callback=self.message_writer.flush,
             trace=self.trace,
             is_agent_builder=self.is_agent_builder,
             target_agent_id=self.target_agent_id,
             agent_config=self.agent_config
         )
         self.context_manager = ContextManager()
+        self.message_cache = get_message_cache()
+        self.token_cache = get_token_cache()
+        # Threads whose cached LLM messages are known to be current for this manager
+        self._synced_threads = set()
+        # Owner, project and creation time of threads, used to record usage in the ledger and spend counter
+        self._thread_billing_info: Dict[str, Dict[str, Any]] = {}
 
     def add_tool(self, tool_class: Type[Tool], function_names: Optional[List[str]] = None, **kwargs):
         """Add a tool to the ThreadManager."""
@@ -77,7 +93,8 @@ class ThreadManager:
         is_llm_message: bool = False,
         metadata: Optional[Dict[str, Any]] = None,
         agent_id: Optional[str] = None,
-        agent_version_id: Optional[str] = None
+        agent_version_id: Optional[str] = None,
+        defer: bool = False
     ):
         """Add a message to the thread in the database.
 
@@ -92,6 +109,9 @@ class ThreadManager:
                       Defaults to None, stored as an empty JSONB object if None.
             agent_id: Optional ID of the agent associated with this message.
             agent_version_id: Optional ID of the specific agent version used.
+            defer: Queue the insert on the write-behind message writer and return
+                   immediately with a client-assigned message_id. Deferred messages
+                   are persisted by the next flush of self.message_writer.
         """
         logger.debug(f"Adding message of type '{type}' to thread {thread_id} (agent: {agent_id}, version: {agent_version_id})")
         client = await self.db.client
@@ -111,12 +131,29 @@ class ThreadManager:
         if agent_version_id:
             data_to_insert['agent_version_id'] = agent_version_id
 
+        if is_llm_message:
+            # Force the next get_llm_messages to fetch rows past the cache watermark
+            self._synced_threads.discard(thread_id)
+
+        if defer:
+            on_persisted = None
+            if type == 'assistant_response_end' and isinstance(content, dict):
+                # Usage is only billed once the message exists, and off the streaming path
+                async def on_persisted(row: Dict[str, Any]):
+                    await self._record_usage(client, thread_id, row['message_id'], row.get('created_at'), content)
+            message = self.message_writer.enqueue(data_to_insert, on_persisted=on_persisted)
+            await self._record_head(thread_id, type, message['message_id'])
+            return message
+
         try:
             # Insert the message and get the inserted row data including the id
             result = await client.table('messages').insert(data_to_insert).execute()
             logger.info(f"Successfully added message to thread {thread_id}")
 
             if result.data and len(result.data) > 0 and isinstance(result.data[0], dict) and 'message_id' in result.data[0]:
+                await self._record_head(thread_id, type, result.data[0]['message_id'])
+                if type == 'assistant_response_end' and isinstance(content, dict):
+                    await self._record_usage(client, thread_id, result.data[0]['message_id'], result.data[0].get('created_at'), content)
                 return result.data[0]
             else:
                 logger.error(f"Insert operation failed or did not return expected data structure for thread {thread_id}. Result data: {result.data}")
@@ -125,65 +162,65 @@ class ThreadManager:
             logger.error(f"Failed to add message to thread {thread_id}: {str(e)}", exc_info=True)
             raise
 
+    async def _record_head(self, thread_id: str, type: str, message_id: str):
+        """Keep the cached thread head that the agent loop reads in step with the new message."""
+        try:
+            await record_message(thread_id, type, message_id)
+        except Exception as e:
+            logger.warning(f"Failed to update thread head of {thread_id}: {str(e)}")
+
+    def set_thread_billing_info(self, thread: Dict[str, Any]):
+        """Set the thread_id, account_id, project_id and created_at of a thread,
+        so recording its usage does not look the thread up again."""
+        self._thread_billing_info[thread['thread_id']] = thread
+
+    async def _record_usage(self, client, thread_id: str, message_id: str, created_at: Optional[str], content: Dict[str, Any]):
+        """Record an LLM response in the usage ledger and the owning account's running monthly spend."""
+        try:
+            thread = self._thread_billing_info.get(thread_id)
+            if thread is None:
+                result = await client.table('threads').select('thread_id, account_id, project_id, created_at').eq('thread_id', thread_id).limit(1).execute()
+                if not result.data:
+                    return
+                thread = result.data[0]
+                self._thread_billing_info[thread_id] = thread
+            await record_usage(client, thread, message_id, created_at, content)
+        except Exception as e:
+            logger.warning(f"Failed to record usage for thread {thread_id}: {str(e)}")
+
     async def get_llm_messages(self, thread_id: str) -> List[Dict[str, Any]]:
         """Get all messages for a thread.
 
-        This method uses the SQL function which handles context truncation
-        by considering summary messages.
+        Messages are served from the incremental message cache, which only
+        fetches rows created after its watermark. Threads with a summary are
+        loaded from the latest summary message onwards. The first call for a thread
+        on this manager always checks the database for new rows, later calls
+        only do so after add_message stored a new LLM message.
 
         Args:
             thread_id: The ID of the thread to get messages for.
 
         Returns:
             List of message objects.
+
+        Raises:
+            RuntimeError: If deferred messages of this manager could not be persisted.
         """
         logger.debug(f"Getting messages for thread {thread_id}")
         client = await self.db.client
 
+        # Make sure deferred messages of this manager are visible. A failed flush
+        # propagates: the context would otherwise silently differ from the stored thread.
         try:
-            # result = await client.rpc('get_llm_formatted_messages', {'p_thread_id': thread_id}).execute()
-            
-            # Fetch messages in batches of 1000 to avoid overloading the database
-            all_messages = []
-            batch_size = 1000
-            offset = 0
-            
-            while True:
-                result = await client.table('messages').select('message_id, content').eq('thread_id', thread_id).eq('is_llm_message', True).order('created_at').range(offset, offset + batch_size - 1).execute()
-                
-                if not result.data or len(result.data) == 0:
-                    break
-                    
-                all_messages.extend(result.data)
-                
-                # If we got fewer than batch_size records, we've reached the end
-                if len(result.data) < batch_size:
-                    break
-                    
-                offset += batch_size
-            
-            # Use all_messages instead of result.data in the rest of the method
-            result_data = all_messages
-
-            # Parse the returned data which might be stringified JSON
-            if not result_data:
-                return []
-
-            # Return properly parsed JSON objects
-            messages = []
-            for item in result_data:
-                if isinstance(item['content'], str):
-                    try:
-                        parsed_item = json.loads(item['content'])
-                        parsed_item['message_id'] = item['message_id']
-                        messages.append(parsed_item)
-                    except json.JSONDecodeError:
-                        logger.error(f"Failed to parse message: {item['content']}")
-                else:
-                    content = item['content']
-                    content['message_id'] = item['message_id']
-                    messages.append(content)
+            await self.message_writer.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush pending messages for thread {thread_id}: {str(e)}")
+            raise
 
+        try:
+            refresh = thread_id not in self._synced_threads
+            messages = await self.message_cache.get_messages(client, thread_id, refresh=refresh)
+            self._synced_threads.add(thread_id)
             return messages
 
         except Exception as e:
@@ -254,8 +291,8 @@ class ThreadManager:
 
         # Add XML examples to system prompt if requested, do this only ONCE before the loop
         if include_xml_examples and config.xml_tool_calling:
-            xml_examples = self.tool_registry.get_xml_examples()
-            if xml_examples:
+            schema_bundle = self.tool_registry.get_schema_bundle()
+            if schema_bundle.xml_examples:
                 examples_content = """
 --- XML TOOL CALLING ---
 
@@ -266,8 +303,7 @@ Note that spaces for string values are not stripped. The output is parsed with r
 
 Here are the XML tools available with examples:
 """
-                for tag_name, example in xml_examples.items():
-                    examples_content += f"<{tag_name}> Example: {example}\\n"
+                examples_content += schema_bundle.xml_examples_text
 
                 # # Save examples content to a file
                 # try:
@@ -297,6 +333,14 @@ Here are the XML tools available with examples:
         # Control whether we need to auto-continue due to tool_calls finish reason
         auto_continue = True
         auto_continue_count = 0
+        # LLM slots taken by this run. Streams release theirs once consumed, but a
+        # consumer that is cancelled or drops the stream never closes it, so the
+        # generators returned below also release them in their finally.
+        llm_slots: List[Slot] = []
+
+        def release_llm_slots():
+            while llm_slots:
+                llm_slots.pop().release()
 
         # Define inner function to handle a single run
         async def _run_once(temp_msg=None):
@@ -312,7 +356,7 @@ Here are the XML tools available with examples:
                 token_count = 0
                 try:
                     # Use the potentially modified working_system_prompt for token counting
-                    token_count = token_counter(model=llm_model, messages=[working_system_prompt] + messages)
+                    token_count = self.token_cache.total([working_system_prompt] + messages, llm_model)
                     token_threshold = self.context_manager.token_threshold
                     logger.info(f"Thread {thread_id} token count: {token_count}/{token_threshold} ({(token_count/token_threshold)*100:.1f}%)")
 
@@ -345,10 +389,13 @@ Here are the XML tools available with examples:
                 # 4. Prepare tools for LLM call
                 openapi_tool_schemas = None
                 if config.native_tool_calling:
-                    openapi_tool_schemas = self.tool_registry.get_openapi_schemas()
-                    logger.debug(f"Retrieved {len(openapi_tool_schemas) if openapi_tool_schemas else 0} OpenAPI tool schemas")
+                    # Cached until tools are registered again, so this is free after the first call
+                    schema_bundle = self.tool_registry.get_schema_bundle()
+                    openapi_tool_schemas = schema_bundle.openapi_schemas
+                    logger.debug(f"Using {len(openapi_tool_schemas)} OpenAPI tool schemas (bundle v{schema_bundle.version}, {schema_bundle.token_count(llm_model)} tokens)")
 
-                prepared_messages = self.context_manager.compress_messages(prepared_messages, llm_model)
+                with observe(COMPRESS_MESSAGES_SECONDS, model=llm_model), span("context.compress", model=llm_model):
+                    prepared_messages = self.context_manager.compress_messages(prepared_messages, llm_model)
 
                 # 5. Make LLM API call
                 logger.debug("Making LLM API call")
@@ -367,17 +414,31 @@ Here are the XML tools available with examples:
                               "tools": openapi_tool_schemas,
                             }
                         )
-                    llm_response = await make_llm_api_call(
-                        prepared_messages, # Pass the potentially modified messages
-                        llm_model,
-                        temperature=llm_temperature,
-                        max_tokens=llm_max_tokens,
-                        tools=openapi_tool_schemas,
-                        tool_choice=tool_choice if config.native_tool_calling else "none",
-                        stream=stream,
-                        enable_thinking=enable_thinking,
-                        reasoning_effort=reasoning_effort
-                    )
+                    # Wait for an LLM slot of the model's provider on this worker
+                    scheduler = get_scheduler()
+                    with span("scheduler.wait", resource=llm_resource(llm_model)):
+                        llm_slot = await scheduler.acquire(llm_resource(llm_model))
+                    llm_slots.append(llm_slot)
+                    try:
+                        llm_response = await make_llm_api_call(
+                            prepared_messages, # Pass the potentially modified messages
+                            llm_model,
+                            temperature=llm_temperature,
+                            max_tokens=llm_max_tokens,
+                            tools=openapi_tool_schemas,
+                            tool_choice=tool_choice if config.native_tool_calling else "none",
+                            stream=stream,
+                            enable_thinking=enable_thinking,
+                            reasoning_effort=reasoning_effort
+                        )
+                    except BaseException:
+                        llm_slot.release()
+                        raise
+                    # A stream keeps its slot until it has been consumed; a complete response frees it now
+                    if hasattr(llm_response, '__aiter__'):
+                        llm_response = scheduler.hold_while_streaming(llm_slot, llm_response)
+                    else:
+                        llm_slot.release()
                     logger.debug("Successfully received raw LLM API response stream/object")
 
                 except Exception as e:
@@ -432,82 +493,102 @@ Here are the XML tools available with examples:
         async def auto_continue_wrapper():
             nonlocal auto_continue, auto_continue_count
 
-            while auto_continue and (native_max_auto_continues == 0 or auto_continue_count < native_max_auto_continues):
-                # Reset auto_continue for this iteration
-                auto_continue = False
-
-                # Run the thread once, passing the potentially modified system prompt
-                # Pass temp_msg only on the first iteration
-                try:
-                    response_gen = await _run_once(temporary_message if auto_continue_count == 0 else None)
-
-                    # Handle error responses
-                    if isinstance(response_gen, dict) and "status" in response_gen and response_gen["status"] == "error":
-                        logger.error(f"Error in auto_continue_wrapper: {response_gen.get('message', 'Unknown error')}")
-                        yield response_gen
-                        return  # Exit the generator on error
+            try:
+                while auto_continue and (native_max_auto_continues == 0 or auto_continue_count < native_max_auto_continues):
+                    # Reset auto_continue for this iteration
+                    auto_continue = False
 
-                    # Process each chunk
+                    # Run the thread once, passing the potentially modified system prompt
+                    # Pass temp_msg only on the first iteration
                     try:
-                        if hasattr(response_gen, '__aiter__'):
-                            async for chunk in cast(AsyncGenerator, response_gen):
-                                # Check if this is a finish reason chunk with tool_calls or xml_tool_limit_reached
-                                if chunk.get('type') == 'finish':
-                                    if chunk.get('finish_reason') == 'tool_calls':
-                                        # Only auto-continue if enabled (max > 0)
-                                        if native_max_auto_continues > 0:
-                                            logger.info(f"Detected finish_reason='tool_calls', auto-continuing ({auto_continue_count + 1}/{native_max_auto_continues})")
-                                            auto_continue = True
-                                            auto_continue_count += 1
-                                            # Don't yield the finish chunk to avoid confusing the client
-                                            continue
-                                    elif chunk.get('finish_reason') == 'xml_tool_limit_reached':
-                                        # Don't auto-continue if XML tool limit was reached
-                                        logger.info(f"Detected finish_reason='xml_tool_limit_reached', stopping auto-continue")
-                                        auto_continue = False
-                                        # Still yield the chunk to inform the client
-
-                                # Otherwise just yield the chunk normally
-                                yield chunk
-                        else:
-                            # response_gen is not iterable (likely an error dict), yield it directly
-                            yield response_gen
+                        response_gen = await _run_once(temporary_message if auto_continue_count == 0 else None)
 
-                        # If not auto-continuing, we're done
-                        if not auto_continue:
-                            break
-                    except Exception as e:
-                        # If there's an exception, log it, yield an error status, and stop execution
-                        logger.error(f"Error in auto_continue_wrapper generator: {str(e)}", exc_info=True)
+                        # Handle error responses
+                        if isinstance(response_gen, dict) and "status" in response_gen and response_gen["status"] == "error":
+                            logger.error(f"Error in auto_continue_wrapper: {response_gen.get('message', 'Unknown error')}")
+                            yield response_gen
+                            return  # Exit the generator on error
+
+                        # Process each chunk
+                        try:
+                            if hasattr(response_gen, '__aiter__'):
+                                async with aclosing(response_gen):
+                                    async for chunk in cast(AsyncGenerator, response_gen):
+                                        # Check if this is a finish reason chunk with tool_calls or xml_tool_limit_reached
+                                        if chunk.get('type') == 'finish':
+                                            if chunk.get('finish_reason') == 'tool_calls':
+                                                # Only auto-continue if enabled (max > 0)
+                                                if native_max_auto_continues > 0:
+                                                    logger.info(f"Detected finish_reason='tool_calls', auto-continuing ({auto_continue_count + 1}/{native_max_auto_continues})")
+                                                    auto_continue = True
+                                                    auto_continue_count += 1
+                                                    AUTO_CONTINUES.labels(reason="tool_calls").inc()
+                                                    # Don't yield the finish chunk to avoid confusing the client
+                                                    continue
+                                            elif chunk.get('finish_reason') == 'xml_tool_limit_reached':
+                                                # Don't auto-continue if XML tool limit was reached
+                                                logger.info(f"Detected finish_reason='xml_tool_limit_reached', stopping auto-continue")
+                                                auto_continue = False
+                                                # Still yield the chunk to inform the client
+
+                                        # Otherwise just yield the chunk normally
+                                        yield chunk
+                                # The response is processed, even if its stream was not read to the end
+                                release_llm_slots()
+                            else:
+                                # response_gen is not iterable (likely an error dict), yield it directly
+                                yield response_gen
+
+                            # If not auto-continuing, we're done
+                            if not auto_continue:
+                                break
+                        except Exception as e:
+                            # If there's an exception, log it, yield an error status, and stop execution
+                            logger.error(f"Error in auto_continue_wrapper generator: {str(e)}", exc_info=True)
+                            yield {
+                                "type": "status",
+                                "status": "error",
+                                "message": f"Error in thread processing: {str(e)}"
+                            }
+                            return  # Exit the generator on any error
+                    except Exception as outer_e:
+                        # Catch exceptions from _run_once itself
+                        logger.error(f"Error executing thread: {str(outer_e)}", exc_info=True)
                         yield {
                             "type": "status",
                             "status": "error",
-                            "message": f"Error in thread processing: {str(e)}"
+                            "message": f"Error executing thread: {str(outer_e)}"
                         }
-                        return  # Exit the generator on any error
-                except Exception as outer_e:
-                    # Catch exceptions from _run_once itself
-                    logger.error(f"Error executing thread: {str(outer_e)}", exc_info=True)
+                        return  # Exit immediately on exception from _run_once
+
+                # If we've reached the max auto-continues, log a warning
+                if auto_continue and auto_continue_count >= native_max_auto_continues:
+                    logger.warning(f"Reached maximum auto-continue limit ({native_max_auto_continues}), stopping.")
                     yield {
-                        "type": "status",
-                        "status": "error",
-                        "message": f"Error executing thread: {str(outer_e)}"
+                        "type": "content",
+                        "content": f"\n[Agent reached maximum auto-continue limit of {native_max_auto_continues}]"
                     }
-                    return  # Exit immediately on exception from _run_once
-
-            # If we've reached the max auto-continues, log a warning
-            if auto_continue and auto_continue_count >= native_max_auto_continues:
-                logger.warning(f"Reached maximum auto-continue limit ({native_max_auto_continues}), stopping.")
-                yield {
-                    "type": "content",
-                    "content": f"\n[Agent reached maximum auto-continue limit of {native_max_auto_continues}]"
-                }
+            finally:
+                release_llm_slots()
 
         # If auto-continue is disabled (max=0), just run once
         if native_max_auto_continues == 0:
             logger.info("Auto-continue is disabled (native_max_auto_continues=0)")
             # Pass the potentially modified system prompt and temp message
-            return await _run_once(temporary_message)
+            response_gen = await _run_once(temporary_message)
+            if not hasattr(response_gen, '__aiter__'):
+                release_llm_slots()
+                return response_gen
+
+            async def run_once_wrapper():
+                try:
+                    async with aclosing(response_gen):
+                        async for chunk in response_gen:
+                            yield chunk
+                finally:
+                    release_llm_slots()
+
+            return run_once_wrapper()
 
         # Otherwise return the auto-continue wrapper generator
         return auto_continue_wrapper()
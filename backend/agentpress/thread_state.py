@@ -0,0 +1,192 @@
+"""
+Thread head: the latest messages of a thread that steer the agent loop.
+
+Every iteration of the agent loop needs to know whether the thread's last
+turn was an assistant message, whether the browser state changed and whether
+a tool left an image for the model to look at. These used to be three
+`select('*')` queries per iteration, one of them returning the full DOM of
+the browser state.
+
+The thread head holds only the ids the loop needs:
+
+- turn_type / turn_message_id: the latest assistant, tool or user message
+- browser_state_id: the latest browser_state message
+- image_context_id: the latest image_context message that was not consumed yet
+
+It is loaded with the get_thread_head RPC and cached in the Redis hash
+thread_head:{thread_id}, which ThreadManager.add_message keeps up to date as
+the run writes messages. Messages can also be written outside a run (the
+frontend inserts user messages directly), so each run seeds the cache from
+the database on its first iteration instead of trusting a cached head.
+"""
+
+import json
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+from services import redis
+from utils.logger import logger
+
+HEAD_KEY_PREFIX = "thread_head"
+HEAD_TTL = 3600 * 24
+
+TURN_TYPES = ('assistant', 'tool', 'user')
+
+# Only heads written by seed_thread_head are complete; add_message updates alone are not
+SEEDED_FIELD = "seeded"
+
+
+def thread_head_key(thread_id: str) -> str:
+    return f"{HEAD_KEY_PREFIX}:{thread_id}"
+
+
+@dataclass
+class ThreadHead:
+    """Ids of the latest messages of a thread that the agent loop reads."""
+    turn_type: Optional[str] = None
+    turn_message_id: Optional[str] = None
+    browser_state_id: Optional[str] = None
+    image_context_id: Optional[str] = None
+
+    @classmethod
+    def from_rpc(cls, data: Optional[Dict[str, Any]]) -> "ThreadHead":
+        data = data or {}
+        turn = data.get('turn') or {}
+        return cls(
+            turn_type=turn.get('type'),
+            turn_message_id=turn.get('message_id'),
+            browser_state_id=(data.get('browser_state') or {}).get('message_id'),
+            image_context_id=(data.get('image_context') or {}).get('message_id'),
+        )
+
+    @classmethod
+    def from_hash(cls, data: Dict[str, str]) -> "ThreadHead":
+        return cls(**{name: data.get(name) or None for name in cls.__dataclass_fields__})
+
+    def to_hash(self) -> Dict[str, str]:
+        return {name: value or "" for name, value in asdict(self).items()}
+
+
+def _head_fields(type: str, message_id: str) -> Optional[Dict[str, str]]:
+    if type in TURN_TYPES:
+        return {'turn_type': type, 'turn_message_id': message_id}
+    if type == 'browser_state':
+        return {'browser_state_id': message_id}
+    if type == 'image_context':
+        return {'image_context_id': message_id}
+    return None
+
+
+async def load_thread_head(client, thread_id: str) -> ThreadHead:
+    """Load the thread head from the database in one round trip."""
+    result = await client.rpc('get_thread_head', {'p_thread_id': thread_id}).execute()
+    return ThreadHead.from_rpc(result.data)
+
+
+async def get_cached_thread_head(thread_id: str) -> Optional[ThreadHead]:
+    """Get the cached thread head, or None if no complete head is cached."""
+    redis_client = await redis.get_client()
+    data = await redis_client.hgetall(thread_head_key(thread_id))
+    if not data or SEEDED_FIELD not in data:
+        return None
+    return ThreadHead.from_hash(data)
+
+
+async def seed_thread_head(thread_id: str, head: ThreadHead):
+    """Replace the cached thread head with one loaded from the database."""
+    key = thread_head_key(thread_id)
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping={**head.to_hash(), SEEDED_FIELD: "1"})
+        pipe.expire(key, HEAD_TTL)
+        await pipe.execute()
+
+
+async def record_message(thread_id: str, type: str, message_id: Optional[str]):
+    """Update the cached thread head after a message was added to the thread."""
+    fields = _head_fields(type, message_id) if message_id else None
+    if not fields:
+        return
+    key = thread_head_key(thread_id)
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, HEAD_TTL)
+        await pipe.execute()
+
+
+def _parse_content(content: Any) -> Dict[str, Any]:
+    if isinstance(content, str):
+        content = json.loads(content)
+    return content if isinstance(content, dict) else {}
+
+
+class ThreadStateTracker:
+    """View of the thread head for the iterations of one agent run.
+
+    The first call to head() loads the head with the get_thread_head RPC and
+    seeds the cache with it; every later call is a single Redis HGETALL. The
+    browser state is only fetched when its message id differs from the one
+    fetched before.
+    """
+
+    def __init__(self, client, thread_id: str):
+        self.client = client
+        self.thread_id = thread_id
+        self._seeded = False
+        self._browser_state_id: Optional[str] = None
+        self._browser_state: Optional[Dict[str, Any]] = None
+
+    async def head(self) -> ThreadHead:
+        """Get the current thread head."""
+        cached = None
+        if self._seeded:
+            try:
+                cached = await get_cached_thread_head(self.thread_id)
+            except Exception as e:
+                logger.warning(f"Failed to read thread head of {self.thread_id} from Redis: {str(e)}")
+        if cached is not None:
+            return cached
+
+        head = await load_thread_head(self.client, self.thread_id)
+        self._seeded = True
+        # Awaited so the seed lands before the run records its next message;
+        # a later seed would replace that message with the older head
+        await self._seed(head)
+        return head
+
+    async def _seed(self, head: ThreadHead):
+        try:
+            await seed_thread_head(self.thread_id, head)
+        except Exception as e:
+            logger.warning(f"Failed to cache thread head of {self.thread_id}: {str(e)}")
+
+    async def browser_state(self, head: ThreadHead) -> Optional[Dict[str, Any]]:
+        """Get the content of the latest browser state, fetching it only if it changed."""
+        if head.browser_state_id == self._browser_state_id:
+            return self._browser_state
+        if not head.browser_state_id:
+            return None
+        result = await self.client.table('messages').select('content').eq('message_id', head.browser_state_id).limit(1).execute()
+        if not result.data:
+            # A deferred write that has not landed yet; try again next iteration
+            return self._browser_state
+        self._browser_state_id = head.browser_state_id
+        self._browser_state = _parse_content(result.data[0]['content'])
+        return self._browser_state
+
+    async def take_image_context(self, head: ThreadHead) -> Optional[Dict[str, Any]]:
+        """Consume the pending image context, deleting it and returning its content."""
+        if not head.image_context_id:
+            return None
+        # The delete returns the deleted row, so the image is read and consumed in one round trip
+        result = await self.client.table('messages').delete().eq('message_id', head.image_context_id).execute()
+        if not result.data:
+            return None
+        try:
+            redis_client = await redis.get_client()
+            await redis_client.hdel(thread_head_key(self.thread_id), 'image_context_id')
+        except Exception as e:
+            logger.warning(f"Failed to clear image context from thread head of {self.thread_id}: {str(e)}")
+        return _parse_content(result.data[0]['content'])
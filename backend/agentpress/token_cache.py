@@ -0,0 +1,99 @@
+"""
+Memoized token counting for AgentPress messages.
+
+Tokenizing a long thread is by far the most expensive part of context
+management. Since messages are immutable once stored, their token counts are
+cached per (model tokenizer, message_id, content hash) so that repeated passes
+within a call and later iterations of the same run only tokenize messages that
+are new or whose content changed (e.g. after compression).
+
+token_counter adds a fixed priming overhead to every call on top of the
+tokens of the messages themselves. The cached per-message counts exclude it,
+and total() and prefix_sums() add it back once per list.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Any, Dict, List, Optional, Tuple
+
+from litellm.utils import token_counter
+from utils.config import config
+
+# Counted to measure the per-call overhead of the tokenizer of a model
+_PROBE_MESSAGE = {"role": "user", "content": "a"}
+
+
+class MessageTokenCache:
+    """LRU cache of per-message token counts."""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        """Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of cached counts, defaults to config.TOKEN_CACHE_MAX_ENTRIES
+        """
+        self.max_entries = max_entries if max_entries is not None else config.TOKEN_CACHE_MAX_ENTRIES
+        self._counts: "OrderedDict[Tuple[str, str, str], int]" = OrderedDict()
+        self._overheads: Dict[str, int] = {}
+
+    @staticmethod
+    def _content_hash(msg: Dict[str, Any]) -> str:
+        """Hash everything in the message that contributes to its token count."""
+        payload = json.dumps({k: v for k, v in msg.items() if k != 'message_id'}, sort_keys=True, default=str)
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    def overhead(self, llm_model: str) -> int:
+        """Get the tokens token_counter adds once per call regardless of the messages."""
+        overhead = self._overheads.get(llm_model)
+        if overhead is None:
+            single = token_counter(model=llm_model, messages=[_PROBE_MESSAGE])
+            double = token_counter(model=llm_model, messages=[_PROBE_MESSAGE, _PROBE_MESSAGE])
+            overhead = max(0, 2 * single - double)
+            self._overheads[llm_model] = overhead
+        return overhead
+
+    def count(self, msg: Dict[str, Any], llm_model: str) -> int:
+        """Get the token count of a single message without the per-call overhead,
+        tokenizing it only on a cache miss."""
+        key = (llm_model, msg.get('message_id') or '', self._content_hash(msg))
+        cached = self._counts.get(key)
+        if cached is not None:
+            self._counts.move_to_end(key)
+            return cached
+
+        count = max(0, token_counter(model=llm_model, messages=[msg]) - self.overhead(llm_model))
+        self._counts[key] = count
+        if len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return count
+
+    def counts(self, messages: List[Dict[str, Any]], llm_model: str) -> List[int]:
+        """Get the token count of each message in the list, without the per-call overhead."""
+        return [self.count(msg, llm_model) for msg in messages]
+
+    def total(self, messages: List[Dict[str, Any]], llm_model: str) -> int:
+        """Get the total token count of a list of messages as the sum of cached
+        per-message counts plus the per-call overhead."""
+        return self.overhead(llm_model) + sum(self.counts(messages, llm_model))
+
+    def prefix_sums(self, messages: List[Dict[str, Any]], llm_model: str) -> List[int]:
+        """Get prefix sums of per-message token counts.
+
+        prefix[i] is the token count of messages[:i] including the per-call
+        overhead, so prefix[-1] equals total(messages) and the count of the
+        messages in any contiguous slice messages[a:b] is prefix[b] - prefix[a].
+        """
+        return list(accumulate(self.counts(messages, llm_model), initial=self.overhead(llm_model)))
+
+
+_token_cache: Optional[MessageTokenCache] = None
+
+
+def get_token_cache() -> MessageTokenCache:
+    """Get the process-wide MessageTokenCache instance."""
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = MessageTokenCache()
+    return _token_cache
@@ -101,6 +101,8 @@ class Tool(ABC):
     
     Attributes:
         _schemas (Dict[str, List[ToolSchema]]): Registered schemas for tool methods
+        _class_schemas (Dict[str, List[ToolSchema]]): Schemas of decorated methods, extracted once per subclass
+        resource_class (Optional[str]): Worker concurrency slot pool the tool's calls run in, if any
         
     Methods:
         get_schemas: Get all registered tool schemas
@@ -108,6 +110,18 @@ class Tool(ABC):
         fail_response: Create a failed result
     """
     
+    _class_schemas: Dict[str, List[ToolSchema]] = {}
+    resource_class: Optional[str] = None
+
+    def __init_subclass__(cls, **kwargs):
+        """Extract the schemas of decorated methods once, when the subclass is defined."""
+        super().__init_subclass__(**kwargs)
+        cls._class_schemas = {
+            name: function.tool_schemas
+            for name, function in inspect.getmembers(cls, predicate=inspect.isfunction)
+            if hasattr(function, 'tool_schemas')
+        }
+
     def __init__(self):
         """Initialize tool with empty schema registry."""
         self._schemas: Dict[str, List[ToolSchema]] = {}
@@ -116,10 +130,8 @@ class Tool(ABC):
 
     def _register_schemas(self):
         """Register schemas from all decorated methods."""
-        for name, method in inspect.getmembers(self, predicate=inspect.ismethod):
-            if hasattr(method, 'tool_schemas'):
-                self._schemas[name] = method.tool_schemas
-                logger.debug(f"Registered schemas for method '{name}' in {self.__class__.__name__}")
+        self._schemas.update(self._class_schemas)
+        logger.debug(f"Registered schemas for {len(self._class_schemas)} methods in {self.__class__.__name__}")
 
     def get_schemas(self) -> Dict[str, List[ToolSchema]]:
         """Get all registered tool schemas.
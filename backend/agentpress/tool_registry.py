@@ -1,8 +1,42 @@
+import json
+from dataclasses import dataclass, field
 from typing import Dict, Type, Any, List, Optional, Callable
-from agentpress.tool import Tool, SchemaType
+from litellm.utils import token_counter
+from agentpress.tool import Tool, ToolSchema, SchemaType
+from agentpress.xml_tool_parser import XMLTagMatcher
 from utils.logger import logger
 
 
+@dataclass(frozen=True)
+class ToolSchemaBundle:
+    """Immutable snapshot of the registry's tool schemas.
+    
+    Built once per registry version and shared by every LLM call until tools
+    are registered again. Callers must not mutate the contained schemas.
+    
+    Attributes:
+        version (int): Registry version the bundle was built from
+        openapi_schemas (List[Dict[str, Any]]): OpenAPI schemas for function calling
+        openapi_json (bytes): The OpenAPI schemas serialized as compact JSON
+        xml_examples (Dict[str, str]): XML tag names mapped to their example usage
+        xml_examples_text (str): The XML examples rendered for the system prompt
+    """
+    version: int
+    openapi_schemas: List[Dict[str, Any]]
+    openapi_json: bytes
+    xml_examples: Dict[str, str]
+    xml_examples_text: str
+    _token_counts: Dict[str, int] = field(default_factory=dict, repr=False, compare=False)
+
+    def token_count(self, llm_model: str) -> int:
+        """Get the token count of the OpenAPI tool payload, counted once per model."""
+        count = self._token_counts.get(llm_model)
+        if count is None:
+            count = token_counter(model=llm_model, text=self.openapi_json.decode('utf-8')) if self.openapi_schemas else 0
+            self._token_counts[llm_model] = count
+        return count
+
+
 class ToolRegistry:
     """Registry for managing and accessing tools.
     
@@ -19,12 +53,18 @@ class ToolRegistry:
         get_xml_tool: Get a tool by XML tag name
         get_openapi_schemas: Get OpenAPI schemas for function calling
         get_xml_examples: Get examples of XML tool usage
+        get_xml_tag_matcher: Get the cached matcher for XML tool tags
+        get_schema_bundle: Get the cached, pre-serialized tool schemas
     """
     
     def __init__(self):
         """Initialize a new ToolRegistry instance."""
         self.tools = {}
         self.xml_tools = {}
+        self._xml_tag_matcher: Optional[XMLTagMatcher] = None
+        # Bumped whenever tools are registered, invalidating the schema bundle
+        self.version = 0
+        self._schema_bundle: Optional[ToolSchemaBundle] = None
         logger.debug("Initialized new ToolRegistry instance")
     
     def register_tool(self, tool_class: Type[Tool], function_names: Optional[List[str]] = None, **kwargs):
@@ -68,8 +108,31 @@ class ToolRegistry:
                         registered_xml += 1
                         logger.debug(f"Registered XML tag {schema.xml_schema.tag_name} -> {func_name} from {tool_class.__name__}")
         
+        if registered_xml:
+            # Rebuilt lazily on the next get_xml_tag_matcher call
+            self._xml_tag_matcher = None
+        self.version += 1
+        
         logger.debug(f"Tool registration complete for {tool_class.__name__}: {registered_openapi} OpenAPI functions, {registered_xml} XML tags")
 
+    def register_function(self, func_name: str, tool_instance: Tool, schema: ToolSchema):
+        """Register a single OpenAPI function of an already created tool instance.
+        
+        Used for functions that only exist after the tool is initialized,
+        such as dynamic MCP tools.
+        
+        Args:
+            func_name: Name of the function
+            tool_instance: Tool instance implementing the function
+            schema: OpenAPI schema of the function
+        """
+        self.tools[func_name] = {
+            "instance": tool_instance,
+            "schema": schema
+        }
+        self.version += 1
+        logger.debug(f"Registered OpenAPI function {func_name} from {tool_instance.__class__.__name__}")
+
     def get_available_functions(self) -> Dict[str, Callable]:
         """Get all available tool functions.
         
@@ -123,17 +186,47 @@ class ToolRegistry:
             logger.warning(f"XML tool not found for tag: {tag_name}")
         return tool
 
-    def get_openapi_schemas(self) -> List[Dict[str, Any]]:
-        """Get OpenAPI schemas for function calling.
+    def get_schema_bundle(self) -> ToolSchemaBundle:
+        """Get the tool schemas as a frozen, pre-serialized bundle.
+        
+        The bundle is built once and reused until the registry version
+        changes, so repeated LLM calls within a run don't rebuild the schema
+        list, the XML examples or the serialized payload.
         
         Returns:
-            List of OpenAPI-compatible schema definitions
+            ToolSchemaBundle for the current registry version
         """
-        schemas = [
+        if self._schema_bundle is not None and self._schema_bundle.version == self.version:
+            return self._schema_bundle
+
+        openapi_schemas = [
             tool_info['schema'].schema 
             for tool_info in self.tools.values()
             if tool_info['schema'].schema_type == SchemaType.OPENAPI
         ]
+        xml_examples = {}
+        for tool_info in self.xml_tools.values():
+            schema = tool_info['schema']
+            if schema.xml_schema and schema.xml_schema.example:
+                xml_examples[schema.xml_schema.tag_name] = schema.xml_schema.example
+
+        self._schema_bundle = ToolSchemaBundle(
+            version=self.version,
+            openapi_schemas=openapi_schemas,
+            openapi_json=json.dumps(openapi_schemas, separators=(',', ':')).encode('utf-8'),
+            xml_examples=xml_examples,
+            xml_examples_text="".join(f"<{tag_name}> Example: {example}\\n" for tag_name, example in xml_examples.items())
+        )
+        logger.debug(f"Built tool schema bundle v{self.version}: {len(openapi_schemas)} OpenAPI schemas, {len(xml_examples)} XML examples")
+        return self._schema_bundle
+
+    def get_openapi_schemas(self) -> List[Dict[str, Any]]:
+        """Get OpenAPI schemas for function calling.
+        
+        Returns:
+            List of OpenAPI-compatible schema definitions, shared with the cached bundle
+        """
+        schemas = self.get_schema_bundle().openapi_schemas
         logger.debug(f"Retrieved {len(schemas)} OpenAPI schemas")
         return schemas
 
@@ -143,10 +236,21 @@ class ToolRegistry:
         Returns:
             Dict mapping tag names to their example usage
         """
-        examples = {}
-        for tool_info in self.xml_tools.values():
-            schema = tool_info['schema']
-            if schema.xml_schema and schema.xml_schema.example:
-                examples[schema.xml_schema.tag_name] = schema.xml_schema.example
+        examples = dict(self.get_schema_bundle().xml_examples)
         logger.debug(f"Retrieved {len(examples)} XML examples")
         return examples
+
+    def get_xml_tag_matcher(self) -> XMLTagMatcher:
+        """Get the compiled matcher for XML tool tags.
+        
+        The matcher is built once and reused until the registered XML tools
+        change, so detecting tool tags costs a single scan of the content
+        however many tools are registered.
+        
+        Returns:
+            XMLTagMatcher for all registered XML tag names
+        """
+        if self._xml_tag_matcher is None or self._xml_tag_matcher.legacy_tags != self.xml_tools.keys():
+            self._xml_tag_matcher = XMLTagMatcher(self.xml_tools.keys())
+            logger.debug(f"Compiled XML tag matcher for {len(self.xml_tools)} tags")
+        return self._xml_tag_matcher
@@ -3,11 +3,38 @@ JSON helper utilities for handling both legacy (string) and new (dict/list) form
 
 These utilities help with the transition from storing JSON as strings to storing
 them as proper JSONB objects in the database.
+
+dumps() and loads() are the fast path for the JSON boundaries on the streaming
+path. They use orjson when it is installed and fall back to the standard
+library otherwise; both produce compact, UTF-8 (not ASCII-escaped) JSON.
 """
 
 import json
 from typing import Any, Union, Dict, List
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value: Any) -> str:
+    """Serialize a value to compact JSON."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:
+            # e.g. non-string dict keys or integers beyond 64 bits
+            pass
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def loads(value: Union[str, bytes]) -> Any:
+    """Parse a JSON string."""
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
 
 def ensure_dict(value: Union[str, Dict[str, Any], None], default: Dict[str, Any] = None) -> Dict[str, Any]:
     """
@@ -141,7 +168,7 @@ def to_json_string(value: Any) -> str:
             return json.dumps(value)
     
     # For all other types, convert to JSON
-    return json.dumps(value)
+    return dumps(value)
 
 
 def format_for_yield(message_object: Dict[str, Any]) -> Dict[str, Any]:
@@ -165,10 +192,10 @@ def format_for_yield(message_object: Dict[str, Any]) -> Dict[str, Any]:
     
     # Ensure content is a JSON string
     if 'content' in formatted and not isinstance(formatted['content'], str):
-        formatted['content'] = json.dumps(formatted['content'])
+        formatted['content'] = dumps(formatted['content'])
         
     # Ensure metadata is a JSON string
     if 'metadata' in formatted and not isinstance(formatted['metadata'], str):
-        formatted['metadata'] = json.dumps(formatted['metadata'])
+        formatted['metadata'] = dumps(formatted['metadata'])
         
     return formatted 
\ No newline at end of file
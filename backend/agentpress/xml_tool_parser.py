@@ -7,8 +7,8 @@ the Cursor-style format with structured function_calls blocks.
 
 import re
 import xml.etree.ElementTree as ET
-from typing import List, Dict, Any, Optional, Tuple
-from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+from dataclasses import dataclass, field
 import json
 import logging
 
@@ -24,6 +24,59 @@ class XMLToolCall:
     parsing_details: Dict[str, Any]
 
 
+@dataclass
+class XMLToolBlock:
+    """A complete tool call block found by XMLToolCallStream.
+
+    Attributes:
+        raw_xml: The exact text of the block, a substring of the fed content
+        tool_calls: Tool calls parsed from a <function_calls> block, empty for legacy blocks
+        legacy_tag: The tag name of a legacy block, None for <function_calls> blocks
+    """
+    raw_xml: str
+    tool_calls: List[XMLToolCall] = field(default_factory=list)
+    legacy_tag: Optional[str] = None
+
+
+class XMLTagMatcher:
+    """
+    Single-pass matcher for the opening tags that start a tool call block.
+    
+    All block start tags (<function_calls> and every legacy tool tag) are
+    compiled into one alternation, so finding the earliest block in some text
+    is a single linear scan regardless of how many tools are registered.
+    Matchers are immutable; ToolRegistry caches one until its tools change.
+    """
+    
+    def __init__(self, legacy_tags: Iterable[str] = ()):
+        """
+        Compile the matcher.
+        
+        Args:
+            legacy_tags: Tag names of legacy XML tools to detect
+        """
+        self.legacy_tags = frozenset(legacy_tags)
+        # Longest names first so a tag never shadows a longer tag it prefixes
+        alternatives = ['(?i:function_calls)'] + [
+            re.escape(tag) for tag in sorted(self.legacy_tags, key=len, reverse=True)
+        ]
+        self.pattern = re.compile(r'<(' + '|'.join(alternatives) + r')(?![\w\-])')
+        # Length of the longest possible '<' + tag name prefix
+        self.max_prefix_length = 1 + max([len('function_calls')] + [len(tag) for tag in self.legacy_tags])
+    
+    def find(self, content: str, pos: int = 0) -> Optional[Tuple[int, str]]:
+        """
+        Find the earliest block start tag at or after pos.
+        
+        Returns:
+            Tuple of (position of '<', tag name), or None if no tag is found
+        """
+        match = self.pattern.search(content, pos)
+        if not match:
+            return None
+        return match.start(), match.group(1)
+
+
 class XMLToolParser:
     """
     Parser for XML tool calls using the Cursor-style format:
@@ -72,26 +125,13 @@ class XMLToolParser:
         Returns:
             List of parsed XMLToolCall objects
         """
-        tool_calls = []
-        
-        # First, try to find function_calls blocks
-        function_calls_matches = self.FUNCTION_CALLS_PATTERN.findall(content)
-        
-        for fc_content in function_calls_matches:
-            # Find all invoke blocks within this function_calls block
-            invoke_matches = self.INVOKE_PATTERN.findall(fc_content)
-            
-            for function_name, invoke_content in invoke_matches:
-                try:
-                    tool_call = self._parse_invoke_block(
-                        function_name, 
-                        invoke_content,
-                        fc_content
-                    )
-                    if tool_call:
-                        tool_calls.append(tool_call)
-                except Exception as e:
-                    logger.error(f"Error parsing invoke block for {function_name}: {e}")
+        # Find function_calls blocks with the same tokenizer used while streaming
+        stream = XMLToolCallStream(parser=self)
+        tool_calls = [
+            tool_call
+            for block in stream.feed(content)
+            for tool_call in block.tool_calls
+        ]
         
         # If not in strict mode and no tool calls found, try legacy format
         if not self.strict_mode and not tool_calls:
@@ -106,6 +146,26 @@ class XMLToolParser:
         full_block: str
     ) -> Optional[XMLToolCall]:
         """Parse a single invoke block into an XMLToolCall."""
+        # Extract all parameters
+        param_matches = self.PARAMETER_PATTERN.findall(invoke_content)
+        
+        # Extract the raw XML for this specific invoke
+        invoke_pattern = re.compile(
+            rf'<invoke\s+name=["\']{re.escape(function_name)}["\']>.*?</invoke>',
+            re.DOTALL | re.IGNORECASE
+        )
+        raw_xml_match = invoke_pattern.search(full_block)
+        raw_xml = raw_xml_match.group(0) if raw_xml_match else f"<invoke name=\"{function_name}\">...</invoke>"
+        
+        return self._build_tool_call(function_name, param_matches, raw_xml)
+    
+    def _build_tool_call(
+        self,
+        function_name: str,
+        raw_parameters: List[Tuple[str, str]],
+        raw_xml: str
+    ) -> XMLToolCall:
+        """Build an XMLToolCall from (name, raw value) parameter pairs."""
         parameters = {}
         parsing_details = {
             "format": "v2",
@@ -113,10 +173,7 @@ class XMLToolParser:
             "raw_parameters": {}
         }
         
-        # Extract all parameters
-        param_matches = self.PARAMETER_PATTERN.findall(invoke_content)
-        
-        for param_name, param_value in param_matches:
+        for param_name, param_value in raw_parameters:
             # Clean up the parameter value
             param_value = param_value.strip()
             
@@ -126,14 +183,6 @@ class XMLToolParser:
             parameters[param_name] = parsed_value
             parsing_details["raw_parameters"][param_name] = param_value
         
-        # Extract the raw XML for this specific invoke
-        invoke_pattern = re.compile(
-            rf'<invoke\s+name=["\']{re.escape(function_name)}["\']>.*?</invoke>',
-            re.DOTALL | re.IGNORECASE
-        )
-        raw_xml_match = invoke_pattern.search(full_block)
-        raw_xml = raw_xml_match.group(0) if raw_xml_match else f"<invoke name=\"{function_name}\">...</invoke>"
-        
         return XMLToolCall(
             function_name=function_name,
             parameters=parameters,
@@ -284,6 +333,206 @@ class XMLToolParser:
         return True, None
 
 
+class XMLToolCallStream:
+    """
+    Push-based incremental tokenizer for streamed XML tool calls.
+    
+    Content is pushed delta by delta with feed(). Every character is scanned
+    once: the tokenizer keeps its scan position and the open
+    <function_calls>/<invoke>/<parameter> frames between calls, and returns each
+    block as soon as its closing tag arrives. Parameter values are treated as
+    raw text until </parameter>, so markup inside them is never mistaken for
+    tool calls. Text outside of blocks is discarded once scanned.
+    
+    Legacy tool tags (e.g. <create-file>...</create-file>) are recognized when
+    their names are passed as legacy_tags, or through a prebuilt tag_matcher.
+    Outside of blocks the next block start is located with the matcher's
+    single compiled pattern instead of stopping at every '<'.
+    """
+    
+    # A '<' that is not closed by '>' within this many characters is not a tag
+    MAX_TAG_LENGTH = 1024
+    
+    TAG_PATTERN = re.compile(r'<(/?)([a-zA-Z][\w\-]*)')
+    NAME_ATTRIBUTE_PATTERN = re.compile(r'\s+name=["\']([^"\']+)["\']\s*>$')
+    
+    def __init__(
+        self,
+        parser: Optional[XMLToolParser] = None,
+        legacy_tags: Optional[Iterable[str]] = None,
+        tag_matcher: Optional[XMLTagMatcher] = None
+    ):
+        """
+        Initialize the stream tokenizer.
+        
+        Args:
+            parser: Parser used to build XMLToolCall objects from invoke blocks
+            legacy_tags: Tag names of legacy XML tools to detect
+            tag_matcher: Prebuilt matcher to use instead of compiling one from legacy_tags
+        """
+        self.parser = parser or XMLToolParser()
+        self.tag_matcher = tag_matcher or XMLTagMatcher(legacy_tags or ())
+        self.legacy_tags = self.tag_matcher.legacy_tags
+        self._buffer = ""
+        self._pos = 0
+        # Start of the open block in the buffer, None outside of blocks
+        self._block_start: Optional[int] = None
+        self._legacy_tag: Optional[str] = None
+        self._legacy_depth = 0
+        # Open invoke frame: (function name, start in buffer)
+        self._invoke: Optional[Tuple[Optional[str], int]] = None
+        # Open parameter frame: (parameter name, content start in buffer)
+        self._parameter: Optional[Tuple[str, int]] = None
+        self._parameters: List[Tuple[str, str]] = []
+        self._tool_calls: List[XMLToolCall] = []
+    
+    def feed(self, delta: str) -> List[XMLToolBlock]:
+        """
+        Push a piece of content and return the blocks it completes.
+        
+        Args:
+            delta: The next piece of streamed content
+            
+        Returns:
+            List of XMLToolBlock objects completed by this delta, in order
+        """
+        self._buffer += delta
+        blocks = []
+        
+        while True:
+            if self._block_start is None:
+                # Outside of blocks only block start tags matter
+                found = self.tag_matcher.find(self._buffer, self._pos)
+                if found is None:
+                    # Keep a trailing '<' that may start a tag name completed by the next delta
+                    last = self._buffer.rfind('<', self._pos)
+                    if last != -1 and len(self._buffer) - last < self.tag_matcher.max_prefix_length:
+                        self._pos = last
+                    else:
+                        self._pos = len(self._buffer)
+                    break
+                start = found[0]
+            elif self._parameter is not None:
+                # Inside a parameter only its closing tag matters
+                start = self._buffer.find('</', self._pos)
+            else:
+                start = self._buffer.find('<', self._pos)
+            
+            if start == -1:
+                # Keep a trailing '<' that may start a closing tag in the next delta
+                self._pos = max(self._pos, len(self._buffer) - 1)
+                break
+            
+            end = self._buffer.find('>', start)
+            if end == -1:
+                if len(self._buffer) - start > self.MAX_TAG_LENGTH:
+                    self._pos = start + 1
+                    continue
+                # Incomplete tag, wait for more content
+                self._pos = start
+                break
+            
+            tag = self._buffer[start:end + 1]
+            match = self.TAG_PATTERN.match(tag)
+            if not match:
+                self._pos = start + 1
+                continue
+            
+            # Tags that change a frame move the position past themselves
+            self._pos = start + 1
+            block = self._handle_tag(tag, match.group(1) == '/', match.group(2), start, end + 1)
+            if block:
+                blocks.append(block)
+        
+        if self._block_start is None:
+            # Nothing before the scan position can be part of a block anymore
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        
+        return blocks
+    
+    def _handle_tag(self, tag: str, closing: bool, name: str, start: int, end: int) -> Optional[XMLToolBlock]:
+        """Update the open frames for a complete tag, returning a block if it closes one."""
+        lower_name = name.lower()
+        
+        if self._parameter is not None:
+            if closing and lower_name == 'parameter':
+                param_name, content_start = self._parameter
+                self._parameters.append((param_name, self._buffer[content_start:start]))
+                self._parameter = None
+                self._pos = end
+            return None
+        
+        if self._block_start is not None and self._legacy_tag is None:
+            if not closing and lower_name == 'invoke':
+                name_match = self.NAME_ATTRIBUTE_PATTERN.match(tag, len('<invoke'))
+                self._invoke = (name_match.group(1) if name_match else None, start)
+                self._parameters = []
+                self._pos = end
+            elif closing and lower_name == 'invoke' and self._invoke is not None:
+                function_name, invoke_start = self._invoke
+                if function_name:
+                    try:
+                        self._tool_calls.append(self.parser._build_tool_call(
+                            function_name, self._parameters, self._buffer[invoke_start:end]
+                        ))
+                    except Exception as e:
+                        logger.error(f"Error parsing invoke block for {function_name}: {e}")
+                self._invoke = None
+                self._pos = end
+            elif not closing and lower_name == 'parameter' and self._invoke is not None:
+                name_match = self.NAME_ATTRIBUTE_PATTERN.match(tag, len('<parameter'))
+                if name_match:
+                    self._parameter = (name_match.group(1), end)
+                    self._pos = end
+            elif closing and lower_name == 'function_calls':
+                self._pos = end
+                return self._close_block(end)
+            return None
+        
+        if self._legacy_tag is not None:
+            if name == self._legacy_tag:
+                self._legacy_depth += -1 if closing else 1
+                self._pos = end
+                if self._legacy_depth == 0:
+                    return self._close_block(end)
+                return None
+            if closing or lower_name != 'function_calls':
+                return None
+            # An unterminated legacy tag must not swallow a following function_calls block
+            self._reset_block()
+        
+        if closing:
+            return None
+        if lower_name == 'function_calls':
+            self._block_start = start
+            self._pos = end
+        elif name in self.legacy_tags:
+            self._block_start = start
+            self._legacy_tag = name
+            self._legacy_depth = 1
+            self._pos = end
+        return None
+    
+    def _close_block(self, end: int) -> XMLToolBlock:
+        block = XMLToolBlock(
+            raw_xml=self._buffer[self._block_start:end],
+            tool_calls=self._tool_calls,
+            legacy_tag=self._legacy_tag
+        )
+        self._reset_block()
+        return block
+    
+    def _reset_block(self):
+        self._block_start = None
+        self._legacy_tag = None
+        self._legacy_depth = 0
+        self._invoke = None
+        self._parameter = None
+        self._parameters = []
+        self._tool_calls = []
+
+
 # Convenience function for quick parsing
 def parse_xml_tool_calls(content: str, strict_mode: bool = False) -> List[XMLToolCall]:
     """
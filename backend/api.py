@@ -13,6 +13,7 @@ from datetime import datetime, timezone
 from utils.config import config, EnvMode
 import asyncio
 from utils.logger import logger, structlog
+from utils.metrics import render_metrics
 import time
 from collections import OrderedDict
 from typing import Dict, Any
@@ -224,6 +225,12 @@ async def health_check():
 
 app.include_router(api_router, prefix="/api")
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of this API process."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 
 if __name__ == "__main__":
     import uvicorn
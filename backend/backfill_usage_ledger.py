@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Script to backfill the usage ledger from stored assistant_response_end messages.
+
+The ledger is only written for responses persisted after the usage_ledger
+migration. Run this once after deploying it so the monthly rollups also
+include earlier usage. Messages already in the ledger are skipped, so it is
+safe to run again.
+
+Usage:
+    python backfill_usage_ledger.py              # usage of the current billing period
+    python backfill_usage_ledger.py 2025-07-01   # usage since a date
+"""
+
+import asyncio
+import json
+import sys
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from services.billing import get_usage_period_start, usage_ledger_entry
+from services.supabase import DBConnection
+from utils.pagination import keyset_pages
+
+
+async def backfill(since: datetime):
+    db = DBConnection()
+    await db.initialize()
+    client = await db.client
+
+    def build_query():
+        return client.table('messages') \
+            .select('message_id, created_at, content, threads!inner(thread_id, account_id, project_id, created_at)') \
+            .eq('type', 'assistant_response_end') \
+            .gte('created_at', since.isoformat())
+
+    total = 0
+    async for page in keyset_pages(build_query, page_size=500):
+        entries = []
+        for message in page:
+            thread = message.get('threads')
+            if isinstance(thread, list):
+                thread = thread[0] if thread else None
+            content = message.get('content')
+            if isinstance(content, str):
+                content = json.loads(content)
+            if not thread or not isinstance(content, dict):
+                continue
+            entries.append(usage_ledger_entry(thread, message['message_id'], message['created_at'], content))
+        if entries:
+            await client.table('usage_ledger').upsert(entries, on_conflict='message_id', ignore_duplicates=True).execute()
+        total += len(entries)
+        print(f"Backfilled {total} messages (up to {page[-1]['created_at']})")
+
+    print(f"Done: {total} messages since {since.isoformat()}")
+
+
+def main():
+    if len(sys.argv) > 1:
+        since = datetime.fromisoformat(sys.argv[1])
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+    else:
+        since = get_usage_period_start()
+    asyncio.run(backfill(since))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ except ImportError:
         ToolResult = Any
 
 from utils.logger import logger
+from utils.metrics import MCP_CONNECT_SECONDS, observe
 from .mcp_providers import MCPProviderFactory, SmitheryProvider, PipedreamProvider
 import os
 
@@ -75,13 +76,14 @@ class MCPManager:
             else:
                 headers = provider.get_headers(qualified_name, mcp_config.get("config", {}), external_user_id)
             
-            async with streamablehttp_client(url, headers=headers) as (read_stream, write_stream, _):
-                async with ClientSession(read_stream, write_stream) as session:
-                    await session.initialize()
-                    logger.info(f"MCP session initialized for {qualified_name} via {provider_type}")
-                    
-                    tools_result = await session.list_tools()
-                    tools = tools_result.tools if hasattr(tools_result, 'tools') else tools_result
+            with observe(MCP_CONNECT_SECONDS, transport=provider_type):
+                async with streamablehttp_client(url, headers=headers) as (read_stream, write_stream, _):
+                    async with ClientSession(read_stream, write_stream) as session:
+                        await session.initialize()
+                        logger.info(f"MCP session initialized for {qualified_name} via {provider_type}")
+                        
+                        tools_result = await session.list_tools()
+                        tools = tools_result.tools if hasattr(tools_result, 'tools') else tools_result
             
             logger.info(f"Available tools from {qualified_name}: {[t.name for t in tools]}")
             
@@ -3,22 +3,31 @@ dotenv.load_dotenv(".env")
 
 import sentry
 import asyncio
-import json
 import traceback
 from datetime import datetime, timezone
 from typing import Optional
 from services import redis
 from agent.run import run_agent
+from agent import response_stream, run_registry
+from agent.response_sink import ResponseSink
+from agent.run_control import RunControl
+from agent.run_archiver import archive_run
+from agentpress.resource_scheduler import DEFERRED_RUNS, bind_account, get_scheduler
+from agentpress.utils.json_helpers import dumps
 from utils.logger import logger, structlog
 import dramatiq
 import uuid
 from agentpress.thread_manager import ThreadManager
+from agentpress.context_manager import ContextManager
 from services.supabase import DBConnection
 from services import redis
 from dramatiq.brokers.rabbitmq import RabbitmqBroker
 import os
 from services.langfuse import langfuse
 from utils.retry import retry
+from utils.config import config
+from utils.metrics import start_worker_metrics_server
+from utils.tracing import finish_run_trace, profile_key, start_run_trace
 
 import sentry_sdk
 from typing import Dict, Any
@@ -53,6 +62,7 @@ async def initialize():
         instance_id = str(uuid.uuid4())[:8]
     await retry(lambda: redis.initialize_async())
     await db.initialize()
+    start_worker_metrics_server()
 
     _initialized = True
     logger.info(f"Initialized agent API with instance ID: {instance_id}")
@@ -78,6 +88,8 @@ async def run_agent_background(
     is_agent_builder: Optional[bool] = False,
     target_agent_id: Optional[str] = None,
     request_id: Optional[str] = None,
+    account_id: Optional[str] = None,
+    deferrals: int = 0,
 ):
     """Run the agent in the background using Redis for state."""
     structlog.contextvars.clear_contextvars()
@@ -93,6 +105,26 @@ async def run_agent_background(
         logger.critical(f"Failed to initialize Redis connection: {e}")
         raise e
 
+    # Push the run back to RabbitMQ instead of starting it on an overloaded worker
+    scheduler = get_scheduler()
+    overload_reason = scheduler.overload_reason(model_name)
+    if overload_reason and deferrals < config.SCHEDULER_MAX_DEFERRALS:
+        logger.warning(f"Worker overloaded ({overload_reason}), deferring agent run {agent_run_id} by {config.SCHEDULER_DEFER_DELAY_MS}ms ({deferrals + 1}/{config.SCHEDULER_MAX_DEFERRALS})")
+        DEFERRED_RUNS.inc()
+        run_agent_background.send_with_options(
+            kwargs=dict(
+                agent_run_id=agent_run_id, thread_id=thread_id, instance_id=instance_id,
+                project_id=project_id, model_name=model_name,
+                enable_thinking=enable_thinking, reasoning_effort=reasoning_effort,
+                stream=stream, enable_context_manager=enable_context_manager,
+                agent_config=agent_config, is_agent_builder=is_agent_builder,
+                target_agent_id=target_agent_id, request_id=request_id,
+                account_id=account_id, deferrals=deferrals + 1,
+            ),
+            delay=config.SCHEDULER_DEFER_DELAY_MS,
+        )
+        return
+
     # Idempotency check: prevent duplicate runs
     run_lock_key = f"agent_run_lock:{agent_run_id}"
     
@@ -132,57 +164,28 @@ async def run_agent_background(
     client = await db.client
     start_time = datetime.now(timezone.utc)
     total_responses = 0
-    pubsub = None
-    stop_checker = None
-    stop_signal_received = False
-
-    # Define Redis keys and channels
-    response_list_key = f"agent_run:{agent_run_id}:responses"
-    response_channel = f"agent_run:{agent_run_id}:new_response"
-    instance_control_channel = f"agent_run:{agent_run_id}:control:{instance_id}"
+    run_control = RunControl(agent_run_id, instance_id)
+    use_streams = False
+    sink = None
+
     global_control_channel = f"agent_run:{agent_run_id}:control"
-    instance_active_key = f"active_run:{instance_id}:{agent_run_id}"
 
-    async def check_for_stop_signal():
-        nonlocal stop_signal_received
-        if not pubsub: return
-        try:
-            while not stop_signal_received:
-                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.5)
-                if message and message.get("type") == "message":
-                    data = message.get("data")
-                    if isinstance(data, bytes): data = data.decode('utf-8')
-                    if data == "STOP":
-                        logger.info(f"Received STOP signal for agent run {agent_run_id} (Instance: {instance_id})")
-                        stop_signal_received = True
-                        break
-                # Periodically refresh the active run key TTL
-                if total_responses % 50 == 0: # Refresh every 50 responses or so
-                    try: await redis.expire(instance_active_key, redis.REDIS_KEY_TTL)
-                    except Exception as ttl_err: logger.warning(f"Failed to refresh TTL for {instance_active_key}: {ttl_err}")
-                await asyncio.sleep(0.1) # Short sleep to prevent tight loop
-        except asyncio.CancelledError:
-            logger.info(f"Stop signal checker cancelled for {agent_run_id} (Instance: {instance_id})")
-        except Exception as e:
-            logger.error(f"Error in stop signal checker for {agent_run_id}: {e}", exc_info=True)
-            stop_signal_received = True # Stop the run if the checker fails
+    # Slots requested by this run are queued under its account
+    bind_account(account_id)
+    # Sampled runs record spans of their hot path for /debug/runs/{id}/profile
+    trace_tokens = start_run_trace(agent_run_id)
 
     trace = langfuse.trace(name="agent_run", id=agent_run_id, session_id=thread_id, metadata={"project_id": project_id, "instance_id": instance_id})
     try:
-        # Setup Pub/Sub listener for control signals
-        pubsub = await redis.create_pubsub()
-        try:
-            await retry(lambda: pubsub.subscribe(instance_control_channel, global_control_channel))
-        except Exception as e:
-            logger.error(f"Redis failed to subscribe to control channels: {e}", exc_info=True)
-            raise e
+        # Counted inside the try so the finally always balances it with run_finished
+        scheduler.run_started()
 
-        logger.debug(f"Subscribed to control channels: {instance_control_channel}, {global_control_channel}")
-        stop_checker = asyncio.create_task(check_for_stop_signal())
-
-        # Ensure active run key exists and has TTL
-        await redis.set(instance_active_key, "running", ex=redis.REDIS_KEY_TTL)
+        # Listen for control signals and keep the run registered while it is running
+        await run_control.start()
 
+        use_streams = await response_stream.uses_streams(agent_run_id)
+        logger.debug(f"Using {'stream' if use_streams else 'list'} response transport for {agent_run_id}")
+        sink = ResponseSink(agent_run_id, use_streams)
 
         # Initialize agent generator
         agent_gen = run_agent(
@@ -199,30 +202,28 @@ async def run_agent_background(
         final_status = "running"
         error_message = None
 
-        pending_redis_operations = []
-
-        async for response in agent_gen:
-            if stop_signal_received:
-                logger.info(f"Agent run {agent_run_id} stopped by signal.")
-                final_status = "stopped"
-                trace.span(name="agent_run_stopped").end(status_message="agent_run_stopped", level="WARNING")
-                break
-
-            # Store response in Redis list and publish notification
-            response_json = json.dumps(response)
-            pending_redis_operations.append(asyncio.create_task(redis.rpush(response_list_key, response_json)))
-            pending_redis_operations.append(asyncio.create_task(redis.publish(response_channel, "new")))
-            total_responses += 1
-
-            # Check for agent-signaled completion or error
-            if response.get('type') == 'status':
-                 status_val = response.get('status')
-                 if status_val in ['completed', 'failed', 'stopped']:
-                     logger.info(f"Agent run {agent_run_id} finished via status message: {status_val}")
-                     final_status = status_val
-                     if status_val == 'failed' or status_val == 'stopped':
-                         error_message = response.get('message', f"Run ended with status: {status_val}")
-                     break
+        async def consume_responses():
+            nonlocal final_status, error_message, total_responses
+            async for response in agent_gen:
+                # Queue the response for the next batched write to Redis
+                await sink.put(dumps(response), status=response.get('status') if response.get('type') == 'status' else None)
+                total_responses += 1
+
+                # Check for agent-signaled completion or error
+                if response.get('type') == 'status':
+                     status_val = response.get('status')
+                     if status_val in ['completed', 'failed', 'stopped']:
+                         logger.info(f"Agent run {agent_run_id} finished via status message: {status_val}")
+                         final_status = status_val
+                         if status_val == 'failed' or status_val == 'stopped':
+                             error_message = response.get('message', f"Run ended with status: {status_val}")
+                         break
+
+        # A STOP cancels the agent wherever it is waiting, including in-flight tool executions
+        if await run_control.run_until_stopped(consume_responses()):
+            logger.info(f"Agent run {agent_run_id} stopped by signal ({run_control.stop_reason}).")
+            final_status = "stopped"
+            trace.span(name="agent_run_stopped").end(status_message="agent_run_stopped", level="WARNING")
 
         # If loop finished without explicit completion/error/stop signal, mark as completed
         if final_status == "running":
@@ -231,19 +232,27 @@ async def run_agent_background(
              logger.info(f"Agent run {agent_run_id} completed normally (duration: {duration:.2f}s, responses: {total_responses})")
              completion_message = {"type": "status", "status": "completed", "message": "Agent run completed successfully"}
              trace.span(name="agent_run_completed").end(status_message="agent_run_completed")
-             await redis.rpush(response_list_key, json.dumps(completion_message))
-             await redis.publish(response_channel, "new") # Notify about the completion message
+             await sink.put(dumps(completion_message), status="completed")
 
-        # Fetch final responses from Redis for DB update
-        all_responses_json = await redis.lrange(response_list_key, 0, -1)
-        all_responses = [json.loads(r) for r in all_responses_json]
+        # Make sure every response is in Redis before the run is marked as finished
+        await sink.flush()
 
-        # Update DB status
-        await update_agent_run_status(client, agent_run_id, final_status, error=error_message, responses=all_responses)
+        # Update DB status; the responses are archived by archive_agent_run once the run is cleaned up
+        await update_agent_run_status(client, agent_run_id, final_status, error=error_message)
+
+        # Summarize the thread off the hot path if it has grown past the token threshold
+        if enable_context_manager and final_status == "completed":
+            try:
+                summarize_thread.send(thread_id=thread_id, model_name=model_name)
+            except Exception as e:
+                logger.warning(f"Failed to enqueue summarization for thread {thread_id}: {str(e)}")
 
         # Publish final control signal (END_STREAM or ERROR)
         control_signal = "END_STREAM" if final_status == "completed" else "ERROR" if final_status == "failed" else "STOP"
         try:
+            # Stream readers find the control entry when the published signal wakes them up
+            if use_streams:
+                await response_stream.append_control(agent_run_id, control_signal)
             await redis.publish(global_control_channel, control_signal)
             # No need to publish to instance channel as the run is ending on this instance
             logger.debug(f"Published final control signal '{control_signal}' to {global_control_channel}")
@@ -261,76 +270,134 @@ async def run_agent_background(
         # Push error message to Redis list
         error_response = {"type": "status", "status": "error", "message": error_message}
         try:
-            await redis.rpush(response_list_key, json.dumps(error_response))
-            await redis.publish(response_channel, "new")
+            if sink:
+                await sink.put(dumps(error_response), status="error")
+                await sink.flush()
+            else:
+                await redis.rpush(response_stream.response_list_key(agent_run_id), dumps(error_response))
+                await redis.publish(response_stream.response_channel(agent_run_id), "new")
         except Exception as redis_err:
              logger.error(f"Failed to push error response to Redis for {agent_run_id}: {redis_err}")
 
-        # Fetch final responses (including the error)
-        all_responses = []
-        try:
-             all_responses_json = await redis.lrange(response_list_key, 0, -1)
-             all_responses = [json.loads(r) for r in all_responses_json]
-        except Exception as fetch_err:
-             logger.error(f"Failed to fetch responses from Redis after error for {agent_run_id}: {fetch_err}")
-             all_responses = [error_response] # Use the error message we tried to push
-
         # Update DB status
-        await update_agent_run_status(client, agent_run_id, "failed", error=f"{error_message}\n{traceback_str}", responses=all_responses)
+        await update_agent_run_status(client, agent_run_id, "failed", error=f"{error_message}\n{traceback_str}")
 
         # Publish ERROR signal
         try:
+            if use_streams:
+                await response_stream.append_control(agent_run_id, "ERROR")
             await redis.publish(global_control_channel, "ERROR")
             logger.debug(f"Published ERROR signal to {global_control_channel}")
         except Exception as e:
             logger.warning(f"Failed to publish ERROR signal: {str(e)}")
 
     finally:
-        # Cleanup stop checker task
-        if stop_checker and not stop_checker.done():
-            stop_checker.cancel()
-            try: await stop_checker
-            except asyncio.CancelledError: pass
-            except Exception as e: logger.warning(f"Error during stop_checker cancellation: {e}")
-
-        # Close pubsub connection
-        if pubsub:
-            try:
-                await pubsub.unsubscribe()
-                await pubsub.close()
-                logger.debug(f"Closed pubsub connection for {agent_run_id}")
-            except Exception as e:
-                logger.warning(f"Error closing pubsub for {agent_run_id}: {str(e)}")
+        scheduler.run_finished()
+
+        # Stop the control listener and heartbeat
+        await run_control.close()
+
+        # Flush any responses still buffered in the sink, with timeout
+        if sink:
+            await sink.close(timeout=30.0)
+            sink_metrics = sink.metrics.to_dict()
+            logger.info(f"Response sink metrics for {agent_run_id}: {sink_metrics}")
+            trace.event(name="response_sink", level="DEFAULT", metadata=sink_metrics)
 
         # Set TTL on the response list in Redis
         await _cleanup_redis_response_list(agent_run_id)
 
+        # Archive the responses into the database off the completion path
+        try:
+            archive_agent_run.send(agent_run_id=agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to enqueue archiving of agent run {agent_run_id}: {str(e)}")
+
         # Remove the instance-specific active run key
-        await _cleanup_redis_instance_key(agent_run_id)
+        await _cleanup_redis_instance_key(agent_run_id, instance_id)
 
         # Clean up the run lock
         await _cleanup_redis_run_lock(agent_run_id)
 
-        # Wait for all pending redis operations to complete, with timeout
-        try:
-            await asyncio.wait_for(asyncio.gather(*pending_redis_operations), timeout=30.0)
-        except asyncio.TimeoutError:
-            logger.warning(f"Timeout waiting for pending Redis operations for {agent_run_id}")
+        # Keep the run profile where the API can read it
+        run_profile = finish_run_trace(trace_tokens)
+        if run_profile:
+            try:
+                await redis.set(profile_key(agent_run_id), dumps(run_profile), ex=config.TRACE_PROFILE_TTL)
+            except Exception as e:
+                logger.warning(f"Failed to store profile of agent run {agent_run_id}: {str(e)}")
 
         logger.info(f"Agent run background task fully completed for: {agent_run_id} (Instance: {instance_id}) with final status: {final_status}")
 
-async def _cleanup_redis_instance_key(agent_run_id: str):
-    """Clean up the instance-specific Redis key for an agent run."""
+# TTL for the per-thread summarization lock (10 minutes)
+SUMMARY_LOCK_TTL = 600
+
+@dramatiq.actor
+async def summarize_thread(thread_id: str, model_name: str):
+    """Write a rolling summary for a thread once its context crosses the token threshold."""
+    structlog.contextvars.clear_contextvars()
+    structlog.contextvars.bind_contextvars(
+        thread_id=thread_id,
+    )
+
+    try:
+        await initialize()
+    except Exception as e:
+        logger.critical(f"Failed to initialize Redis connection: {e}")
+        raise e
+
+    # Only one summarization per thread at a time
+    summary_lock_key = f"thread_summary_lock:{thread_id}"
+    lock_acquired = await redis.set(summary_lock_key, instance_id, nx=True, ex=SUMMARY_LOCK_TTL)
+    if not lock_acquired:
+        logger.info(f"Thread {thread_id} is already being summarized. Skipping.")
+        return
+
+    try:
+        context_manager = ContextManager()
+        await context_manager.check_and_summarize_if_needed(thread_id, model_name)
+    except Exception as e:
+        logger.error(f"Error summarizing thread {thread_id}: {str(e)}", exc_info=True)
+    finally:
+        try:
+            await redis.delete(summary_lock_key)
+        except Exception as e:
+            logger.warning(f"Failed to clean up Redis summary lock key {summary_lock_key}: {str(e)}")
+
+@dramatiq.actor(priority=100)
+async def archive_agent_run(agent_run_id: str):
+    """Archive the responses of a finished agent run into the database.
+
+    Low priority: runs and summaries pulled at the same time are processed first.
+    """
+    structlog.contextvars.clear_contextvars()
+    structlog.contextvars.bind_contextvars(
+        agent_run_id=agent_run_id,
+    )
+
+    try:
+        await initialize()
+    except Exception as e:
+        logger.critical(f"Failed to initialize Redis connection: {e}")
+        raise e
+
+    try:
+        client = await db.client
+        await archive_run(client, agent_run_id)
+    except Exception as e:
+        logger.error(f"Error archiving agent run {agent_run_id}: {str(e)}", exc_info=True)
+
+async def _cleanup_redis_instance_key(agent_run_id: str, instance_id: str):
+    """Remove an agent run from the active runs of the instance it was registered on."""
     if not instance_id:
         logger.warning("Instance ID not set, cannot clean up instance key.")
         return
-    key = f"active_run:{instance_id}:{agent_run_id}"
-    logger.debug(f"Cleaning up Redis instance key: {key}")
+    logger.debug(f"Unregistering active run {agent_run_id} from instance {instance_id}")
     try:
-        await redis.delete(key)
-        logger.debug(f"Successfully cleaned up Redis key: {key}")
+        await run_registry.unregister_run(instance_id, agent_run_id)
+        logger.debug(f"Successfully unregistered active run {agent_run_id}")
     except Exception as e:
-        logger.warning(f"Failed to clean up Redis key {key}: {str(e)}")
+        logger.warning(f"Failed to unregister active run {agent_run_id} from instance {instance_id}: {str(e)}")
 
 async def _cleanup_redis_run_lock(agent_run_id: str):
     """Clean up the run lock Redis key for an agent run."""
@@ -346,13 +413,12 @@ async def _cleanup_redis_run_lock(agent_run_id: str):
 REDIS_RESPONSE_LIST_TTL = 3600 * 24
 
 async def _cleanup_redis_response_list(agent_run_id: str):
-    """Set TTL on the Redis response list."""
-    response_list_key = f"agent_run:{agent_run_id}:responses"
+    """Set TTL on the Redis response list or stream."""
     try:
-        await redis.expire(response_list_key, REDIS_RESPONSE_LIST_TTL)
-        logger.debug(f"Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on response list: {response_list_key}")
+        await response_stream.expire_responses(agent_run_id, REDIS_RESPONSE_LIST_TTL)
+        logger.debug(f"Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on responses of agent run {agent_run_id}")
     except Exception as e:
-        logger.warning(f"Failed to set TTL on response list {response_list_key}: {str(e)}")
+        logger.warning(f"Failed to set TTL on responses of agent run {agent_run_id}: {str(e)}")
 
 async def update_agent_run_status(
     client,
@@ -383,15 +449,9 @@ async def update_agent_run_status(
             try:
                 update_result = await client.table('agent_runs').update(update_data).eq("id", agent_run_id).execute()
 
+                # The update returns the updated row, so no separate read is needed to verify it
                 if hasattr(update_result, 'data') and update_result.data:
                     logger.info(f"Successfully updated agent run {agent_run_id} status to '{status}' (retry {retry})")
-
-                    # Verify the update
-                    verify_result = await client.table('agent_runs').select('status', 'completed_at').eq("id", agent_run_id).execute()
-                    if verify_result.data:
-                        actual_status = verify_result.data[0].get('status')
-                        completed_at = verify_result.data[0].get('completed_at')
-                        logger.info(f"Verified agent run update: status={actual_status}, completed_at={completed_at}")
                     return True
                 else:
                     logger.warning(f"Database update returned no data for agent run {agent_run_id} on retry {retry}: {update_result}")
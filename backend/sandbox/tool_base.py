@@ -1,17 +1,21 @@
 from typing import Optional
 
 from agentpress.thread_manager import ThreadManager
+from agentpress.resource_scheduler import SANDBOX_RESOURCE
 from agentpress.tool import Tool
 from daytona_sdk import AsyncSandbox
 from sandbox.sandbox import get_or_start_sandbox
 from utils.logger import logger
 from utils.files_utils import clean_path
+from utils.tracing import span
 
 class SandboxToolsBase(Tool):
     """Base class for all sandbox tools that provides project-based sandbox access."""
     
     # Class variable to track if sandbox URLs have been printed
     _urls_printed = False
+
+    resource_class = SANDBOX_RESOURCE
     
     def __init__(self, project_id: str, thread_manager: Optional[ThreadManager] = None):
         super().__init__()
@@ -45,7 +49,8 @@ class SandboxToolsBase(Tool):
                 self._sandbox_pass = sandbox_info.get('pass')
                 
                 # Get or start the sandbox
-                self._sandbox = await get_or_start_sandbox(self._sandbox_id)
+                with span("sandbox.start", sandbox_id=self._sandbox_id):
+                    self._sandbox = await get_or_start_sandbox(self._sandbox_id)
                 
                 # # Log URLs if not already printed
                 # if not SandboxToolsBase._urls_printed:
@@ -5,12 +5,17 @@ stripe listen --forward-to localhost:8000/api/billing/webhook
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Request
-from typing import Optional, Dict, Tuple
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+import json
 import stripe
 from datetime import datetime, timezone
 from utils.logger import logger
 from utils.config import config, EnvMode
+from utils.metrics import BILLING_CHECK_SECONDS, timed
+from utils.pagination import decode_cursor, encode_cursor, keyset_pages
 from services.supabase import DBConnection
+from services import redis, stripe_api
+from utils.coalesce import CoalescingCache
 from utils.auth_utils import get_current_user_id_from_jwt
 from pydantic import BaseModel
 from utils.constants import MODEL_ACCESS_TIERS, MODEL_NAME_ALIASES, HARDCODED_MODEL_PRICES
@@ -128,7 +133,8 @@ async def get_stripe_customer_id(client, user_id: str) -> Optional[str]:
 async def create_stripe_customer(client, user_id: str, email: str) -> str:
     """Create a new Stripe customer for a user."""
     # Create customer in Stripe
-    customer = stripe.Customer.create(
+    customer = await stripe_api.call(
+        stripe.Customer.create,
         email=email,
         metadata={"user_id": user_id}
     )
@@ -143,8 +149,14 @@ async def create_stripe_customer(client, user_id: str, email: str) -> str:
     
     return customer.id
 
-async def get_user_subscription(user_id: str) -> Optional[Dict]:
-    """Get the current subscription for a user from Stripe."""
+async def get_user_subscription(user_id: str, use_cache: bool = True) -> Optional[Dict]:
+    """Get the current subscription for a user from Stripe.
+
+    Args:
+        user_id: The account ID
+        use_cache: Whether the subscriptions may come from the per-process
+                   cache of stripe_api, see list_active_subscriptions
+    """
     try:
         # Get customer ID
         db = DBConnection()
@@ -155,19 +167,15 @@ async def get_user_subscription(user_id: str) -> Optional[Dict]:
             return None
             
         # Get all active subscriptions for the customer
-        subscriptions = stripe.Subscription.list(
-            customer=customer_id,
-            status='active'
-        )
-        # print("Found subscriptions:", subscriptions)
+        subscriptions = await stripe_api.list_active_subscriptions(customer_id, use_cache=use_cache)
         
         # Check if we have any subscriptions
-        if not subscriptions or not subscriptions.get('data'):
+        if not subscriptions:
             return None
             
         # Filter subscriptions to only include our product's subscriptions
         our_subscriptions = []
-        for sub in subscriptions['data']:
+        for sub in subscriptions:
             # Get the first subscription item
             if sub.get('items') and sub['items'].get('data') and len(sub['items']['data']) > 0:
                 item = sub['items']['data'][0]
@@ -205,13 +213,15 @@ async def get_user_subscription(user_id: str) -> Optional[Dict]:
             for sub in our_subscriptions:
                 if sub['id'] != most_recent['id']:
                     try:
-                        stripe.Subscription.modify(
+                        await stripe_api.call(
+                            stripe.Subscription.modify,
                             sub['id'],
                             cancel_at_period_end=True
                         )
                         logger.info(f"Cancelled subscription {sub['id']} for user {user_id}")
                     except Exception as e:
                         logger.error(f"Error cancelling subscription {sub['id']}: {str(e)}")
+            stripe_api.invalidate_customer(customer_id)
             
             return most_recent
             
@@ -225,27 +235,15 @@ async def calculate_monthly_usage(client, user_id: str) -> float:
     """Calculate total agent run minutes for the current month for a user."""
     start_time = time.time()
     
-    # Use get_usage_logs to fetch all usage data (it already handles the date filtering and batching)
-    total_cost = 0.0
-    page = 0
-    items_per_page = 1000
-    
-    while True:
-        # Get usage logs for this page
-        usage_result = await get_usage_logs(client, user_id, page, items_per_page)
-        
-        if not usage_result['logs']:
-            break
-        
-        # Sum up the estimated costs from this page
-        for log_entry in usage_result['logs']:
-            total_cost += log_entry['estimated_cost']
-        
-        # If there are no more pages, break
-        if not usage_result['has_more']:
-            break
-            
-        page += 1
+    # The rollup holds the billable usage of the month, maintained as usage is recorded
+    month = get_usage_period_start().date().replace(day=1)
+    result = await client.table('usage_monthly_rollups') \
+        .select('cost') \
+        .eq('account_id', user_id) \
+        .eq('month', month.isoformat()) \
+        .limit(1) \
+        .execute()
+    total_cost = float(result.data[0]['cost']) if result.data else 0.0
     
     end_time = time.time()
     execution_time = end_time - start_time
@@ -254,8 +252,8 @@ async def calculate_monthly_usage(client, user_id: str) -> float:
     return total_cost
 
 
-async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: int = 1000) -> Dict:
-    """Get detailed usage logs for a user with pagination."""
+def get_usage_period_start() -> datetime:
+    """Get the start of the current billing period used for usage calculations."""
     # Get start of current month in UTC
     now = datetime.now(timezone.utc)
     start_of_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
@@ -264,111 +262,119 @@ async def get_usage_logs(client, user_id: str, page: int = 0, items_per_page: in
     # Ignore all token counts before this date
     cutoff_date = datetime(2025, 6, 30, 9, 0, 0, tzinfo=timezone.utc)
     
-    start_of_month = max(start_of_month, cutoff_date)
-    
-    # First get all threads for this user in batches
-    batch_size = 1000
-    offset = 0
-    all_threads = []
-    
-    while True:
-        threads_batch = await client.table('threads') \
-            .select('thread_id') \
+    return max(start_of_month, cutoff_date)
+
+
+def usage_ledger_entry(thread: Dict[str, Any], message_id: str, created_at: Optional[str], content: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the usage_ledger row of an assistant_response_end message.
+
+    Args:
+        thread: The thread with its thread_id, account_id, project_id and created_at
+        message_id: The ID of the assistant_response_end message
+        created_at: created_at of the message, or None for the current time
+        content: The message content with model and usage
+    """
+    usage = content.get('usage') or {}
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    model = content.get('model') or 'unknown'
+    entry = {
+        'account_id': thread['account_id'],
+        'thread_id': thread['thread_id'],
+        'project_id': thread.get('project_id'),
+        'message_id': message_id,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cost': calculate_token_cost(prompt_tokens, completion_tokens, model),
+        'thread_created_at': thread['created_at'],
+    }
+    if created_at:
+        entry['created_at'] = created_at
+    return entry
+
+
+def _usage_log_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a usage_ledger row into a usage log entry."""
+    prompt_tokens = entry.get('prompt_tokens') or 0
+    completion_tokens = entry.get('completion_tokens') or 0
+    return {
+        'message_id': entry['message_id'],
+        'thread_id': entry['thread_id'],
+        'created_at': entry['created_at'],
+        'content': {
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens
+            },
+            'model': entry['model']
+        },
+        'total_tokens': prompt_tokens + completion_tokens,
+        'estimated_cost': float(entry.get('cost') or 0),
+        'project_id': entry.get('project_id') or 'unknown'
+    }
+
+
+async def _usage_ledger_pages(
+    client, user_id: str, items_per_page: int = 1000, cursor: Optional[str] = None
+) -> AsyncGenerator[List[Dict[str, Any]], None]:
+    """Yield the billable usage ledger rows of a user newest first, paging by (created_at, message_id)."""
+    start_of_month = get_usage_period_start().isoformat()
+
+    def build_query():
+        # Only usage of threads created in the current period is billed
+        return client.table('usage_ledger') \
+            .select('message_id, thread_id, project_id, model, prompt_tokens, completion_tokens, cost, created_at') \
             .eq('account_id', user_id) \
-            .gte('created_at', start_of_month.isoformat()) \
-            .range(offset, offset + batch_size - 1) \
-            .execute()
-        
-        if not threads_batch.data:
-            break
-            
-        all_threads.extend(threads_batch.data)
-        
-        # If we got less than batch_size, we've reached the end
-        if len(threads_batch.data) < batch_size:
-            break
-            
-        offset += batch_size
-    
-    if not all_threads:
-        return {"logs": [], "has_more": False}
-    
-    thread_ids = [t['thread_id'] for t in all_threads]
-    
-    # Fetch usage messages with pagination, including thread project info
+            .gte('created_at', start_of_month) \
+            .gte('thread_created_at', start_of_month)
+
+    after = decode_cursor(cursor) if cursor else None
+    async for page in keyset_pages(build_query, desc=True, page_size=items_per_page, after=after):
+        yield page
+
+
+async def iter_usage_log_pages(client, user_id: str, items_per_page: int = 1000) -> AsyncGenerator[List[Dict[str, Any]], None]:
+    """Yield the usage logs of a user for the current period page by page, newest first."""
+    async for entries in _usage_ledger_pages(client, user_id, items_per_page):
+        yield [_usage_log_entry(entry) for entry in entries]
+
+
+async def get_usage_logs(
+    client, user_id: str, page: int = 0, items_per_page: int = 1000, cursor: Optional[str] = None
+) -> Dict:
+    """Get detailed usage logs for a user with pagination.
+
+    Pages are read by keyset: pass the next_cursor of a response as cursor to
+    get the page after it. page is only read when no cursor is given, and
+    skips that many pages first.
+    """
     start_time = time.time()
-    messages_result = await client.table('messages') \
-        .select(
-            'message_id, thread_id, created_at, content, threads!inner(project_id)'
-        ) \
-        .in_('thread_id', thread_ids) \
-        .eq('type', 'assistant_response_end') \
-        .gte('created_at', start_of_month.isoformat()) \
-        .order('created_at', desc=True) \
-        .range(page * items_per_page, (page + 1) * items_per_page - 1) \
-        .execute()
+    entries = []
+    pages = _usage_ledger_pages(client, user_id, items_per_page, cursor)
+    try:
+        page_index = 0
+        async for page_entries in pages:
+            if cursor or page_index == page:
+                entries = page_entries
+                break
+            page_index += 1
+    finally:
+        await pages.aclose()
     
-    end_time = time.time()
-    execution_time = end_time - start_time
+    execution_time = time.time() - start_time
     logger.info(f"Database query for usage logs took {execution_time:.3f} seconds")
 
-    if not messages_result.data:
-        return {"logs": [], "has_more": False}
+    if not entries:
+        return {"logs": [], "has_more": False, "next_cursor": None}
 
-    # Process messages into usage log entries
-    processed_logs = []
-    
-    for message in messages_result.data:
-        try:
-            # Safely extract usage data with defaults
-            content = message.get('content', {})
-            usage = content.get('usage', {})
-            
-            # Ensure usage has required fields with safe defaults
-            prompt_tokens = usage.get('prompt_tokens', 0)
-            completion_tokens = usage.get('completion_tokens', 0)
-            model = content.get('model', 'unknown')
-            
-            # Safely calculate total tokens
-            total_tokens = (prompt_tokens or 0) + (completion_tokens or 0)
-            
-            # Calculate estimated cost using the same logic as calculate_monthly_usage
-            estimated_cost = calculate_token_cost(
-                prompt_tokens,
-                completion_tokens,
-                model
-            )
-            
-            # Safely extract project_id from threads relationship
-            project_id = 'unknown'
-            if message.get('threads') and isinstance(message['threads'], list) and len(message['threads']) > 0:
-                project_id = message['threads'][0].get('project_id', 'unknown')
-            
-            processed_logs.append({
-                'message_id': message.get('message_id', 'unknown'),
-                'thread_id': message.get('thread_id', 'unknown'),
-                'created_at': message.get('created_at', None),
-                'content': {
-                    'usage': {
-                        'prompt_tokens': prompt_tokens,
-                        'completion_tokens': completion_tokens
-                    },
-                    'model': model
-                },
-                'total_tokens': total_tokens,
-                'estimated_cost': estimated_cost,
-                'project_id': project_id
-            })
-        except Exception as e:
-            logger.warning(f"Error processing usage log entry for message {message.get('message_id', 'unknown')}: {str(e)}")
-            continue
-    
-    # Check if there are more results
-    has_more = len(processed_logs) == items_per_page
+    # A full page means there may be more
+    has_more = len(entries) == items_per_page
     
     return {
-        "logs": processed_logs,
-        "has_more": has_more
+        "logs": [_usage_log_entry(entry) for entry in entries],
+        "has_more": has_more,
+        "next_cursor": encode_cursor(entries[-1]) if has_more else None
     }
 
 
@@ -438,6 +444,180 @@ def calculate_token_cost(prompt_tokens: int, completion_tokens: int, model: str)
         logger.error(f"Error calculating token cost for model {model}: {str(e)}")
         return 0.0
 
+# Billing gate cache
+#
+# check_billing_status runs before every agent loop iteration. Rather than
+# querying auth and Stripe and recomputing the month's usage every time, the
+# billing state of an account is kept in Redis and read with a single MGET:
+# - billing:unlimited:{account_id}: whitelist status, short TTL
+# - billing:subscription:{account_id}: the Stripe subscription, short TTL, dropped
+#   by stripe_webhook and checkout changes through invalidate_billing_cache
+# - billing:usage:{account_id}:{YYYY-MM}: running monthly spend, seeded from
+#   calculate_monthly_usage and incremented by record_usage whenever an
+#   assistant_response_end is written. It expires after BILLING_USAGE_COUNTER_TTL
+#   so it is periodically reconciled with the usage_monthly_rollups row.
+
+# Increment the usage counter only if it was seeded; a missing counter is recomputed from the database
+_INCREMENT_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+
+def _billing_cache_keys(user_id: str) -> Tuple[str, str, str]:
+    month = datetime.now(timezone.utc).strftime('%Y-%m')
+    return (
+        f"billing:unlimited:{user_id}",
+        f"billing:subscription:{user_id}",
+        f"billing:usage:{user_id}:{month}"
+    )
+
+
+_user_emails = CoalescingCache(ttl=config.BILLING_USER_EMAIL_CACHE_TTL, max_entries=10000)
+
+
+async def get_user_email(client, user_id: str) -> Optional[str]:
+    """Get the email of a user from auth, cached and with concurrent lookups coalesced.
+
+    Returns:
+        The email, or None if the user does not exist or has no email.
+    """
+    async def load() -> Optional[str]:
+        user_result = await client.auth.admin.get_user_by_id(user_id)
+        if user_result and user_result.user:
+            return user_result.user.email
+        return None
+
+    return await _user_emails.get(user_id, load)
+
+
+async def is_unlimited_user(client, user_id: str) -> bool:
+    """Check if a user is in the unlimited whitelist."""
+    try:
+        user_email = await get_user_email(client, user_id)
+        if user_email:
+            unlimited_users = get_unlimited_users()
+            if user_email in unlimited_users:
+                logger.info(f"✅ User {user_email} is in unlimited whitelist")
+                return True
+            logger.info(f"❌ User {user_email} is NOT in unlimited whitelist")
+    except Exception as e:
+        logger.warning(f"Could not check unlimited user status: {str(e)}")
+    return False
+
+
+async def get_cached_billing_state(client, user_id: str) -> Tuple[bool, Optional[Dict], float]:
+    """Get the unlimited status, subscription and monthly usage of an account.
+
+    Reads all three from Redis in one round trip and only falls back to auth,
+    Stripe or the usage calculation for values that are not cached.
+
+    Returns:
+        Tuple[bool, Optional[Dict], float]: (is_unlimited, subscription, current_usage)
+    """
+    unlimited_key, subscription_key, usage_key = _billing_cache_keys(user_id)
+    cached_unlimited = cached_subscription = cached_usage = None
+    redis_client = None
+    try:
+        redis_client = await redis.get_client()
+        cached_unlimited, cached_subscription, cached_usage = await redis_client.mget(unlimited_key, subscription_key, usage_key)
+    except Exception as e:
+        logger.warning(f"Could not read cached billing state for {user_id}: {str(e)}")
+
+    async def store(key: str, value: str, ex: int, nx: bool = False):
+        if redis_client is None:
+            return
+        try:
+            await redis_client.set(key, value, ex=ex, nx=nx)
+        except Exception as e:
+            logger.warning(f"Could not cache billing state {key}: {str(e)}")
+
+    if cached_unlimited is None:
+        unlimited = await is_unlimited_user(client, user_id)
+        await store(unlimited_key, '1' if unlimited else '0', config.BILLING_UNLIMITED_CACHE_TTL)
+    else:
+        unlimited = cached_unlimited == '1'
+    if unlimited:
+        return True, None, 0.0
+
+    if cached_subscription is None:
+        # The Redis entry was dropped or expired, so skip the per-process cache that could still hold the old state
+        subscription = await get_user_subscription(user_id, use_cache=False)
+        # Lookups that found nothing may be Stripe errors, so they are retried sooner
+        ttl = config.BILLING_SUBSCRIPTION_CACHE_TTL if subscription else min(60, config.BILLING_SUBSCRIPTION_CACHE_TTL)
+        await store(subscription_key, json.dumps({'subscription': subscription}, default=str), ttl)
+    else:
+        subscription = json.loads(cached_subscription)['subscription']
+
+    if cached_usage is None:
+        current_usage = await calculate_monthly_usage(client, user_id)
+        # Don't overwrite a counter seeded concurrently by another process
+        await store(usage_key, repr(current_usage), config.BILLING_USAGE_COUNTER_TTL, nx=True)
+    else:
+        current_usage = float(cached_usage)
+
+    return False, subscription, current_usage
+
+
+async def record_usage(client, thread: Dict[str, Any], message_id: str, created_at: Optional[str], content: Dict[str, Any]):
+    """Record the usage of an assistant_response_end message.
+
+    Appends it to the usage ledger, whose trigger adds it to the monthly
+    rollup, and adds its cost to the account's monthly spend counter.
+
+    Args:
+        client: Supabase async client
+        thread: The thread with its thread_id, account_id, project_id and created_at
+        message_id: The ID of the assistant_response_end message
+        created_at: created_at of the message, or None for the current time
+        content: The assistant_response_end message content with model and usage
+    """
+    entry = usage_ledger_entry(thread, message_id, created_at, content)
+    try:
+        # Idempotent on message_id, so a retried write is not counted twice
+        await client.table('usage_ledger').upsert(entry, on_conflict='message_id', ignore_duplicates=True).execute()
+    except Exception as e:
+        logger.warning(f"Could not append usage of message {message_id} to the ledger: {str(e)}")
+
+    if config.ENV_MODE == EnvMode.LOCAL:
+        return
+
+    # Mirror the rollups, which only count threads created in the current period
+    if datetime.fromisoformat(thread['created_at'].replace('Z', '+00:00')) < get_usage_period_start():
+        return
+
+    cost = entry['cost']
+    if cost <= 0:
+        return
+
+    try:
+        redis_client = await redis.get_client()
+        await redis_client.eval(_INCREMENT_IF_EXISTS_SCRIPT, 1, _billing_cache_keys(thread['account_id'])[2], cost)
+    except Exception as e:
+        logger.warning(f"Could not record usage of {cost} for account {thread['account_id']}: {str(e)}")
+
+
+async def invalidate_billing_cache(user_id: str, customer_id: Optional[str] = None):
+    """Drop the cached subscription and unlimited status of an account.
+
+    Args:
+        user_id: The account ID
+        customer_id: The Stripe customer of the account, whose subscriptions
+                     are also dropped from the cache of this process
+    """
+    _user_emails.invalidate(user_id)
+    if customer_id:
+        stripe_api.invalidate_customer(customer_id)
+    unlimited_key, subscription_key, _ = _billing_cache_keys(user_id)
+    try:
+        redis_client = await redis.get_client()
+        await redis_client.delete(unlimited_key, subscription_key)
+    except Exception as e:
+        logger.warning(f"Could not invalidate billing cache for {user_id}: {str(e)}")
+
+
 async def get_allowed_models_for_user(client, user_id: str):
     """Get the list of models allowed for a user based on their subscription tier."""
     if config.ENV_MODE == EnvMode.LOCAL:
@@ -446,9 +626,8 @@ async def get_allowed_models_for_user(client, user_id: str):
     
     # Check if user is in unlimited whitelist
     try:
-        user_result = await client.auth.admin.get_user_by_id(user_id)
-        if user_result and user_result.user and user_result.user.email:
-            user_email = user_result.user.email
+        user_email = await get_user_email(client, user_id)
+        if user_email:
             unlimited_users = get_unlimited_users()
             logger.info(f"🔍 Checking model access for user {user_email}")
             if user_email in unlimited_users:
@@ -478,6 +657,7 @@ async def get_allowed_models_for_user(client, user_id: str):
     return MODEL_ACCESS_TIERS.get(tier_name, MODEL_ACCESS_TIERS['free'])  # Default to free tier if unknown
 
 
+@timed(BILLING_CHECK_SECONDS, check="model_access")
 async def can_use_model(client, user_id: str, model_name: str):
     if config.ENV_MODE == EnvMode.LOCAL:
         logger.info("Running in local development mode - billing checks are disabled")
@@ -494,6 +674,7 @@ async def can_use_model(client, user_id: str, model_name: str):
     
     return False, f"Your current subscription plan does not include access to {model_name}. Please upgrade your subscription or choose from your available models: {', '.join(allowed_models)}", allowed_models
 
+@timed(BILLING_CHECK_SECONDS, check="billing_status")
 async def check_billing_status(client, user_id: str) -> Tuple[bool, str, Optional[Dict]]:
     """
     Check if a user can run agents based on their subscription and usage.
@@ -509,28 +690,15 @@ async def check_billing_status(client, user_id: str) -> Tuple[bool, str, Optiona
             "minutes_limit": "no limit"
         }
     
-    # Check if user is in unlimited whitelist
-    try:
-        user_result = await client.auth.admin.get_user_by_id(user_id)
-        if user_result and user_result.user and user_result.user.email:
-            user_email = user_result.user.email
-            unlimited_users = get_unlimited_users()
-            logger.info(f"🔍 Checking billing status for user {user_email}")
-            if user_email in unlimited_users:
-                logger.info(f"✅ User {user_email} is in unlimited whitelist - bypassing billing checks")
-                return True, "Unlimited tier user - no billing restrictions", {
-                    "price_id": "unlimited",
-                    "plan_name": "Unlimited ($200 tier)",
-                    "minutes_limit": "unlimited"
-                }
-            else:
-                logger.info(f"❌ User {user_email} is NOT in unlimited whitelist - checking billing")
-    except Exception as e:
-        logger.warning(f"Could not check unlimited user status: {str(e)}")
-    
-    # Get current subscription
-    subscription = await get_user_subscription(user_id)
-    # print("Current subscription:", subscription)
+    # Unlimited status, subscription and usage are served from the billing gate cache
+    unlimited, subscription, current_usage = await get_cached_billing_state(client, user_id)
+    if unlimited:
+        logger.debug(f"User {user_id} is in unlimited whitelist - bypassing billing checks")
+        return True, "Unlimited tier user - no billing restrictions", {
+            "price_id": "unlimited",
+            "plan_name": "Unlimited ($200 tier)",
+            "minutes_limit": "unlimited"
+        }
     
     # If no subscription, they can use free tier
     if not subscription:
@@ -552,9 +720,6 @@ async def check_billing_status(client, user_id: str) -> Tuple[bool, str, Optiona
         logger.warning(f"Unknown subscription tier: {price_id}, defaulting to free tier")
         tier_info = SUBSCRIPTION_TIERS[config.STRIPE_FREE_TIER_ID]
     
-    # Calculate current month's usage
-    current_usage = await calculate_monthly_usage(client, user_id)
-    
     # Check if within limits
     if current_usage >= tier_info['cost']:
         return False, f"Monthly limit of {tier_info['cost']} dollars reached. Please upgrade your plan or wait until next month.", subscription
@@ -574,9 +739,8 @@ async def create_checkout_session(
         client = await db.client
         
         # Get user email from auth.users
-        user_result = await client.auth.admin.get_user_by_id(current_user_id)
-        if not user_result: raise HTTPException(status_code=404, detail="User not found")
-        email = user_result.user.email
+        email = await get_user_email(client, current_user_id)
+        if not email: raise HTTPException(status_code=404, detail="User not found")
         
         # Get or create Stripe customer
         customer_id = await get_stripe_customer_id(client, current_user_id)
@@ -584,7 +748,7 @@ async def create_checkout_session(
          
         # Get the target price and product ID
         try:
-            price = stripe.Price.retrieve(request.price_id, expand=['product'])
+            price = await stripe_api.call(stripe.Price.retrieve, request.price_id, expand=['product'])
             product_id = price['product']['id']
         except stripe.error.InvalidRequestError:
             raise HTTPException(status_code=400, detail=f"Invalid price ID: {request.price_id}")
@@ -594,7 +758,8 @@ async def create_checkout_session(
             raise HTTPException(status_code=400, detail="Price ID does not belong to the correct product.")
             
         # Check for existing subscription for our product
-        existing_subscription = await get_user_subscription(current_user_id)
+        # Read from Stripe, a stale subscription here could create a second one
+        existing_subscription = await get_user_subscription(current_user_id, use_cache=False)
         # print("Existing subscription for product:", existing_subscription)
         
         if existing_subscription:
@@ -619,13 +784,14 @@ async def create_checkout_session(
                     }
                 
                 # Get current and new price details
-                current_price = stripe.Price.retrieve(current_price_id)
+                current_price = await stripe_api.call(stripe.Price.retrieve, current_price_id)
                 new_price = price # Already retrieved
                 is_upgrade = new_price['unit_amount'] > current_price['unit_amount']
 
                 if is_upgrade:
                     # --- Handle Upgrade --- Immediate modification
-                    updated_subscription = stripe.Subscription.modify(
+                    updated_subscription = await stripe_api.call(
+                        stripe.Subscription.modify,
                         subscription_id,
                         items=[{
                             'id': subscription_item['id'],
@@ -640,10 +806,11 @@ async def create_checkout_session(
                         {'active': True}
                     ).eq('id', customer_id).execute()
                     logger.info(f"Updated customer {customer_id} active status to TRUE after subscription upgrade")
+                    await invalidate_billing_cache(current_user_id, customer_id)
                     
                     latest_invoice = None
                     if updated_subscription.get('latest_invoice'):
-                       latest_invoice = stripe.Invoice.retrieve(updated_subscription['latest_invoice']) 
+                       latest_invoice = await stripe_api.call(stripe.Invoice.retrieve, updated_subscription['latest_invoice']) 
                     
                     return {
                         "subscription_id": updated_subscription['id'],
@@ -669,12 +836,12 @@ async def create_checkout_session(
                         
                         # Retrieve the subscription again to get the schedule ID if it exists
                         # This ensures we have the latest state before creating/modifying schedule
-                        sub_with_schedule = stripe.Subscription.retrieve(subscription_id)
+                        sub_with_schedule = await stripe_api.call(stripe.Subscription.retrieve, subscription_id)
                         schedule_id = sub_with_schedule.get('schedule')
 
                         # Get the current phase configuration from the schedule or subscription
                         if schedule_id:
-                            schedule = stripe.SubscriptionSchedule.retrieve(schedule_id)
+                            schedule = await stripe_api.call(stripe.SubscriptionSchedule.retrieve, schedule_id)
                             # Find the current phase in the schedule
                             # This logic assumes simple schedules; might need refinement for complex ones
                             current_phase = None
@@ -739,7 +906,8 @@ async def create_checkout_session(
                             logger.info(f"Updating existing schedule {schedule_id} for subscription {subscription_id}")
                             logger.debug(f"Current phase data: {current_phase_update_data}")
                             logger.debug(f"New phase data: {new_downgrade_phase_data}")
-                            updated_schedule = stripe.SubscriptionSchedule.modify(
+                            updated_schedule = await stripe_api.call(
+                                stripe.SubscriptionSchedule.modify,
                                 schedule_id,
                                 phases=[current_phase_update_data, new_downgrade_phase_data],
                                 end_behavior='release' 
@@ -754,7 +922,8 @@ async def create_checkout_session(
                             logger.debug(f"Current price: {current_price_id}, New price: {request.price_id}")
                             
                             try:
-                                updated_schedule = stripe.SubscriptionSchedule.create(
+                                updated_schedule = await stripe_api.call(
+                                    stripe.SubscriptionSchedule.create,
                                     from_subscription=subscription_id,
                                     phases=[
                                         {
@@ -786,7 +955,7 @@ async def create_checkout_session(
                                 # print(f"Created new schedule {updated_schedule['id']} from subscription {subscription_id}")
                                 
                                 # Verify the schedule was created correctly
-                                fetched_schedule = stripe.SubscriptionSchedule.retrieve(updated_schedule['id'])
+                                fetched_schedule = await stripe_api.call(stripe.SubscriptionSchedule.retrieve, updated_schedule['id'])
                                 logger.info(f"Schedule verification - Status: {fetched_schedule.get('status')}, Phase Count: {len(fetched_schedule.get('phases', []))}")
                                 logger.debug(f"Schedule details: {fetched_schedule}")
                             except Exception as schedule_error:
@@ -814,7 +983,8 @@ async def create_checkout_session(
                 raise HTTPException(status_code=500, detail=f"Error updating subscription: {str(e)}")
         else:
             
-            session = stripe.checkout.Session.create(
+            session = await stripe_api.call(
+                stripe.checkout.Session.create,
                 customer=customer_id,
                 payment_method_types=['card'],
                     line_items=[{'price': request.price_id, 'quantity': 1}],
@@ -866,7 +1036,7 @@ async def create_portal_session(
         # Ensure the portal configuration has subscription_update enabled
         try:
             # First, check if we have a configuration that already enables subscription update
-            configurations = stripe.billing_portal.Configuration.list(limit=100)
+            configurations = await stripe_api.call(stripe.billing_portal.Configuration.list, limit=100)
             active_config = None
             
             # Look for a configuration with subscription_update enabled
@@ -885,7 +1055,8 @@ async def create_portal_session(
                     default_config = configurations['data'][0]
                     logger.info(f"Updating default portal configuration: {default_config['id']} to enable subscription_update")
                     
-                    active_config = stripe.billing_portal.Configuration.update(
+                    active_config = await stripe_api.call(
+                        stripe.billing_portal.Configuration.update,
                         default_config['id'],
                         features={
                             'subscription_update': {
@@ -902,7 +1073,8 @@ async def create_portal_session(
                 else:
                     # Create a new configuration with subscription_update enabled
                     logger.info("Creating new portal configuration with subscription_update enabled")
-                    active_config = stripe.billing_portal.Configuration.create(
+                    active_config = await stripe_api.call(
+                        stripe.billing_portal.Configuration.create,
                         business_profile={
                             'headline': 'Subscription Management',
                             'privacy_policy_url': config.FRONTEND_URL + '/privacy',
@@ -940,7 +1112,7 @@ async def create_portal_session(
             portal_params["configuration"] = active_config['id']
         
         # Create the session
-        session = stripe.billing_portal.Session.create(**portal_params)
+        session = await stripe_api.call(stripe.billing_portal.Session.create, **portal_params)
         
         return {"url": session.url}
         
@@ -960,9 +1132,8 @@ async def get_subscription(
         
         # Check if user is in unlimited whitelist FIRST
         try:
-            user_result = await client.auth.admin.get_user_by_id(current_user_id)
-            if user_result and user_result.user and user_result.user.email:
-                user_email = user_result.user.email
+            user_email = await get_user_email(client, current_user_id)
+            if user_email:
                 unlimited_users = get_unlimited_users()
                 if user_email in unlimited_users:
                     logger.info(f"✅ User {user_email} is in unlimited whitelist - returning unlimited subscription status")
@@ -1026,7 +1197,7 @@ async def get_subscription(
         schedule_id = subscription.get('schedule')
         if schedule_id:
             try:
-                schedule = stripe.SubscriptionSchedule.retrieve(schedule_id)
+                schedule = await stripe_api.call(stripe.SubscriptionSchedule.retrieve, schedule_id)
                 # Find the *next* phase after the current one
                 next_phase = None
                 current_phase_end = current_item['current_period_end']
@@ -1126,11 +1297,7 @@ async def stripe_webhook(request: Request):
                 else:
                     # Subscription is not active (e.g., past_due, canceled, etc.)
                     # Check if customer has any other active subscriptions before updating status
-                    has_active = len(stripe.Subscription.list(
-                        customer=customer_id,
-                        status='active',
-                        limit=1
-                    ).get('data', [])) > 0
+                    has_active = len(await stripe_api.list_active_subscriptions(customer_id, use_cache=False)) > 0
                     
                     if not has_active:
                         await client.schema('basejump').from_('billing_customers').update(
@@ -1140,11 +1307,7 @@ async def stripe_webhook(request: Request):
             
             elif event.type == 'customer.subscription.deleted':
                 # Check if customer has any other active subscriptions
-                has_active = len(stripe.Subscription.list(
-                    customer=customer_id,
-                    status='active',
-                    limit=1
-                ).get('data', [])) > 0
+                has_active = len(await stripe_api.list_active_subscriptions(customer_id, use_cache=False)) > 0
                 
                 if not has_active:
                     # If no active subscriptions left, set active to false
@@ -1153,6 +1316,15 @@ async def stripe_webhook(request: Request):
                     ).eq('id', customer_id).execute()
                     logger.info(f"Webhook: Updated customer {customer_id} active status to FALSE after subscription deletion")
             
+            # Drop the cached subscription so the billing gate sees the change immediately
+            customer_result = await client.schema('basejump').from_('billing_customers') \
+                .select('account_id') \
+                .eq('id', customer_id) \
+                .execute()
+            stripe_api.invalidate_customer(customer_id)
+            for customer in customer_result.data or []:
+                await invalidate_billing_cache(customer['account_id'], customer_id)
+            
             logger.info(f"Processed {event.type} event for customer {customer_id}")
         
         return {"status": "success"}
@@ -1342,9 +1514,13 @@ async def get_available_models(
 async def get_usage_logs_endpoint(
     page: int = 0,
     items_per_page: int = 1000,
+    cursor: Optional[str] = None,
     current_user_id: str = Depends(get_current_user_id_from_jwt)
 ):
-    """Get detailed usage logs for a user with pagination."""
+    """Get detailed usage logs for a user with pagination.
+
+    Pass the next_cursor of a response as cursor to get the following page.
+    """
     try:
         # Get Supabase client
         db = DBConnection()
@@ -1365,8 +1541,14 @@ async def get_usage_logs_endpoint(
         if items_per_page < 1 or items_per_page > 1000:
             raise HTTPException(status_code=400, detail="Items per page must be between 1 and 1000")
         
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        
         # Get usage logs
-        result = await get_usage_logs(client, current_user_id, page, items_per_page)
+        result = await get_usage_logs(client, current_user_id, page, items_per_page, cursor=cursor)
         
         return result
         
@@ -19,6 +19,7 @@ import litellm
 from litellm.files.main import ModelResponse
 from utils.logger import logger
 from utils.config import config
+from utils.tracing import traced
 
 # litellm.set_verbose=True
 litellm.modify_params=True
@@ -277,6 +278,7 @@ def prepare_params(
 
     return params
 
+@traced("llm.request")
 async def make_llm_api_call(
     messages: List[Dict[str, Any]],
     model_name: str,
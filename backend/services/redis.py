@@ -5,6 +5,8 @@ import asyncio
 from utils.logger import logger
 from typing import List, Any
 from utils.retry import retry
+from utils.metrics import REDIS_OP_SECONDS, timed
+from utils.tracing import traced
 from urllib.parse import urlparse
 import ssl
 
@@ -18,6 +20,13 @@ _init_lock = asyncio.Lock()
 REDIS_KEY_TTL = 3600 * 24  # 24 hour TTL as safety mechanism
 
 
+def _instrumented(op: str):
+    """Observe the latency of a Redis helper and record its calls as spans."""
+    def decorator(func):
+        return traced(f"redis.{op}")(timed(REDIS_OP_SECONDS, op=op)(func))
+    return decorator
+
+
 def initialize():
     """Initialize Redis connection pool and client using environment variables."""
     global client, pool
@@ -176,12 +185,14 @@ async def get_client():
 
 
 # Basic Redis operations
+@_instrumented("set")
 async def set(key: str, value: str, ex: int = None, nx: bool = False):
     """Set a Redis key."""
     redis_client = await get_client()
     return await redis_client.set(key, value, ex=ex, nx=nx)
 
 
+@_instrumented("get")
 async def get(key: str, default: str = None):
     """Get a Redis key."""
     redis_client = await get_client()
@@ -189,12 +200,20 @@ async def get(key: str, default: str = None):
     return result if result is not None else default
 
 
+@_instrumented("delete")
 async def delete(key: str):
     """Delete a Redis key."""
     redis_client = await get_client()
     return await redis_client.delete(key)
 
 
+@_instrumented("incr")
+async def incr(key: str):
+    """Increment an integer Redis key."""
+    redis_client = await get_client()
+    return await redis_client.incr(key)
+
+
 async def check_redis_health():
     """Check Redis health by attempting to ping."""
     try:
@@ -206,6 +225,7 @@ async def check_redis_health():
         return {"status": "unhealthy", "error": str(e)}
 
 
+@_instrumented("publish")
 async def publish(channel: str, message: str):
     """Publish a message to a Redis channel."""
     redis_client = await get_client()
@@ -219,12 +239,14 @@ async def create_pubsub():
 
 
 # List operations
+@_instrumented("rpush")
 async def rpush(key: str, *values: Any):
     """Append one or more values to a list."""
     redis_client = await get_client()
     return await redis_client.rpush(key, *values)
 
 
+@_instrumented("lrange")
 async def lrange(key: str, start: int, end: int) -> List[str]:
     """Get a range of elements from a list."""
     redis_client = await get_client()
@@ -234,11 +256,42 @@ async def lrange(key: str, start: int, end: int) -> List[str]:
 # Key management
 
 
+@_instrumented("keys")
 async def keys(pattern: str) -> List[str]:
     redis_client = await get_client()
     return await redis_client.keys(pattern)
 
 
+@_instrumented("expire")
 async def expire(key: str, seconds: int):
     redis_client = await get_client()
     return await redis_client.expire(key, seconds)
+
+
+@_instrumented("exists")
+async def exists(*keys: str) -> int:
+    """Count how many of the given keys exist."""
+    redis_client = await get_client()
+    return await redis_client.exists(*keys)
+
+
+# Stream operations
+@_instrumented("xadd")
+async def xadd(key: str, fields: dict, maxlen: int = None, approximate: bool = True) -> str:
+    """Append an entry to a stream, returning its ID."""
+    redis_client = await get_client()
+    return await redis_client.xadd(key, fields, maxlen=maxlen, approximate=approximate)
+
+
+@_instrumented("xread")
+async def xread(streams: dict, count: int = None, block: int = None):
+    """Read entries newer than the given IDs from one or more streams."""
+    redis_client = await get_client()
+    return await redis_client.xread(streams, count=count, block=block)
+
+
+@_instrumented("xrange")
+async def xrange(key: str, min: str = "-", max: str = "+", count: int = None):
+    """Get a range of entries from a stream."""
+    redis_client = await get_client()
+    return await redis_client.xrange(key, min=min, max=max, count=count)
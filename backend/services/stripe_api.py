@@ -0,0 +1,58 @@
+"""
+Non-blocking access to the Stripe API.
+
+The stripe library is synchronous: calling it from a request handler or the
+agent loop blocks the event loop, and every other request and run of the
+process, for the whole HTTP round trip. call() runs Stripe methods in a
+worker thread instead:
+
+    price = await stripe_api.call(stripe.Price.retrieve, price_id, expand=['product'])
+
+The active subscriptions of a customer, which are read by every billing
+check, are also cached per customer for STRIPE_SUBSCRIPTION_CACHE_TTL
+seconds, and concurrent lookups of the same customer share a single Stripe
+request. stripe_webhook and subscription changes drop the cached entry with
+invalidate_customer(). The cache is per process, so other processes may see
+the old subscriptions until their entry expires; callers that need the
+current state pass use_cache=False.
+"""
+
+import asyncio
+from typing import Any, Callable, Dict, List
+
+import stripe
+
+from utils.coalesce import CoalescingCache
+from utils.config import config
+from utils.tracing import span
+
+_subscriptions = CoalescingCache(
+    ttl=config.STRIPE_SUBSCRIPTION_CACHE_TTL,
+    max_entries=config.STRIPE_SUBSCRIPTION_CACHE_SIZE,
+)
+
+
+async def call(method: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call a method of the stripe library without blocking the event loop."""
+    with span(f"stripe.{getattr(method, '__qualname__', 'call')}"):
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+
+async def list_active_subscriptions(customer_id: str, use_cache: bool = True) -> List[Dict[str, Any]]:
+    """Get the active subscriptions of a Stripe customer.
+
+    Args:
+        customer_id: The Stripe customer ID
+        use_cache: Whether a cached list may be returned. Concurrent lookups
+                   are coalesced either way.
+    """
+    async def load() -> List[Dict[str, Any]]:
+        subscriptions = await call(stripe.Subscription.list, customer=customer_id, status='active')
+        return list(subscriptions.get('data') or []) if subscriptions else []
+
+    return await _subscriptions.get(customer_id, load, use_cache=use_cache)
+
+
+def invalidate_customer(customer_id: str):
+    """Drop the cached subscriptions of a Stripe customer in this process."""
+    _subscriptions.invalidate(customer_id)
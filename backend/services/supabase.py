@@ -6,10 +6,33 @@ from typing import Optional
 from supabase import create_async_client, AsyncClient
 from utils.logger import logger
 from utils.config import config
+from utils.metrics import SUPABASE_REQUEST_SECONDS
+from utils.tracing import end_span, start_span
 import base64
 import uuid
 from datetime import datetime
 import threading
+import time
+
+
+def _request_table(request) -> str:
+    # PostgREST paths are /rest/v1/{table} or /rest/v1/rpc/{function}
+    return request.url.path.split('/rest/v1/', 1)[-1] or 'unknown'
+
+
+async def _mark_request_start(request):
+    request.extensions['metrics_started_at'] = time.perf_counter()
+    request.extensions['trace_span'] = start_span(f"supabase.{_request_table(request)}", method=request.method)
+
+
+async def _observe_response(response):
+    request = response.request
+    end_span(request.extensions.get('trace_span'), status=response.status_code)
+    started_at = request.extensions.get('metrics_started_at')
+    if started_at is None:
+        return
+    SUPABASE_REQUEST_SECONDS.labels(table=_request_table(request), method=request.method).observe(time.perf_counter() - started_at)
+
 
 class DBConnection:
     """Thread-safe singleton database connection manager using Supabase."""
@@ -53,6 +76,8 @@ class DBConnection:
                 supabase_key,
             )
             
+            self._instrument_postgrest()
+
             self._initialized = True
             key_type = "SERVICE_ROLE_KEY" if config.SUPABASE_SERVICE_ROLE_KEY else "ANON_KEY"
             logger.debug(f"Database connection initialized with Supabase using {key_type}")
@@ -61,6 +86,18 @@ class DBConnection:
             logger.error(f"Database initialization error: {e}")
             raise RuntimeError(f"Failed to initialize database connection: {str(e)}")
 
+    def _instrument_postgrest(self):
+        """Observe the latency of every PostgREST request of the client per table and trace it as a span."""
+        try:
+            # The service role client never signs in, so its PostgREST session lives as long as the client
+            session = self._client.postgrest.session
+            session.event_hooks = {
+                'request': [*session.event_hooks['request'], _mark_request_start],
+                'response': [*session.event_hooks['response'], _observe_response],
+            }
+        except Exception as e:
+            logger.warning(f"Failed to instrument Supabase requests: {e}")
+
     @classmethod
     async def disconnect(cls):
         """Disconnect from the database."""
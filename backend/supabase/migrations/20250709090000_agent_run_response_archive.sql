@@ -0,0 +1,14 @@
+-- Migration: Compressed response archive for finished agent runs
+-- Runs used to store every streamed response, one row per token chunk, in
+-- agent_runs.responses. The run archiver instead stores the responses with
+-- consecutive content chunks merged, compressed and base64 encoded.
+
+BEGIN;
+
+ALTER TABLE agent_runs ADD COLUMN IF NOT EXISTS responses_archive TEXT;
+ALTER TABLE agent_runs ADD COLUMN IF NOT EXISTS responses_archive_encoding TEXT;
+
+COMMENT ON COLUMN agent_runs.responses_archive IS 'Base64 of the compressed JSON array of the run responses, with consecutive content chunks merged';
+COMMENT ON COLUMN agent_runs.responses_archive_encoding IS 'Compression of responses_archive: zstd or zlib';
+
+COMMIT;
@@ -0,0 +1,49 @@
+-- Migration: Thread head RPC for the agent loop
+-- Each iteration of the agent loop read the latest assistant/tool/user
+-- message, the latest browser_state and the latest image_context of the
+-- thread with three select('*') queries. get_thread_head returns the ids and
+-- types of those messages in a single round trip, without their content.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION get_thread_head(p_thread_id UUID)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+    SELECT jsonb_build_object(
+        'turn', (
+            SELECT jsonb_build_object('message_id', m.message_id, 'type', m.type)
+            FROM messages m
+            WHERE m.thread_id = p_thread_id
+              AND m.type IN ('assistant', 'tool', 'user')
+            ORDER BY m.created_at DESC
+            LIMIT 1
+        ),
+        'browser_state', (
+            SELECT jsonb_build_object('message_id', m.message_id)
+            FROM messages m
+            WHERE m.thread_id = p_thread_id
+              AND m.type = 'browser_state'
+            ORDER BY m.created_at DESC
+            LIMIT 1
+        ),
+        'image_context', (
+            SELECT jsonb_build_object('message_id', m.message_id)
+            FROM messages m
+            WHERE m.thread_id = p_thread_id
+              AND m.type = 'image_context'
+            ORDER BY m.created_at DESC
+            LIMIT 1
+        )
+    );
+$$;
+
+REVOKE ALL ON FUNCTION get_thread_head(UUID) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION get_thread_head(UUID) TO service_role;
+
+COMMENT ON FUNCTION get_thread_head(UUID) IS 'Ids of the latest assistant/tool/user, browser_state and image_context messages of a thread, read by the agent loop';
+
+COMMIT;
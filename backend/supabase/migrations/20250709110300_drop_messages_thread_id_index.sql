@@ -0,0 +1,9 @@
+-- Migration: Composite indexes for the hot paths on messages (4/4)
+-- idx_messages_thread_id is superseded by idx_messages_thread_created, which
+-- has thread_id as its leading column.
+-- See 20250709110000_messages_thread_created_index.sql.
+--
+--   Query: SELECT count(*) FROM messages WHERE thread_id = $1;
+--   Expected: Index Only Scan or Bitmap Index Scan using idx_messages_thread_created
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_thread_id;
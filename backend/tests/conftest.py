@@ -0,0 +1,9 @@
+import os
+
+# utils.config refuses to load without these; the unit tests never reach the services
+for name in (
+    "SUPABASE_URL", "SUPABASE_ANON_KEY", "SUPABASE_SERVICE_ROLE_KEY",
+    "DAYTONA_API_KEY", "DAYTONA_SERVER_URL", "DAYTONA_TARGET",
+    "TAVILY_API_KEY", "RAPID_API_KEY", "FIRECRAWL_API_KEY",
+):
+    os.environ.setdefault(name, "test")
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from utils.coalesce import CoalescingCache
+
+
+class Loader:
+    """Counts calls and lets the test decide when a load finishes."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        return self.calls
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_concurrent_misses_share_one_load():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    load = Loader()
+    callers = [asyncio.create_task(cache.get("key", load)) for _ in range(10)]
+    await settle()
+    load.release.set()
+    assert await asyncio.gather(*callers) == [1] * 10
+    assert load.calls == 1
+
+
+async def test_cached_value_is_reused_until_bypassed():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    load = Loader()
+    load.release.set()
+    assert await cache.get("key", load) == 1
+    assert await cache.get("key", load) == 1
+    assert await cache.get("key", load, use_cache=False) == 2
+    # The bypassing load refreshed the cached value
+    assert await cache.get("key", load) == 2
+
+
+async def test_expired_value_is_reloaded(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.coalesce.time.monotonic", lambda: now[0])
+    cache = CoalescingCache(ttl=30, max_entries=10)
+    load = Loader()
+    load.release.set()
+    assert await cache.get("key", load) == 1
+    now[0] += 31
+    assert await cache.get("key", load) == 2
+
+
+async def test_zero_ttl_coalesces_without_caching():
+    cache = CoalescingCache(ttl=0, max_entries=10)
+    load = Loader()
+    callers = [asyncio.create_task(cache.get("key", load)) for _ in range(3)]
+    await settle()
+    load.release.set()
+    assert await asyncio.gather(*callers) == [1, 1, 1]
+    assert await cache.get("key", load) == 2
+
+
+async def test_lru_evicts_least_recently_used():
+    cache = CoalescingCache(ttl=60, max_entries=2)
+
+    async def value_of(key):
+        return key
+
+    await cache.get("a", lambda: value_of("a"))
+    await cache.get("b", lambda: value_of("b"))
+    await cache.get("a", lambda: value_of("unused"))
+    await cache.get("c", lambda: value_of("c"))
+    assert await cache.get("a", lambda: value_of("reloaded")) == "a"
+    assert await cache.get("b", lambda: value_of("reloaded")) == "reloaded"
+
+
+async def test_invalidate_detaches_in_flight_load():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    stale = Loader()
+    before = asyncio.create_task(cache.get("key", stale))
+    await settle()
+
+    cache.invalidate("key")
+    fresh = Loader()
+    fresh.calls = 10
+    after = asyncio.create_task(cache.get("key", fresh))
+    await settle()
+    # The caller after the invalidation started its own load instead of joining the stale one
+    assert fresh.calls == 11
+
+    stale.release.set()
+    fresh.release.set()
+    assert await before == 1
+    assert await after == 11
+
+    # The stale load finished last but did not overwrite the cached value
+    assert await cache.get("key", Loader()) == 11
+
+
+async def test_invalidated_stale_load_is_not_cached():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    stale = Loader()
+    caller = asyncio.create_task(cache.get("key", stale))
+    await settle()
+    cache.invalidate("key")
+    stale.release.set()
+    assert await caller == 1
+
+    fresh = Loader()
+    fresh.calls = 100
+    fresh.release.set()
+    assert await cache.get("key", fresh) == 101
+
+
+async def test_exceptions_propagate_and_are_not_cached():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(cache.get("key", failing), cache.get("key", failing), return_exceptions=True)
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert calls == 1
+
+    with pytest.raises(ValueError):
+        await cache.get("key", failing)
+    assert calls == 2
+
+
+async def test_cancelled_caller_does_not_cancel_shared_load():
+    cache = CoalescingCache(ttl=60, max_entries=10)
+    load = Loader()
+    cancelled = asyncio.create_task(cache.get("key", load))
+    other = asyncio.create_task(cache.get("key", load))
+    await settle()
+
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    load.release.set()
+    assert await other == 1
+    assert load.calls == 1
@@ -0,0 +1,133 @@
+import copy
+import json
+import uuid
+
+import pytest
+
+from agentpress import token_cache
+from agentpress.context_manager import ContextManager
+from agentpress.token_cache import MessageTokenCache
+
+MODEL = "gpt-4o"
+THRESHOLD = 4096
+
+
+class FakeTokenizer:
+    """Stands in for litellm's token_counter: 4 characters per token, with its
+    per-message and per-call priming overhead, counting what it tokenizes."""
+
+    def __init__(self):
+        self.calls = 0
+        self.messages = 0
+
+    def __call__(self, model=None, messages=None, **kwargs):
+        self.calls += 1
+        self.messages += len(messages)
+        return 3 + sum(3 + len(self.text(msg)) // 4 for msg in messages)
+
+    @staticmethod
+    def text(msg):
+        content = msg.get("content")
+        return content if isinstance(content, str) else json.dumps(content)
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    tokenizer = FakeTokenizer()
+    monkeypatch.setattr(token_cache, "token_counter", tokenizer)
+    return tokenizer
+
+
+@pytest.fixture
+def manager():
+    manager = ContextManager()
+    manager.token_cache = MessageTokenCache(max_entries=100000)
+    return manager
+
+
+def legacy_compress_messages(manager, tokenizer, messages, max_tokens, token_threshold=THRESHOLD, max_iterations=5):
+    """The multi-pass compress_messages that the single-pass compressor replaced."""
+    result = manager.remove_meta_messages(messages)
+    tokenizer(model=MODEL, messages=result)
+
+    for kind_matches in (
+        manager.is_tool_result_message,
+        lambda msg: msg.get("role") == "user",
+        lambda msg: msg.get("role") == "assistant",
+    ):
+        if tokenizer(model=MODEL, messages=result) <= max_tokens:
+            continue
+        seen = 0
+        for msg in reversed(result):
+            if not kind_matches(msg):
+                continue
+            seen += 1
+            if tokenizer(messages=[msg]) > token_threshold:
+                if seen > 1:
+                    msg["content"] = manager.compress_message(msg["content"], msg["message_id"], token_threshold * 3)
+                else:
+                    msg["content"] = manager.safe_truncate(msg["content"], int(max_tokens * 2))
+
+    if max_iterations <= 0:
+        return manager.compress_messages_by_omitting_messages(messages, MODEL, max_tokens)
+    if tokenizer(model=MODEL, messages=result) > max_tokens:
+        return legacy_compress_messages(manager, tokenizer, messages, max_tokens, token_threshold // 2, max_iterations - 1)
+    return manager.middle_out_messages(result)
+
+
+def long_thread(length):
+    messages = [{"role": "system", "content": "You are a helpful agent."}]
+    for i in range(length):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"{role} message {i} " + "x" * 20000, "message_id": str(uuid.UUID(int=i))})
+    return messages
+
+
+def compressed_at_first_level(manager, messages):
+    """The thread with every message but the newest user and assistant message compressed once."""
+    expected = copy.deepcopy(messages)
+    for msg in expected[1:-2]:
+        msg["content"] = manager.compress_message(msg["content"], msg["message_id"], THRESHOLD * 3)
+    return expected
+
+
+def test_thread_within_budget_is_returned_unchanged(manager, tokenizer):
+    messages = long_thread(10)
+    manager.get_model_max_tokens = lambda model: 10 ** 6
+    assert manager.compress_messages(copy.deepcopy(messages), MODEL) == messages
+
+
+def test_matches_multi_pass_compressor_with_fewer_tokenizations(manager, tokenizer):
+    messages = long_thread(200)
+    expected = compressed_at_first_level(manager, messages)
+    # The budget is only met once every older message is compressed at the first level
+    budget = FakeTokenizer()(messages=expected) + 10
+    manager.get_model_max_tokens = lambda model: budget
+
+    legacy = FakeTokenizer()
+    legacy_results = [legacy_compress_messages(manager, legacy, copy.deepcopy(messages), budget) for _ in range(2)]
+    results = [manager.compress_messages(copy.deepcopy(messages), MODEL) for _ in range(2)]
+
+    assert results == legacy_results == [expected, expected]
+    assert tokenizer.calls < legacy.calls
+    assert tokenizer.messages < legacy.messages
+
+
+def test_repeated_compression_of_a_thread_does_not_tokenize_again(manager, tokenizer):
+    messages = long_thread(200)
+    manager.get_model_max_tokens = lambda model: FakeTokenizer()(messages=compressed_at_first_level(manager, messages)) + 10
+    manager.compress_messages(copy.deepcopy(messages), MODEL)
+    calls = tokenizer.calls
+
+    manager.compress_messages(copy.deepcopy(messages), MODEL)
+    assert tokenizer.calls == calls
+
+
+def test_newest_messages_of_each_kind_are_never_compressed(manager, tokenizer):
+    messages = long_thread(40)
+    manager.get_model_max_tokens = lambda model: 12000
+
+    result = manager.compress_messages(copy.deepcopy(messages), MODEL)
+
+    assert [msg["content"] for msg in result[-2:]] == [msg["content"] for msg in messages[-2:]]
+    assert all("expand-message" in msg["content"] for msg in result[1:-2])
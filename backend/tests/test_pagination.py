@@ -0,0 +1,117 @@
+import re
+
+import pytest
+
+from utils.pagination import decode_cursor, encode_cursor, keyset_filter, keyset_pages
+
+
+def test_keyset_filter_quotes_timestamps():
+    assert keyset_filter(('created_at', 'message_id'), ['2025-07-09T10:00:00.123+00:00', 'abc']) == (
+        'created_at.gt."2025-07-09T10:00:00.123+00:00",'
+        'and(created_at.eq."2025-07-09T10:00:00.123+00:00",message_id.gt."abc")'
+    )
+
+
+def test_keyset_filter_descending():
+    assert keyset_filter(('created_at', 'message_id'), ['t', 'm'], desc=True) == (
+        'created_at.lt."t",and(created_at.eq."t",message_id.lt."m")'
+    )
+
+
+def test_keyset_filter_single_key():
+    assert keyset_filter(('thread_id',), ['x']) == 'thread_id.gt."x"'
+
+
+def test_keyset_filter_escapes_quotes():
+    assert keyset_filter(('name',), ['a"b\\c']) == 'name.gt."a\\"b\\\\c"'
+
+
+def test_cursor_round_trip():
+    row = {'created_at': '2025-07-09T10:00:00+00:00', 'message_id': 'abc', 'content': {}}
+    assert decode_cursor(encode_cursor(row)) == ['2025-07-09T10:00:00+00:00', 'abc']
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "bnVsbA==", "WyJvbmx5Il0="])
+def test_decode_cursor_rejects_malformed(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+class FakeQuery:
+    """Applies the keyset filter of keyset_pages to in-memory rows."""
+
+    def __init__(self, rows, executed):
+        self.rows = rows
+        self.executed = executed
+        self.after = None
+        self.desc = False
+        self.page_size = None
+
+    def or_(self, filters):
+        op, created_at = re.match(r'created_at\.(gt|lt)\."([^"]*)"', filters).groups()
+        message_id = re.search(r'message_id\.(?:gt|lt)\."([^"]*)"', filters).group(1)
+        self.after = (created_at, message_id)
+        return self
+
+    def order(self, key, desc=False):
+        self.desc = desc
+        return self
+
+    def limit(self, page_size):
+        self.page_size = page_size
+        return self
+
+    async def execute(self):
+        self.executed.append(self.after)
+        key = lambda row: (row['created_at'], row['message_id'])
+        rows = sorted(self.rows, key=key, reverse=self.desc)
+        if self.after is not None:
+            rows = [row for row in rows if (key(row) < self.after if self.desc else key(row) > self.after)]
+
+        class Result:
+            data = rows[:self.page_size]
+        return Result
+
+
+def make_rows(count):
+    # Three rows per timestamp, so pages split rows with equal created_at
+    return [{'created_at': f"2025-07-09T10:00:0{i // 3}+00:00", 'message_id': f"m{i:02d}"} for i in range(count)]
+
+
+async def collect(rows, **kwargs):
+    executed = []
+    pages = []
+    async for page in keyset_pages(lambda: FakeQuery(rows, executed), **kwargs):
+        pages.append([row['message_id'] for row in page])
+    return pages, executed
+
+
+async def test_keyset_pages_ascending():
+    pages, executed = await collect(make_rows(10), page_size=4)
+    assert pages == [['m00', 'm01', 'm02', 'm03'], ['m04', 'm05', 'm06', 'm07'], ['m08', 'm09']]
+    assert executed[0] is None
+    assert executed[1] == ('2025-07-09T10:00:01+00:00', 'm03')
+
+
+async def test_keyset_pages_descending():
+    pages, _ = await collect(make_rows(7), page_size=3, desc=True)
+    assert pages == [['m06', 'm05', 'm04'], ['m03', 'm02', 'm01'], ['m00']]
+
+
+async def test_keyset_pages_stops_after_full_last_page():
+    pages, executed = await collect(make_rows(6), page_size=3)
+    assert pages == [['m00', 'm01', 'm02'], ['m03', 'm04', 'm05']]
+    # A full page needs one more query to find out it was the last
+    assert len(executed) == 3
+
+
+async def test_keyset_pages_resumes_after_cursor():
+    rows = make_rows(6)
+    pages, _ = await collect(rows, page_size=10, after=decode_cursor(encode_cursor(rows[3])))
+    assert pages == [['m04', 'm05']]
+
+
+async def test_keyset_pages_empty():
+    pages, executed = await collect([], page_size=3)
+    assert pages == []
+    assert executed == [None]
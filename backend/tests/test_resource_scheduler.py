@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from agentpress.resource_scheduler import SlotPool
+
+
+async def settle():
+    # Let woken waiters run up to their next await
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_acquire_within_capacity_does_not_wait():
+    pool = SlotPool("test:capacity", 2)
+    first = await pool.acquire("a")
+    second = await pool.acquire("a")
+    assert pool.in_use == 2
+    first.release()
+    second.release()
+    assert pool.in_use == 0
+
+
+async def test_release_is_idempotent():
+    pool = SlotPool("test:idempotent", 1)
+    slot = await pool.acquire("a")
+    slot.release()
+    slot.release()
+    assert pool.in_use == 0
+
+
+async def test_release_hands_slot_to_waiter():
+    pool = SlotPool("test:handoff", 1)
+    held = await pool.acquire("a")
+    waiter = asyncio.create_task(pool.acquire("b"))
+    await settle()
+    assert pool.waiting == 1
+
+    held.release()
+    granted = await waiter
+    # The slot passed straight to the waiter instead of being freed
+    assert pool.in_use == 1
+    assert pool.waiting == 0
+    granted.release()
+    assert pool.in_use == 0
+
+
+async def test_new_caller_cannot_take_slot_ahead_of_waiters():
+    pool = SlotPool("test:order", 1)
+    held = await pool.acquire("a")
+    waiter = asyncio.create_task(pool.acquire("b"))
+    await settle()
+
+    held.release()
+    late = asyncio.create_task(pool.acquire("c"))
+    await settle()
+    assert waiter.done()
+    assert not late.done()
+
+    (await waiter).release()
+    (await late).release()
+    assert pool.in_use == 0
+
+
+async def test_round_robin_across_accounts():
+    pool = SlotPool("test:fairness", 1)
+    held = await pool.acquire("busy")
+    order = []
+
+    async def use(account):
+        slot = await pool.acquire(account)
+        order.append(account)
+        await asyncio.sleep(0)
+        slot.release()
+
+    # One account queues many calls before another queues one
+    tasks = [asyncio.create_task(use("busy")) for _ in range(3)]
+    await settle()
+    tasks.append(asyncio.create_task(use("quiet")))
+    await settle()
+
+    held.release()
+    await asyncio.gather(*tasks)
+    assert order == ["busy", "quiet", "busy", "busy"]
+    assert pool.in_use == 0
+
+
+async def test_cancelled_waiter_leaves_queue():
+    pool = SlotPool("test:cancel", 1)
+    held = await pool.acquire("a")
+    cancelled = asyncio.create_task(pool.acquire("b"))
+    other = asyncio.create_task(pool.acquire("c"))
+    await settle()
+    assert pool.waiting == 2
+
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert pool.waiting == 1
+
+    held.release()
+    (await other).release()
+    assert pool.in_use == 0
+    assert pool.waiting == 0
+
+
+async def test_slot_granted_to_cancelled_waiter_is_passed_on():
+    pool = SlotPool("test:grant-cancel", 1)
+    held = await pool.acquire("a")
+    cancelled = asyncio.create_task(pool.acquire("b"))
+    other = asyncio.create_task(pool.acquire("c"))
+    await settle()
+
+    # The slot is granted to the first waiter, which is cancelled before it resumes
+    held.release()
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+
+    (await other).release()
+    assert pool.in_use == 0
+    assert pool.waiting == 0
+
+
+async def test_cancelled_last_waiter_frees_slot():
+    pool = SlotPool("test:grant-cancel-last", 1)
+    held = await pool.acquire("a")
+    cancelled = asyncio.create_task(pool.acquire("b"))
+    await settle()
+
+    held.release()
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert pool.in_use == 0
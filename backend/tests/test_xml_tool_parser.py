@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from agentpress.xml_tool_parser import XMLToolCallStream, XMLToolParser
+
+CONTENT = """Let me look at the project first, since a < b and b > c.
+
+<function_calls>
+<invoke name="execute_command">
+<parameter name="command">ls -la && echo "<done>"</parameter>
+<parameter name="timeout">30</parameter>
+</invoke>
+<invoke name="create_file">
+<parameter name="file_path">index.html</parameter>
+<parameter name="file_contents"><html><body><function_calls>not a block</function_calls></body></html></parameter>
+</invoke>
+</function_calls>
+
+Now the legacy format, with a nested tag of the same name:
+
+<create-file file_path="notes.md">Use <create-file>path</create-file> to add files</create-file>
+
+<FUNCTION_CALLS>
+<invoke name='str_replace'>
+<parameter name="file_path">app.py</parameter>
+<parameter name="options">{"count": 1, "regex": false}</parameter>
+</invoke>
+</FUNCTION_CALLS>
+And some trailing text with an unfinished <tag"""
+
+
+def regex_tool_calls(content):
+    """Tool calls found by re-scanning the whole buffer with the parser's patterns."""
+    parser = XMLToolParser()
+    return [
+        parser._parse_invoke_block(function_name, invoke_content, block)
+        for block in parser.FUNCTION_CALLS_PATTERN.findall(content)
+        for function_name, invoke_content in parser.INVOKE_PATTERN.findall(block)
+    ]
+
+
+def summarize(tool_calls):
+    return [(tool_call.function_name, tool_call.parameters) for tool_call in tool_calls]
+
+
+def feed_in_chunks(content, boundaries):
+    stream = XMLToolCallStream(legacy_tags=["create-file"])
+    blocks = []
+    previous = 0
+    for boundary in boundaries + [len(content)]:
+        blocks.extend(stream.feed(content[previous:boundary]))
+        previous = boundary
+    return blocks
+
+
+def test_whole_buffer_matches_regex_scan():
+    # The regex scan ends a block at a closing tag inside a parameter value, so leave those out
+    content = CONTENT.replace("<function_calls>not a block</function_calls>", "not a block")
+    tool_calls = [tool_call for block in feed_in_chunks(content, []) for tool_call in block.tool_calls]
+    assert summarize(tool_calls) == summarize(regex_tool_calls(content))
+
+
+def test_markup_inside_parameter_values_is_not_parsed():
+    blocks = feed_in_chunks(CONTENT, [])
+    tool_calls = [tool_call for block in blocks for tool_call in block.tool_calls]
+
+    assert [tool_call.function_name for tool_call in tool_calls] == ["execute_command", "create_file", "str_replace"]
+    assert [block.legacy_tag for block in blocks] == [None, "create-file", None]
+    assert blocks[1].raw_xml == '<create-file file_path="notes.md">Use <create-file>path</create-file> to add files</create-file>'
+    assert tool_calls[1].parameters["file_contents"].startswith("<html><body><function_calls>")
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_chunk_boundaries_match_whole_buffer(seed):
+    rng = random.Random(seed)
+    boundaries = sorted(rng.sample(range(1, len(CONTENT)), rng.randint(1, 200)))
+
+    expected = feed_in_chunks(CONTENT, [])
+    blocks = feed_in_chunks(CONTENT, boundaries)
+
+    assert [block.raw_xml for block in blocks] == [block.raw_xml for block in expected]
+    assert [summarize(block.tool_calls) for block in blocks] == [summarize(block.tool_calls) for block in expected]
+
+
+def test_single_character_chunks_match_whole_buffer():
+    expected = feed_in_chunks(CONTENT, [])
+    blocks = feed_in_chunks(CONTENT, list(range(1, len(CONTENT))))
+    assert [block.raw_xml for block in blocks] == [block.raw_xml for block in expected]
+
+
+def test_text_outside_of_blocks_is_not_kept():
+    stream = XMLToolCallStream()
+    for _ in range(1000):
+        assert stream.feed("plain text that mentions a < b in passing. ") == []
+    assert len(stream._buffer) < 100
@@ -5,9 +5,9 @@ from datetime import datetime, timezone
 
 from .core import TriggerResult, TriggerEvent
 from services.supabase import DBConnection
-from services import redis
 from utils.logger import logger, structlog
 from run_agent_background import run_agent_background
+from agent import run_registry
 
 class TriggerExecutor:
     def __init__(self, db_connection: DBConnection):
@@ -371,11 +371,10 @@ Please execute this workflow according to its defined steps."""
         
         # Register this run in Redis with TTL
         instance_id = "workflow_trigger_executor"
-        instance_key = f"active_run:{instance_id}:{agent_run_id}"
         try:
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_registry.register_run(instance_id, agent_run_id)
         except Exception as e:
-            logger.warning(f"Failed to register workflow agent run in Redis ({instance_key}): {str(e)}")
+            logger.warning(f"Failed to register workflow agent run {agent_run_id} for instance {instance_id} in Redis: {str(e)}")
 
         request_id = structlog.contextvars.get_contextvars().get('request_id')
 
@@ -394,6 +393,7 @@ Please execute this workflow according to its defined steps."""
             is_agent_builder=False,
             target_agent_id=None,
             request_id=request_id,
+            account_id=agent_config.get('account_id'),
         )
         
         logger.info(f"Created workflow agent run: {agent_run_id}")
@@ -722,11 +722,10 @@ Please respond appropriately to this trigger event."""
         agent_run_id = agent_run.data[0]['id']
         
         instance_id = "trigger_executor"
-        instance_key = f"active_run:{instance_id}:{agent_run_id}"
         try:
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_registry.register_run(instance_id, agent_run_id)
         except Exception as e:
-            logger.warning(f"Failed to register agent run in Redis ({instance_key}): {str(e)}")
+            logger.warning(f"Failed to register agent run {agent_run_id} for instance {instance_id} in Redis: {str(e)}")
 
         request_id = structlog.contextvars.get_contextvars().get('request_id')
 
@@ -744,6 +743,7 @@ Please respond appropriately to this trigger event."""
             is_agent_builder=False,
             target_agent_id=None,
             request_id=request_id,
+            account_id=agent_config.get('account_id'),
         )
         
         logger.info(f"Started background agent execution for trigger (run_id: {agent_run_id})")
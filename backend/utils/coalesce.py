@@ -0,0 +1,93 @@
+"""
+In-process cache that coalesces concurrent misses into a single call.
+
+Lookups against slow upstreams (Stripe, the Supabase auth admin API) are
+often made by several requests of the same account at once, e.g. the
+billing page firing its status, models and usage requests together. With a
+plain cache each of them misses and calls the upstream. CoalescingCache
+keeps one in-flight load per key that every concurrent caller awaits:
+
+    subscriptions = CoalescingCache(ttl=30, max_entries=10000)
+
+    async def get_subscriptions(customer_id):
+        return await subscriptions.get(customer_id, lambda: fetch(customer_id))
+
+Results are kept in an LRU for `ttl` seconds. invalidate() drops the entry
+and detaches the in-flight load, so a load started before the invalidation
+can neither be joined by later callers nor store its result.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class CoalescingCache:
+    """LRU of values with a TTL whose concurrent misses share one load per key."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        """Initialize the cache.
+
+        Args:
+            ttl: Lifetime of a value in seconds; 0 disables caching but still coalesces loads
+            max_entries: Maximum number of cached values
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._loads: Dict[Hashable, asyncio.Task] = {}
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable[Any]], use_cache: bool = True) -> Any:
+        """Get the value of a key, loading it if it is not cached.
+
+        Args:
+            key: The cache key
+            load: Loads the value; called at most once for concurrent misses of a key
+            use_cache: Whether a cached value may be returned. The loaded value
+                       is cached either way.
+
+        Exceptions raised by load propagate to every caller waiting on it and are not cached.
+        """
+        if use_cache:
+            cached = self._entries.get(key)
+            if cached is not None:
+                expires_at, value = cached
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        task = self._loads.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, load))
+            self._loads[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # A cancelled caller must not cancel the load the other callers wait on
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        value = await load()
+        # Not stored if the key was invalidated while loading
+        if self.ttl > 0 and self._loads.get(key) is asyncio.current_task():
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._loads.get(key) is task:
+            del self._loads[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled
+            task.exception()
+
+    def invalidate(self, key: Hashable):
+        """Drop the cached value of a key and detach its in-flight load."""
+        self._entries.pop(key, None)
+        self._loads.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._loads.clear()
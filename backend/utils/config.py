@@ -223,6 +223,64 @@ class Configuration:
     LANGFUSE_SECRET_KEY: Optional[str] = None
     LANGFUSE_HOST: str = "https://cloud.langfuse.com"
 
+    # Thread message cache
+    MESSAGE_CACHE_MAX_THREADS: int = 256
+    MESSAGE_CACHE_REDIS_TTL: int = 3600
+    TOKEN_CACHE_MAX_ENTRIES: int = 50000
+
+    # Write-behind message persistence
+    MESSAGE_WRITER_BATCH_SIZE: int = 20
+    MESSAGE_WRITER_FLUSH_INTERVAL_MS: int = 50
+
+    # Agent run bootstrap cache
+    AGENT_BOOTSTRAP_CACHE_TTL: int = 300
+    AGENT_BOOTSTRAP_CACHE_MAX_ENTRIES: int = 512
+
+    # Billing gate cache (seconds)
+    BILLING_UNLIMITED_CACHE_TTL: int = 600
+    BILLING_SUBSCRIPTION_CACHE_TTL: int = 300
+    BILLING_USAGE_COUNTER_TTL: int = 3600
+    BILLING_USER_EMAIL_CACHE_TTL: int = 300
+
+    # In-process Stripe subscription cache (seconds / entries)
+    STRIPE_SUBSCRIPTION_CACHE_TTL: int = 30
+    STRIPE_SUBSCRIPTION_CACHE_SIZE: int = 10000
+
+    # Agent run response streams (Redis Streams transport)
+    RESPONSE_STREAM_MAXLEN: int = 100000
+    RESPONSE_STREAM_READ_COUNT: int = 500
+    RESPONSE_STREAM_BLOCK_MS: int = 5000
+    STREAM_HUB_MAX_QUEUE: int = 256
+
+    # Active run registry heartbeat (seconds)
+    ACTIVE_RUN_HEARTBEAT_INTERVAL: int = 30
+    ACTIVE_RUN_HEARTBEAT_TTL: int = 120
+
+    # Agent run response sink (coalesced Redis writes)
+    RESPONSE_SINK_BATCH_SIZE: int = 64
+    RESPONSE_SINK_FLUSH_INTERVAL_MS: int = 15
+    RESPONSE_SINK_MAX_PENDING: int = 2000
+
+    # Worker concurrency scheduler (slots per worker process)
+    SCHEDULER_LLM_SLOTS_PER_PROVIDER: int = 16
+    SCHEDULER_LLM_PROVIDER_SLOTS: Optional[str] = None
+    SCHEDULER_SANDBOX_SLOTS: int = 32
+    SCHEDULER_BROWSER_SLOTS: int = 8
+    SCHEDULER_MCP_SLOTS: int = 16
+    SCHEDULER_DEFAULT_SLOTS: int = 16
+    SCHEDULER_MAX_ACTIVE_RUNS: int = 16
+    SCHEDULER_DEFER_DELAY_MS: int = 5000
+    SCHEDULER_MAX_DEFERRALS: int = 6
+
+    # Prometheus metrics of the worker processes
+    WORKER_METRICS_PORT: int = 9191
+
+    # Span tracing of agent runs
+    TRACE_SAMPLE_PERCENT: int = 10
+    TRACE_MAX_SPANS_PER_RUN: int = 5000
+    TRACE_RING_BUFFER_SIZE: int = 200
+    TRACE_PROFILE_TTL: int = 86400
+
     # Admin API key for server-side operations
     ADMIN_API_KEY: Optional[str] = None
     
@@ -0,0 +1,160 @@
+"""
+Prometheus metrics of the agent pipeline.
+
+Usage:
+    from utils.metrics import TOOL_EXECUTION_SECONDS, observe
+
+    with observe(TOOL_EXECUTION_SECONDS, tool="web_search"):
+        ...
+
+The API serves the metrics on /metrics. Each worker process calls
+start_worker_metrics_server(), which serves them on WORKER_METRICS_PORT.
+dramatiq forks several worker processes, so only the first one binds the
+port. Set PROMETHEUS_MULTIPROC_DIR to an empty, writable directory before
+the processes start, and that one server reports the metrics of all of them.
+Without it, it reports only its own process.
+"""
+
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    start_http_server,
+)
+
+from utils.config import config
+from utils.logger import logger
+
+# Buckets for calls that stream or run tools, which take seconds rather than milliseconds
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (100, 500, 1000, 5000, 10000, 25000, 50000, 100000, 250000)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "agent_llm_time_to_first_token_seconds", "Time from the start of a streamed LLM response to its first chunk",
+    ["model"], buckets=SLOW_BUCKETS,
+)
+# MCP tools are labelled "mcp": their method names come from user-configured servers and are unbounded
+TOOL_EXECUTION_SECONDS = Histogram(
+    "agent_tool_execution_seconds", "Duration of tool executions, excluding the wait for a worker slot",
+    ["tool", "success"], buckets=SLOW_BUCKETS,
+)
+TOOL_SLOT_WAIT_SECONDS = Histogram(
+    "agent_tool_slot_wait_seconds", "Time tool calls wait for a worker slot of their resource class",
+    ["resource"], buckets=SLOW_BUCKETS,
+)
+SUPABASE_REQUEST_SECONDS = Histogram(
+    "agent_supabase_request_seconds", "Latency of Supabase REST requests until their response headers",
+    ["table", "method"],
+)
+REDIS_OP_SECONDS = Histogram(
+    "agent_redis_op_seconds", "Latency of Redis operations",
+    ["op"],
+)
+# Summed over the live runs of all worker processes
+RESPONSE_SINK_QUEUE_DEPTH = Gauge(
+    "agent_response_sink_queue_depth", "Responses of agent runs waiting to be written to Redis",
+    multiprocess_mode="livesum",
+)
+RESPONSE_SINK_FLUSH_SECONDS = Histogram(
+    "agent_response_sink_flush_seconds", "Duration of the Redis pipelines writing batches of responses, including a retry",
+    ["transport"],
+)
+RESPONSE_SINK_BATCH_SIZE = Histogram(
+    "agent_response_sink_batch_size", "Number of responses written per Redis pipeline",
+    ["transport"], buckets=BATCH_BUCKETS,
+)
+COMPRESS_MESSAGES_SECONDS = Histogram(
+    "agent_compress_messages_seconds", "Duration of context compression before LLM calls",
+    ["model"],
+)
+COMPRESS_MESSAGES_TOKENS_REMOVED = Histogram(
+    "agent_compress_messages_tokens_removed", "Tokens removed by context compression when the context exceeded the budget",
+    ["model"], buckets=TOKEN_BUCKETS,
+)
+BILLING_CHECK_SECONDS = Histogram(
+    "agent_billing_check_seconds", "Latency of billing and model access checks",
+    ["check"],
+)
+MCP_CONNECT_SECONDS = Histogram(
+    "agent_mcp_connect_seconds", "Time to connect to an MCP server and list its tools",
+    ["transport"], buckets=SLOW_BUCKETS,
+)
+AGENT_SETUP_PHASE_SECONDS = Histogram(
+    "agent_setup_phase_seconds", "Duration of the setup phases of an agent run before its first LLM call",
+    ["phase", "bootstrap_cache"],
+)
+AUTO_CONTINUES = Counter(
+    "agent_auto_continues_total", "Automatic continuations of a thread run",
+    ["reason"],
+)
+
+_worker_server_started = False
+
+
+@contextmanager
+def observe(histogram: Histogram, **labels):
+    """Observe the duration of the block in a histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorator observing the duration of every call of a function, sync or async."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with observe(histogram, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe(histogram, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _registry() -> CollectorRegistry:
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Render the metrics in the Prometheus text format, returning the body and its content type."""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def start_worker_metrics_server(port: Optional[int] = None):
+    """Serve the metrics of the worker processes over HTTP, once per process."""
+    global _worker_server_started
+    if _worker_server_started:
+        return
+    _worker_server_started = True
+    port = port or config.WORKER_METRICS_PORT
+    try:
+        start_http_server(port, registry=_registry())
+        logger.info(f"Serving worker metrics on port {port}")
+    except OSError as e:
+        # Another worker process of this host already serves them
+        logger.debug(f"Worker metrics port {port} is not available: {str(e)}")
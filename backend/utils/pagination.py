@@ -0,0 +1,101 @@
+"""
+Keyset pagination of PostgREST queries.
+
+OFFSET pagination (`.range(offset, offset + n - 1)`) makes the database
+skip every row of the previous pages, so each page is slower than the one
+before, and rows inserted or deleted while the pages are read shift the
+offsets, skipping or repeating rows. Keyset pagination instead asks for the
+rows that sort after the last row of the previous page:
+
+    async for page in keyset_pages(
+        lambda: client.table('messages').select('message_id, created_at, content').eq('thread_id', thread_id),
+        keys=('created_at', 'message_id'),
+    ):
+        ...
+
+The sort keys must end in a unique column, so that the position of every
+row is unambiguous. Callers serving pages over HTTP hand the position to
+the client as an opaque cursor (encode_cursor / decode_cursor).
+"""
+
+import base64
+import json
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Sequence
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def _quote(value: Any) -> str:
+    # Values in PostgREST logic trees are quoted, since timestamps contain reserved characters
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def keyset_filter(keys: Sequence[str], values: Sequence[Any], desc: bool = False) -> str:
+    """Build the PostgREST or= filter selecting the rows that sort after values.
+
+    For keys (a, b) in ascending order this is a > x OR (a = x AND b > y).
+    """
+    op = 'lt' if desc else 'gt'
+    branches = []
+    for i, key in enumerate(keys):
+        conditions = [f"{k}.eq.{_quote(v)}" for k, v in zip(keys[:i], values[:i])]
+        conditions.append(f"{key}.{op}.{_quote(values[i])}")
+        branches.append(conditions[0] if len(conditions) == 1 else f"and({','.join(conditions)})")
+    return ','.join(branches)
+
+
+async def keyset_pages(
+    build_query: Callable[[], Any],
+    keys: Sequence[str] = ('created_at', 'message_id'),
+    desc: bool = False,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    after: Optional[Sequence[Any]] = None,
+) -> AsyncGenerator[List[Dict[str, Any]], None]:
+    """Yield the rows of a query page by page, in the order of keys.
+
+    Args:
+        build_query: Returns a new filtered query builder; called once per page
+        keys: Columns the rows are ordered by, ending in a unique column.
+              The query must select all of them.
+        desc: Whether to order by the keys in descending order
+        page_size: Maximum number of rows per page
+        after: Key values of the row to continue after, e.g. from decode_cursor
+    """
+    last = list(after) if after else None
+    while True:
+        query = build_query()
+        if last is not None:
+            query = query.or_(keyset_filter(keys, last, desc))
+        for key in keys:
+            query = query.order(key, desc=desc)
+        result = await query.limit(page_size).execute()
+
+        rows = result.data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = [rows[-1][key] for key in keys]
+
+
+async def keyset_rows(build_query: Callable[[], Any], **kwargs) -> AsyncGenerator[Dict[str, Any], None]:
+    """Yield the rows of a query one by one; see keyset_pages for the arguments."""
+    async for page in keyset_pages(build_query, **kwargs):
+        for row in page:
+            yield row
+
+
+def encode_cursor(row: Dict[str, Any], keys: Sequence[str] = ('created_at', 'message_id')) -> str:
+    """Encode the position of a row as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps([row[key] for key in keys]).encode()).decode()
+
+
+def decode_cursor(cursor: str, keys: Sequence[str] = ('created_at', 'message_id')) -> List[Any]:
+    """Decode a cursor made by encode_cursor, raising ValueError if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
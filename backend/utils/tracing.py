@@ -0,0 +1,287 @@
+"""
+Lightweight span tracing of agent runs.
+
+Langfuse only records the coarse generations of a run, so a slow run does not
+show whether the time went to Supabase, Redis, the sandbox or the LLM. This
+module records nested spans of the hot path:
+
+    from utils.tracing import span, traced
+
+    with span("sandbox.ensure", project_id=project_id):
+        ...
+
+    @traced("redis.get")
+    async def get(key): ...
+
+- The current trace and span live in contextvars, so spans nest across
+  awaits and tasks created while a span is open, like the structlog
+  context of the run.
+- Sampling is decided once per run (TRACE_SAMPLE_PERCENT). Outside a sampled
+  run span() costs one contextvar lookup.
+- Finished traces are kept in an in-memory ring buffer of the last
+  TRACE_RING_BUFFER_SIZE runs of the process. The worker also stores them in
+  Redis, so the API process can serve /debug/runs/{id}/profile.
+"""
+
+import functools
+import inspect
+import itertools
+import random
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.config import config
+
+
+class Span:
+    """A timed operation inside a run trace. Times are in seconds since the start of the trace."""
+
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attributes", "error")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, start: float, attributes: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round(self.start * 1000, 3),
+            "end_ms": round(self.end * 1000, 3) if self.end is not None else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class RunTrace:
+    """The spans recorded for one sampled agent run."""
+
+    def __init__(self, agent_run_id: str, max_spans: int):
+        self.agent_run_id = agent_run_id
+        self.max_spans = max_spans
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        self._ids = itertools.count(1)
+        self.spans: List[Span] = []
+        self.dropped_spans = 0
+
+    def now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def start_span(self, name: str, parent_id: Optional[int], attributes: Dict[str, Any]) -> Optional[Span]:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return None
+        new_span = Span(next(self._ids), parent_id, name, self.now(), attributes)
+        self.spans.append(new_span)
+        return new_span
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "agent_run_id": self.agent_run_id,
+            "started_at": self.started_at,
+            "dropped_spans": self.dropped_spans,
+            "spans": [s.to_dict() for s in self.spans],
+        }
+
+
+_current_trace: ContextVar[Optional[RunTrace]] = ContextVar("run_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("run_span", default=None)
+
+_finished_traces: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def profile_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:profile"
+
+
+def start_run_trace(agent_run_id: str, force: bool = False) -> Optional[Tuple[Token, Token]]:
+    """Start tracing the current run if it is sampled, opening its root span.
+
+    Returns:
+        The tokens to pass to finish_run_trace, or None if the run is not sampled.
+    """
+    if not force and random.random() * 100 >= config.TRACE_SAMPLE_PERCENT:
+        return None
+    trace = RunTrace(agent_run_id, config.TRACE_MAX_SPANS_PER_RUN)
+    root = trace.start_span("agent_run", None, {})
+    return _current_trace.set(trace), _current_span.set(root)
+
+
+def finish_run_trace(tokens: Optional[Tuple[Token, Token]]) -> Optional[Dict[str, Any]]:
+    """Close the root span of the current run and keep its trace in the ring buffer.
+
+    Returns:
+        The finished trace as a dict, or None if the run was not sampled.
+    """
+    if tokens is None:
+        return None
+    trace = _current_trace.get()
+    root = _current_span.get()
+    _current_span.reset(tokens[1])
+    _current_trace.reset(tokens[0])
+    if trace is None:
+        return None
+
+    end = trace.now()
+    if root is not None:
+        root.end = end
+    # Spans left open by cancelled tasks end with the run
+    for open_span in trace.spans:
+        if open_span.end is None:
+            open_span.end = end
+            open_span.error = open_span.error or "unfinished"
+
+    data = trace.to_dict()
+    _finished_traces[trace.agent_run_id] = data
+    _finished_traces.move_to_end(trace.agent_run_id)
+    while len(_finished_traces) > config.TRACE_RING_BUFFER_SIZE:
+        _finished_traces.popitem(last=False)
+    return data
+
+
+def get_finished_trace(agent_run_id: str) -> Optional[Dict[str, Any]]:
+    """Get a trace from the ring buffer of this process."""
+    return _finished_traces.get(agent_run_id)
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """Start a span without making it the current span, for operations with no nested spans.
+
+    The span must be ended with end_span. Returns None outside a sampled run.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent = _current_span.get()
+    return trace.start_span(name, parent.span_id if parent else None, attributes)
+
+
+def end_span(started: Optional[Span], error: Optional[BaseException] = None, **attributes):
+    """End a span returned by start_span."""
+    if started is None:
+        return
+    trace = _current_trace.get()
+    started.end = trace.now() if trace else started.start
+    if attributes:
+        started.attributes.update(attributes)
+    if error is not None:
+        started.error = f"{type(error).__name__}: {error}"
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record the block as a span nested in the current span, yielding the span or None."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = trace.start_span(name, parent.span_id if parent else None, attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = trace.now()
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """Decorator recording every call of a function, sync or async, as a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current_trace.get() is None:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def critical_path(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """Compute the critical path of a finished trace.
+
+    Walking back from the end of the root span, the time of each span is
+    attributed to the child that finished last before that point, recursively,
+    and to the span itself where no child was running. The result is the
+    chain of operations that determined the duration of the run.
+    """
+    spans = trace.get("spans") or []
+    if not spans:
+        return {"agent_run_id": trace.get("agent_run_id"), "duration_ms": 0, "critical_path": [], "by_category": {}}
+
+    children: Dict[Optional[int], List[Dict[str, Any]]] = defaultdict(list)
+    for s in spans:
+        children[s["parent_id"]].append(s)
+    for siblings in children.values():
+        siblings.sort(key=lambda s: s["end_ms"], reverse=True)
+    root = children[None][0]
+
+    segments: List[Tuple[Dict[str, Any], float, float]] = []
+
+    def walk(current: Dict[str, Any], until: float):
+        cursor = min(current["end_ms"], until)
+        for child in children.get(current["id"], []):
+            if child["start_ms"] >= cursor:
+                continue
+            child_end = min(child["end_ms"], cursor)
+            if cursor > child_end:
+                segments.append((current, child_end, cursor))
+            walk(child, child_end)
+            cursor = child["start_ms"]
+        if cursor > current["start_ms"]:
+            segments.append((current, current["start_ms"], cursor))
+
+    walk(root, root["end_ms"])
+    segments.reverse()
+
+    path: List[Dict[str, Any]] = []
+    by_category: Dict[str, float] = defaultdict(float)
+    for s, start, end in segments:
+        by_category[s["name"].split(".", 1)[0]] += end - start
+        if path and path[-1]["span_id"] == s["id"]:
+            path[-1]["duration_ms"] = round(end - path[-1]["start_ms"], 3)
+            continue
+        path.append({
+            "span_id": s["id"],
+            "name": s["name"],
+            "start_ms": round(start, 3),
+            "duration_ms": round(end - start, 3),
+            "attributes": s.get("attributes") or {},
+            "error": s.get("error"),
+        })
+
+    return {
+        "agent_run_id": trace.get("agent_run_id"),
+        "started_at": trace.get("started_at"),
+        "duration_ms": round(root["end_ms"] - root["start_ms"], 3),
+        "span_count": len(spans),
+        "dropped_spans": trace.get("dropped_spans", 0),
+        "by_category": {category: round(ms, 3) for category, ms in sorted(by_category.items(), key=lambda item: -item[1])},
+        "critical_path": path,
+    }
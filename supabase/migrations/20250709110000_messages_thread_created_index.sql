@@ -0,0 +1,35 @@
+-- Migration: Composite indexes for the hot paths on messages (1/4)
+-- messages only had single-column indexes on thread_id and created_at, while
+-- the hot queries filter on thread_id plus is_llm_message or type and order
+-- by created_at:
+--
+--   get_llm_messages (message cache):
+--     WHERE thread_id = $1 AND is_llm_message [AND created_at >= $2]
+--     ORDER BY created_at, message_id
+--   latest summary / get_thread_head / run_agent lookups:
+--     WHERE thread_id = $1 AND type = $2 [AND is_llm_message]
+--     ORDER BY created_at DESC LIMIT 1
+--   agent builder chat history:
+--     WHERE thread_id = $1 AND type NOT IN ('status', 'summary')
+--     ORDER BY created_at, message_id
+--
+-- messages is the busiest write table, so each index is built CONCURRENTLY
+-- to keep inserts flowing. CONCURRENTLY cannot run inside a transaction,
+-- hence one statement per migration and no BEGIN/COMMIT. The superseded
+-- idx_messages_thread_id is dropped only after the new indexes exist.
+--
+-- Each migration names the query its index is for and the plan to expect.
+-- Check them against a large thread after deploying, e.g.
+--   EXPLAIN (ANALYZE, BUFFERS) <query> with a real thread_id;
+-- none of them should show a Seq Scan on messages or a Sort node.
+--
+-- This index serves the full history of a thread in order, and every
+-- lookup by thread_id alone.
+--
+--   Query: SELECT * FROM messages WHERE thread_id = $1
+--            AND type NOT IN ('status', 'summary')
+--            ORDER BY created_at, message_id LIMIT 1000;
+--   Expected: Index Scan using idx_messages_thread_created, type as a Filter
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_thread_created
+    ON messages(thread_id, created_at, message_id);
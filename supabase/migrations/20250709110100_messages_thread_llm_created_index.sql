@@ -0,0 +1,13 @@
+-- Migration: Composite indexes for the hot paths on messages (2/4)
+-- LLM messages of a thread in order, the rows loaded before every LLM call.
+-- See 20250709110000_messages_thread_created_index.sql.
+--
+--   Query: SELECT message_id, type, content, metadata, created_at FROM messages
+--            WHERE thread_id = $1 AND is_llm_message AND created_at >= $2
+--            ORDER BY created_at, message_id LIMIT 1000;
+--   Expected: Index Scan using idx_messages_thread_llm_created,
+--             created_at >= $2 in the Index Cond
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_thread_llm_created
+    ON messages(thread_id, created_at, message_id)
+    WHERE is_llm_message;
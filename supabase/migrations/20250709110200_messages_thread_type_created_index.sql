@@ -0,0 +1,15 @@
+-- Migration: Composite indexes for the hot paths on messages (3/4)
+-- Latest message of a type in a thread.
+-- See 20250709110000_messages_thread_created_index.sql.
+--
+--   Query: SELECT message_id FROM messages
+--            WHERE thread_id = $1 AND type = 'summary' AND is_llm_message
+--            ORDER BY created_at DESC LIMIT 1;
+--   Expected: Limit over an Index Scan using idx_messages_thread_type_created
+--   The same holds for the browser_state and image_context lookups of
+--   get_thread_head and the latest user message read by run_agent.
+--   Its type IN ('assistant', 'tool', 'user') lookup may instead scan
+--   idx_messages_thread_created backwards; either plan stops at the first row.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_thread_type_created
+    ON messages(thread_id, type, created_at DESC);
@@ -0,0 +1,95 @@
+-- Migration: Usage ledger and monthly rollups
+-- Usage used to be derived from messages on every read: get_usage_logs
+-- listed the account's threads of the month, scanned their
+-- assistant_response_end messages and priced each one in Python.
+--
+-- usage_ledger gets one append-only row per assistant_response_end when the
+-- backend persists it, with the model and cost computed at write time.
+-- usage_monthly_rollups holds the billable totals per account and month and
+-- is maintained by a trigger on every ledger insert. As in the message based
+-- calculation, usage is billable in a month only if its thread was created in
+-- that month.
+--
+-- Usage written before this migration is loaded with backfill_usage_ledger.py.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS usage_ledger (
+    entry_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    account_id UUID NOT NULL REFERENCES basejump.accounts(id) ON DELETE CASCADE,
+    thread_id UUID NOT NULL,
+    project_id UUID,
+    -- No foreign key: ledger entries outlive deleted messages and threads
+    message_id UUID NOT NULL UNIQUE,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cost NUMERIC(20, 10) NOT NULL DEFAULT 0,
+    thread_created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT TIMEZONE('utc'::text, NOW())
+);
+
+CREATE INDEX IF NOT EXISTS idx_usage_ledger_account_created
+    ON usage_ledger(account_id, created_at DESC, message_id DESC);
+
+CREATE TABLE IF NOT EXISTS usage_monthly_rollups (
+    account_id UUID NOT NULL REFERENCES basejump.accounts(id) ON DELETE CASCADE,
+    month DATE NOT NULL,
+    cost NUMERIC(20, 10) NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    request_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT TIMEZONE('utc'::text, NOW()),
+    PRIMARY KEY (account_id, month)
+);
+
+ALTER TABLE usage_ledger ENABLE ROW LEVEL SECURITY;
+ALTER TABLE usage_monthly_rollups ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY usage_ledger_select ON usage_ledger
+    FOR SELECT
+    USING (basejump.has_role_on_account(account_id) = true);
+
+CREATE POLICY usage_monthly_rollups_select ON usage_monthly_rollups
+    FOR SELECT
+    USING (basejump.has_role_on_account(account_id) = true);
+
+-- Ledger entries are never updated or deleted by the application
+CREATE OR REPLACE FUNCTION rollup_usage_ledger_entry()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    entry_month DATE := date_trunc('month', NEW.created_at AT TIME ZONE 'UTC')::date;
+BEGIN
+    IF date_trunc('month', NEW.thread_created_at AT TIME ZONE 'UTC')::date <> entry_month THEN
+        RETURN NEW;
+    END IF;
+
+    INSERT INTO usage_monthly_rollups (account_id, month, cost, prompt_tokens, completion_tokens, request_count)
+    VALUES (NEW.account_id, entry_month, NEW.cost, NEW.prompt_tokens, NEW.completion_tokens, 1)
+    ON CONFLICT (account_id, month) DO UPDATE SET
+        cost = usage_monthly_rollups.cost + EXCLUDED.cost,
+        prompt_tokens = usage_monthly_rollups.prompt_tokens + EXCLUDED.prompt_tokens,
+        completion_tokens = usage_monthly_rollups.completion_tokens + EXCLUDED.completion_tokens,
+        request_count = usage_monthly_rollups.request_count + 1,
+        updated_at = TIMEZONE('utc'::text, NOW());
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_rollup_usage_ledger ON usage_ledger;
+CREATE TRIGGER trigger_rollup_usage_ledger
+    AFTER INSERT ON usage_ledger
+    FOR EACH ROW
+    EXECUTE FUNCTION rollup_usage_ledger_entry();
+
+GRANT SELECT ON usage_ledger, usage_monthly_rollups TO authenticated;
+GRANT ALL ON usage_ledger, usage_monthly_rollups TO service_role;
+
+COMMENT ON TABLE usage_ledger IS 'Append-only usage of every LLM response, priced when it was written';
+COMMENT ON TABLE usage_monthly_rollups IS 'Billable usage per account and month, maintained by trigger_rollup_usage_ledger';
+
+COMMIT;
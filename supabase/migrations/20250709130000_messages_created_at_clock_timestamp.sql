@@ -0,0 +1,7 @@
+-- Migration: Per-row creation time of messages
+-- Gives every row of a multi-row insert its own creation time.
+-- The message writer of the agent inserts streamed messages in batches and
+-- leaves created_at to the database. NOW() is the start time of the
+-- transaction, so all rows of a batch would share one created_at and lose
+-- their order for readers that only sort by created_at.
+ALTER TABLE messages ALTER COLUMN created_at SET DEFAULT TIMEZONE('utc'::text, clock_timestamp());